@@ -0,0 +1,135 @@
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import caches
+from django.db import transaction
+from django.http import Http404, JsonResponse
+from django.shortcuts import redirect
+from .database import SAFE_METHODS
+from .models import Membership
+from .shards import mess_shard
+
+
+def _cache():
+    return caches[getattr(settings, 'MEMBERSHIP_CACHE_ALIAS', 'default')]
+
+
+def _version_cache():
+    # Never culled, see VERSION_CACHE_ALIAS in settings
+    return caches[getattr(settings, 'VERSION_CACHE_ALIAS', 'default')]
+
+
+def _version_key(mess_id):
+    return f'membership-version:{mess_id}'
+
+
+def _bump(key):
+    cache = _version_cache()
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key was evicted between add and incr
+        cache.set(key, 1, timeout=None)
+
+
+def invalidate_memberships(mess_id):
+    """Drop the cached memberships of a mess once the current transaction commits"""
+    transaction.on_commit(lambda: _bump(_version_key(mess_id)))
+
+
+def membership_version(mess_id):
+    """Changes whenever a membership of the mess or the mess itself changes"""
+    return _version_cache().get(_version_key(mess_id), 0)
+
+
+def get_membership(request, mess_id):
+    """
+    The requesting user's Membership of a mess with its mess loaded, or
+    None when they are not a member. Resolved with one select_related query
+    and remembered for the rest of the request. When
+    MEMBERSHIP_CACHE_TIMEOUT is set it is also kept in the cache framework
+    across requests until a membership or the mess changes, including its
+    shard and shard lock, which rebalance_shard bumps the version for.
+    """
+    memo = request.__dict__.setdefault('_memberships', {})
+    if mess_id in memo:
+        return memo[mess_id]
+
+    timeout = getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 0)
+    membership = key = None
+    if timeout:
+        cache = _cache()
+        key = f'membership:{mess_id}:{membership_version(mess_id)}:{request.user.id}'
+        membership = cache.get(key)
+
+    if membership is None:
+        membership = Membership.objects.select_related('mess').filter(
+            mess_id=mess_id, user_id=request.user.id
+        ).first()
+        if membership is not None and key:
+            cache.set(key, membership, timeout)
+
+    if membership is not None:
+        membership.user = request.user
+    memo[mess_id] = membership
+    return membership
+
+
+def mess_member_required(role=None, denied_message='Permission denied.', json=False):
+    """
+    Decorator for views taking a mess_id, to be placed under login_required.
+    Sets request.mess and request.membership, or raises Http404 when the
+    user is not a member of the mess. With a role, members holding another
+    role are redirected home with denied_message, or get a 403 JSON error
+    when json is set. The view's mess data queries go to the mess's shard;
+    writes are refused while rebalance_shard is moving it. Works for sync
+    and async views.
+    """
+    def check(request, mess_id):
+        membership = get_membership(request, mess_id)
+        if membership is None:
+            if json:
+                return JsonResponse({'error': 'Mess not found or you do not have access.'}, status=404)
+            raise Http404('Mess not found or you do not have access.')
+
+        if role is not None and membership.role != role:
+            if json:
+                return JsonResponse({'error': denied_message}, status=403)
+            messages.error(request, denied_message)
+            return redirect('home')
+
+        if membership.mess.shard_locked and request.method not in SAFE_METHODS:
+            moving_message = 'This mess is being moved to another database, please try again in a minute.'
+            if json:
+                return JsonResponse({'error': moving_message}, status=503)
+            messages.warning(request, moving_message)
+            return redirect('home')
+
+        request.mess = membership.mess
+        request.membership = membership
+        return None
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapped(request, mess_id, *args, **kwargs):
+                # Reuse the user login_required already loaded instead of loading it again in the thread
+                request.user = await request.auser()
+                denied = await sync_to_async(check)(request, mess_id)
+                if denied is not None:
+                    return denied
+                with mess_shard(request.mess):
+                    return await view(request, mess_id, *args, **kwargs)
+            return wrapped
+
+        @wraps(view)
+        def wrapped(request, mess_id, *args, **kwargs):
+            denied = check(request, mess_id)
+            if denied is not None:
+                return denied
+            with mess_shard(request.mess):
+                return view(request, mess_id, *args, **kwargs)
+        return wrapped
+    return decorator
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Mess, Membership, Meal, Expense, Deposit, Message
+from .models import CustomUser, Mess, Membership, Meal, Expense, Deposit, Message, MonthlyLedger, MonthSnapshot, ReportJob
 
 
 class CustomUserAdmin(UserAdmin):
@@ -41,10 +41,25 @@ class MessageAdmin(admin.ModelAdmin):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
     content_short.short_description = 'Content'
 
+class MonthlyLedgerAdmin(admin.ModelAdmin):
+    list_display = ['mess', 'user', 'year', 'month', 'meals', 'deposit', 'expense']
+    list_filter = ['mess', 'year', 'month']
+
+class MonthSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['mess', 'user', 'year', 'month', 'meals', 'meal_rate', 'cost', 'deposit', 'carried_forward', 'balance']
+    list_filter = ['mess', 'year', 'month']
+
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ['mess', 'year', 'month', 'status', 'requested_by', 'created_at', 'finished_at']
+    list_filter = ['status', 'mess']
+
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Mess)
 admin.site.register(Membership)
 admin.site.register(Meal, MealAdmin)
 admin.site.register(Expense, ExpenseAdmin)
 admin.site.register(Deposit, DepositAdmin)
-admin.site.register(Message, MessageAdmin)
\ No newline at end of file
+admin.site.register(Message, MessageAdmin)
+admin.site.register(MonthlyLedger, MonthlyLedgerAdmin)
+admin.site.register(MonthSnapshot, MonthSnapshotAdmin)
+admin.site.register(ReportJob, ReportJobAdmin)
\ No newline at end of file
@@ -0,0 +1,214 @@
+import random
+import string
+import time
+from contextlib import ExitStack
+from datetime import date, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from .models import CustomUser, Mess, Membership, Meal, Expense, Deposit, Message, Notification
+from .ledger import rebuild_ledger
+from .notifications import adjust_unread_counts
+from .instrumentation import percentiles
+from .settlement import meal_total_expression, month_bounds
+
+# Indexes added for the hot filter paths, see migration 0010
+HOT_PATH_INDEXES = [
+    'meal_mess_date_idx',
+    'meal_mess_user_date_idx',
+    'meal_mess_year_month_idx',
+    'expense_mess_date_idx',
+    'expense_mess_year_month_idx',
+    'deposit_mess_date_idx',
+    'deposit_mess_user_date_idx',
+    'deposit_mess_year_month_idx',
+    'ledger_mess_year_month_idx',
+    'notif_user_created_idx',
+    'notif_user_unread_idx',
+]
+
+
+def _unique_code(used):
+    while True:
+        code = ''.join(random.choices(string.digits, k=6))
+        if code not in used:
+            used.add(code)
+            return code
+
+
+def seed_dataset(messes=1, members=20, days=60, notifications=50, messages=100, batch_size=1000):
+    """
+    Bulk-insert synthetic messes with members, meals, expenses, deposits,
+    messages and notifications covering the last `days` days.
+    Returns the ids of the created messes.
+    """
+    token = ''.join(random.choices(string.ascii_lowercase, k=6))
+    password = make_password('benchmark')
+    used_codes = set(Mess.objects.values_list('code', flat=True))
+    today = date.today()
+    dates = [today - timedelta(days=offset) for offset in range(days)]
+
+    Mess.objects.bulk_create([
+        Mess(name=f'Bench mess {token}-{i}', address='Benchmark street', code=_unique_code(used_codes))
+        for i in range(messes)
+    ])
+    created_messes = list(Mess.objects.filter(name__startswith=f'Bench mess {token}-').order_by('id'))
+
+    CustomUser.objects.bulk_create([
+        CustomUser(username=f'bench-{token}-{mess_index}-{i}', password=password)
+        for mess_index in range(messes)
+        for i in range(members)
+    ], batch_size=batch_size)
+    users = {
+        user.username: user
+        for user in CustomUser.objects.filter(username__startswith=f'bench-{token}-')
+    }
+
+    memberships = []
+    mess_users = {}
+    for mess_index, mess in enumerate(created_messes):
+        mess_users[mess.id] = [users[f'bench-{token}-{mess_index}-{i}'] for i in range(members)]
+        for i, user in enumerate(mess_users[mess.id]):
+            memberships.append(Membership(user=user, mess=mess, role='manager' if i == 0 else 'member'))
+    Membership.objects.bulk_create(memberships, batch_size=batch_size)
+
+    def dated(model, day, **fields):
+        return model(date=day, month=day.month, year=day.year, **fields)
+
+    for mess in created_messes:
+        mess_members = mess_users[mess.id]
+        manager = mess_members[0]
+
+        Meal.objects.bulk_create((
+            dated(Meal, day, user=user, mess=mess, breakfast=random.randint(0, 1),
+                  lunch=random.randint(0, 2), dinner=random.randint(0, 2))
+            for day in dates
+            for user in mess_members
+        ), batch_size=batch_size)
+        Expense.objects.bulk_create((
+            dated(Expense, day, mess=mess, created_by=manager,
+                  amount=Decimal(random.randint(200, 3000)), description='Bazar')
+            for day in dates
+        ), batch_size=batch_size)
+        Deposit.objects.bulk_create((
+            dated(Deposit, day, user=user, mess=mess, amount=Decimal(random.randint(100, 2000)))
+            for day in dates[::7]
+            for user in mess_members
+        ), batch_size=batch_size)
+        Message.objects.bulk_create((
+            Message(mess=mess, user=random.choice(mess_members), content=f'Benchmark message {i}')
+            for i in range(messages)
+        ), batch_size=batch_size)
+        Notification.objects.bulk_create((
+            Notification(user=user, mess=mess, title='Benchmark', message=f'Notification {i}',
+                         is_read=i % 3 != 0)
+            for user in mess_members
+            for i in range(notifications)
+        ), batch_size=batch_size)
+        unread_per_member = len([i for i in range(notifications) if i % 3 == 0])
+        adjust_unread_counts({user.id: unread_per_member for user in mess_members})
+
+    mess_ids = [mess.id for mess in created_messes]
+    rebuild_ledger(mess_ids)
+    return mess_ids
+
+
+def analyze():
+    """Refresh the planner statistics"""
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def hot_queries(mess, user, year, month):
+    """The filter paths used by the dashboards, reports and notification pages"""
+    first_day, last_day = month_bounds(year, month)
+    in_month = {'mess': mess, 'date__range': [first_day, last_day]}
+    return [
+        ('Meals per member for a month', Meal.objects.filter(**in_month).values('user').order_by()
+            .annotate(total=models.Sum(meal_total_expression()))),
+        ('Member meals for a month', Meal.objects.filter(user=user, **in_month)),
+        ('Meals by year/month columns', Meal.objects.filter(mess=mess, year=year, month=month)),
+        ('Expenses for a month', Expense.objects.filter(**in_month)),
+        ('Expenses by year/month columns', Expense.objects.filter(mess=mess, year=year, month=month)),
+        ('Deposits per member for a month', Deposit.objects.filter(**in_month).values('user').order_by()
+            .annotate(total=models.Sum('amount'))),
+        ('Member deposits for a month', Deposit.objects.filter(user=user, **in_month)),
+        ('Ledger rows for a month', mess.monthlyledger_set.filter(year=year, month=month)),
+        ('Unread notifications', Notification.objects.filter(user=user, is_read=False).order_by('-created_at')),
+        ('Latest notifications', Notification.objects.filter(user=user).order_by('-created_at')[:20]),
+    ]
+
+
+def drop_indexes(names):
+    """Drop indexes by name. Only meant to run inside a transaction that is rolled back."""
+    existing = set()
+    with connection.cursor() as cursor:
+        for table in connection.introspection.table_names(cursor):
+            existing.update(connection.introspection.get_constraints(cursor, table))
+        for name in names:
+            if name in existing:
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+
+
+# (URL name, takes the mess id, who requests it)
+BENCHMARK_VIEWS = [
+    ('mess_dashboard', True, 'manager'),
+    ('member_dashboard', True, 'member'),
+    ('view_reports', True, 'manager'),
+    ('download_report_pdf', True, 'manager'),
+    ('manager_messages', True, 'manager'),
+    ('notifications', False, 'member'),
+    ('get_unread_count', False, 'member'),
+]
+
+
+def run_benchmark(mess, iterations=20, views=None):
+    """
+    Request each benchmark view `iterations` times with the test client as
+    the mess manager or a member. Returns latency and query count
+    percentiles per view, counting the queries of the default database and
+    the mess's shard.
+    """
+    memberships = list(mess.membership_set.select_related('user').order_by('id'))
+    manager = next(m.user for m in memberships if m.role == 'manager')
+    member = next((m.user for m in memberships if m.role == 'member'), manager)
+
+    clients = {}
+    for role, user in (('manager', manager), ('member', member)):
+        clients[role] = Client()
+        clients[role].force_login(user)
+
+    results = {}
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for name, takes_mess, role in BENCHMARK_VIEWS:
+            if views and name not in views:
+                continue
+            url = reverse(name, args=[mess.id] if takes_mess else [])
+            timings = []
+            query_counts = []
+            statuses = set()
+            for _ in range(iterations):
+                # Timed from before CaptureQueriesContext, which opens the
+                # connection, so connection setup counts towards the latency
+                start = time.perf_counter()
+                with ExitStack() as stack:
+                    captured = [
+                        stack.enter_context(CaptureQueriesContext(connections[alias]))
+                        for alias in dict.fromkeys([DEFAULT_DB_ALIAS, mess.shard])
+                    ]
+                    response = clients[role].get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+                query_counts.append(sum(len(queries) for queries in captured))
+                statuses.add(response.status_code)
+
+            results[name] = {
+                'url': url,
+                'status': sorted(statuses),
+                'wall_ms': percentiles(timings),
+                'queries': percentiles(query_counts),
+            }
+    return results
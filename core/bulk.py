@@ -0,0 +1,65 @@
+from .models import Meal
+from .closing import check_months_open
+from .ledger import record_meal_changes
+from .report_cache import invalidate_month
+from .shards import check_not_moving, mess_atomic
+
+MEAL_FIELDS = ('breakfast', 'lunch', 'dinner')
+
+
+def upsert_meals(mess, entries, batch_size=500):
+    """
+    Insert or update many meals of a mess in one transaction with
+    bulk_create(update_conflicts=True) and keep the monthly ledger in step.
+
+    entries is an iterable of (user_id, date, breakfast, lunch, dinner); a
+    later entry for the same user and date wins. New all-zero entries and
+    entries that don't change anything are skipped. Returns the written
+    meals as a list of (meal, created). Raises MonthClosedError when a date
+    falls in a closed month and MessMovingError while the mess is moved to
+    another shard.
+    """
+    wanted = {(user_id, day): counts for user_id, day, *counts in entries}
+    if not wanted:
+        return []
+
+    with mess_atomic():
+        check_not_moving(mess.id)
+        check_months_open(mess.id, {(day.year, day.month) for user_id, day in wanted})
+        existing = {
+            (meal.user_id, meal.date): meal
+            for meal in Meal.objects.select_for_update().filter(
+                mess=mess,
+                user_id__in={user_id for user_id, day in wanted},
+                date__in={day for user_id, day in wanted},
+            )
+        }
+
+        written = []
+        previous = []
+        for (user_id, day), (breakfast, lunch, dinner) in wanted.items():
+            current = existing.get((user_id, day))
+            if current is None and not (breakfast or lunch or dinner):
+                continue
+            if current is not None and (current.breakfast, current.lunch, current.dinner) == (breakfast, lunch, dinner):
+                continue
+
+            meal = Meal(user_id=user_id, mess=mess, date=day, month=day.month, year=day.year,
+                        breakfast=breakfast, lunch=lunch, dinner=dinner)
+            written.append((meal, current is None))
+            if current is not None:
+                previous.append(current.ledger_values())
+
+        meals = [meal for meal, created in written]
+        Meal.objects.bulk_create(
+            meals,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=['user', 'mess', 'date'],
+            update_fields=[*MEAL_FIELDS, 'month', 'year'],
+        )
+        record_meal_changes(mess.id, previous, [meal.ledger_values() for meal in meals])
+        for year, month in {(day.year, day.month) for user_id, day in wanted}:
+            invalidate_month(mess.id, year, month)
+
+    return written
@@ -0,0 +1,48 @@
+from django.db import models
+from .models import Membership, Message
+
+MESSAGE_PAGE_SIZE = 50
+
+
+def message_page(mess, before=None, after=None, page_size=MESSAGE_PAGE_SIZE):
+    """
+    Up to page_size chat messages of a mess, newest first, using keyset
+    pagination on (created_at, id). `before` returns the messages older
+    than that message id. `after` returns the ones newer than it, taking
+    those closest to it so a client catching up never skips any. Returns
+    the messages and whether more are left in that direction.
+    """
+    messages = Message.objects.filter(mess=mess).select_related('user')
+    if after is not None:
+        anchor = Message.objects.filter(mess=mess, id=after).values('created_at')[:1]
+        messages = messages.filter(
+            models.Q(created_at__gt=models.Subquery(anchor))
+            | models.Q(created_at=models.Subquery(anchor), id__gt=after)
+        ).order_by('created_at', 'id')
+    else:
+        messages = messages.order_by('-created_at', '-id')
+        if before is not None:
+            anchor = Message.objects.filter(mess=mess, id=before).values('created_at')[:1]
+            messages = messages.filter(
+                models.Q(created_at__lt=models.Subquery(anchor))
+                | models.Q(created_at=models.Subquery(anchor), id__lt=before)
+            )
+
+    page = list(messages[:page_size + 1])
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    if after is not None:
+        page.reverse()
+    return page, has_more
+
+
+def latest_message(mess_id):
+    """(id, created_at) of the newest message of a mess, or None"""
+    return Message.objects.filter(mess_id=mess_id).order_by('-created_at', '-id').values_list(
+        'id', 'created_at'
+    ).first()
+
+
+def manager_ids(mess):
+    """Ids of the mess's managers, for the Manager badge next to their messages"""
+    return set(Membership.objects.filter(mess=mess, role='manager').values_list('user_id', flat=True))
@@ -0,0 +1,283 @@
+from datetime import date
+from decimal import Decimal
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from .models import Membership, Mess, MonthlyLedger, MonthSnapshot
+from .report_cache import cached_range_settlement
+from .settlement import month_range_filter, months_between, next_month, previous_month, range_settlement
+from .shards import MessMovingError, mess_atomic, mess_shard
+
+CENT = Decimal('0.01')
+
+
+class MonthClosedError(ValueError):
+    """Raised when a meal, expense or deposit of a closed month is changed"""
+
+
+def last_closed_month(mess_id):
+    """(year, month) of the latest closed month of a mess, or None"""
+    return MonthSnapshot.objects.filter(mess_id=mess_id, user__isnull=True).order_by(
+        '-year', '-month'
+    ).values_list('year', 'month').first()
+
+
+def check_months_open(mess_id, months):
+    """
+    Raise MonthClosedError if any of the (year, month) pairs is closed.
+    Inside a transaction the mess row is locked first, as close_month does,
+    so no month can be closed between the check and the write.
+    """
+    if not months:
+        return
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        Mess.objects.select_for_update().filter(id=mess_id).first()
+    last = last_closed_month(mess_id)
+    if last is None:
+        return
+    for year, month in sorted(months):
+        if (year, month) <= tuple(last):
+            raise MonthClosedError(
+                f'{date(year, month, 1):%B %Y} is closed, its meals, expenses and deposits can no longer be changed.'
+            )
+
+
+def check_instance_open(instance):
+    """Refuse to save or delete a Meal, Expense or Deposit that belongs, or belonged, to a closed month"""
+    months = {(instance.date.year, instance.date.month)}
+    previous = getattr(instance, '_ledger_snapshot', None) or getattr(instance, '_ledger_stored', None)
+    if previous:
+        months.add((previous['date'].year, previous['date'].month))
+    elif instance.pk and not instance._state.adding:
+        stored = type(instance).objects.filter(pk=instance.pk).values_list('date', flat=True).first()
+        if stored:
+            months.add((stored.year, stored.month))
+    check_months_open(instance.mess_id, months)
+
+
+def _first_ledger_month(mess_id):
+    return MonthlyLedger.objects.filter(mess_id=mess_id).order_by('year', 'month').values_list('year', 'month').first()
+
+
+def closing_balances(mess_id, year, month):
+    """Member balances (user id to amount) frozen when the given month was closed"""
+    return dict(
+        MonthSnapshot.objects.filter(mess_id=mess_id, year=year, month=month, user__isnull=False)
+        .values_list('user_id', 'balance')
+    )
+
+
+def opening_balances(mess, year, month):
+    """
+    Member balances carried into the given month. Starts from the last
+    month closed before it and only settles the open months in between.
+    """
+    closed = MonthSnapshot.objects.filter(mess=mess, user__isnull=True).filter(
+        models.Q(year__lt=year) | models.Q(year=year, month__lt=month)
+    ).order_by('-year', '-month').values_list('year', 'month').first()
+
+    if closed:
+        balances = closing_balances(mess.id, *closed)
+        start = next_month(*closed)
+    else:
+        balances = {}
+        start = _first_ledger_month(mess.id)
+        if start is None:
+            return balances
+
+    end = previous_month(year, month)
+    if tuple(start) > end:
+        return balances
+    settlement = cached_range_settlement(mess, months_between(*start, *end))
+    return {
+        report['user'].id: balances.get(report['user'].id, 0) + report['balance']
+        for report in settlement['member_reports']
+    }
+
+
+def with_balances(settlement, opening):
+    """Copy of an open month's settlement with carried-forward and closing balances added"""
+    return {
+        **settlement,
+        'member_reports': [
+            {
+                **report,
+                'carried_forward': opening.get(report['user'].id, 0),
+                'closing_balance': opening.get(report['user'].id, 0) + report['balance'],
+            }
+            for report in settlement['member_reports']
+        ],
+        'closed': False,
+    }
+
+
+def close_month(mess, year, month, user=None):
+    """
+    Close every open month of the mess up to and including the given one
+    and freeze their settlement in MonthSnapshot rows. Each month's
+    balances are carried forward from the previous closed month.
+    Returns the closed (year, month) pairs.
+    """
+    today = date.today()
+    if (year, month) > (today.year, today.month):
+        raise ValueError('Future months cannot be closed.')
+
+    with mess_shard(mess), mess_atomic():
+        # Serialises concurrent closes of the same mess
+        if Mess.objects.select_for_update().filter(id=mess.id).values_list('shard_locked', flat=True).first():
+            raise MessMovingError(f'{mess.name} is being moved to another database, please try again in a minute.')
+
+        last = last_closed_month(mess.id)
+        if last:
+            start = next_month(*last)
+            opening = closing_balances(mess.id, *last)
+        else:
+            start = _first_ledger_month(mess.id) or (year, month)
+            start = min(tuple(start), (year, month))
+            opening = {}
+
+        months = months_between(*start, year, month)
+        if not months:
+            raise ValueError(f'{date(year, month, 1):%B %Y} is already closed.')
+
+        settlement = range_settlement(mess, months, opening=opening)
+        snapshots = []
+        for index, (entry, (snapshot_year, snapshot_month)) in enumerate(zip(settlement['trend'], months)):
+            carried_total = Decimal('0')
+            balance_total = Decimal('0')
+            for report in settlement['member_reports']:
+                figures = report['monthly'][index]
+                carried = report['monthly'][index - 1]['balance'] if index else report['carried_forward']
+                carried = Decimal(carried).quantize(CENT)
+                balance = Decimal(figures['balance']).quantize(CENT)
+                carried_total += carried
+                balance_total += balance
+                snapshots.append(MonthSnapshot(
+                    mess=mess, user=report['user'], year=snapshot_year, month=snapshot_month,
+                    meals=figures['meals'], meal_rate=entry['meal_rate'].quantize(Decimal('0.0001')),
+                    cost=Decimal(figures['cost']).quantize(CENT), deposit=figures['deposit'],
+                    carried_forward=carried, balance=balance, closed_by=user,
+                ))
+            snapshots.append(MonthSnapshot(
+                mess=mess, user=None, year=snapshot_year, month=snapshot_month,
+                meals=entry['total_meals'], meal_rate=entry['meal_rate'].quantize(Decimal('0.0001')),
+                cost=entry['total_expense'], deposit=entry['total_deposit'],
+                carried_forward=carried_total, balance=balance_total, closed_by=user,
+            ))
+        MonthSnapshot.objects.bulk_create(snapshots, batch_size=500)
+    return months
+
+
+def snapshot_settlement(mess, year, month):
+    """
+    Settlement of a closed month read from its snapshots, in the shape of
+    monthly_settlement with the carried-forward and closing balances
+    added. Returns None if the month is not closed.
+    """
+    snapshots = list(MonthSnapshot.objects.filter(mess=mess, year=year, month=month).select_related('user'))
+    mess_row = next((row for row in snapshots if row.user_id is None), None)
+    if mess_row is None:
+        return None
+
+    roles = dict(mess.membership_set.values_list('user_id', 'role'))
+    return {
+        'grand_total_meals': mess_row.meals,
+        'total_expense': mess_row.cost,
+        'total_deposit': mess_row.deposit,
+        'meal_rate': mess_row.meal_rate,
+        'member_reports': [
+            {
+                'user': row.user,
+                'total_meal': row.meals,
+                'total_cost': row.cost,
+                'total_deposit': row.deposit,
+                'balance': row.deposit - row.cost,
+                'carried_forward': row.carried_forward,
+                'closing_balance': row.balance,
+                'role': roles.get(row.user_id),
+            }
+            for row in snapshots if row.user_id is not None
+        ],
+        'closed': True,
+    }
+
+
+def carried_range_settlement(mess, months):
+    """
+    range_settlement of a continuous range of months as the monthly reports
+    show them: member balances are carried in from before the range and
+    closed months are read from their snapshots, the open ones from the
+    cached range settlement.
+    """
+    last = last_closed_month(mess.id)
+    closed = [month for month in months if last and month <= tuple(last)]
+    open_months = months[len(closed):]
+
+    members = {
+        member.user_id: {'user': member.user, 'role': member.role, 'monthly': {}}
+        for member in Membership.objects.filter(mess=mess).select_related('user')
+    }
+    trend = []
+    if closed:
+        for row in MonthSnapshot.objects.filter(month_range_filter(closed), mess=mess).select_related('user').order_by(
+            'year', 'month'
+        ):
+            if row.user_id is None:
+                trend.append({
+                    'year': row.year,
+                    'month': row.month,
+                    'label': date(row.year, row.month, 1).strftime('%b %Y'),
+                    'total_meals': row.meals,
+                    'total_expense': row.cost,
+                    'total_deposit': row.deposit,
+                    'meal_rate': row.meal_rate,
+                })
+                continue
+            # Members who left since keep their rows in closed months
+            member = members.setdefault(row.user_id, {'user': row.user, 'role': None, 'monthly': {}})
+            member['monthly'][(row.year, row.month)] = {
+                'meals': row.meals, 'cost': row.cost, 'deposit': row.deposit, 'balance': row.balance,
+            }
+    if open_months:
+        settlement = cached_range_settlement(mess, open_months)
+        trend += settlement['trend']
+        for report in settlement['member_reports']:
+            monthly = members[report['user'].id]['monthly']
+            for (year, month), entry in zip(open_months, report['monthly']):
+                monthly[(year, month)] = {'meals': entry['meals'], 'cost': entry['cost'], 'deposit': entry['deposit']}
+
+    opening = opening_balances(mess, *months[0])
+    member_reports = []
+    for user_id, member in members.items():
+        balance = Decimal(opening.get(user_id, 0))
+        report = {
+            'user': member['user'],
+            'total_meal': 0,
+            'total_cost': Decimal('0'),
+            'total_deposit': Decimal('0'),
+            'carried_forward': balance,
+            'role': member['role'],
+            'running_balance': [],
+            'monthly': [],
+        }
+        for month in months:
+            figures = member['monthly'].get(month, {'meals': 0, 'cost': Decimal('0'), 'deposit': Decimal('0')})
+            # A closed month's snapshot holds the balance it was closed with
+            balance = figures.get('balance', balance + figures['deposit'] - figures['cost'])
+            report['total_meal'] += figures['meals']
+            report['total_cost'] += figures['cost']
+            report['total_deposit'] += figures['deposit']
+            report['running_balance'].append(balance)
+            report['monthly'].append({**figures, 'balance': balance})
+        report['balance'] = balance
+        member_reports.append(report)
+
+    grand_total_meals = sum(entry['total_meals'] for entry in trend)
+    total_expense = sum((entry['total_expense'] for entry in trend), Decimal('0'))
+    return {
+        'grand_total_meals': grand_total_meals,
+        'total_expense': total_expense,
+        'total_deposit': sum((entry['total_deposit'] for entry in trend), Decimal('0')),
+        'meal_rate': total_expense / grand_total_meals if grand_total_meals > 0 else 0,
+        'member_reports': member_reports,
+        'trend': trend,
+    }
+
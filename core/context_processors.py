@@ -1,10 +1,13 @@
-from .models import Notification
+from . import realtime
 
 def notification_count(request):
     if request.user.is_authenticated:
         try:
-            unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
+            unread_count = request.user.unread_notifications
             return {'unread_notification_count': unread_count}
         except:
             return {'unread_notification_count': 0}
-    return {'unread_notification_count': 0}
\ No newline at end of file
+    return {'unread_notification_count': 0}
+
+def realtime_events(request):
+    return {'realtime_events': realtime.streams_enabled(request)}
\ No newline at end of file
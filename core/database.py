@@ -0,0 +1,63 @@
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from .shards import current_alias, in_atomic_block, mess_atomic
+
+logger = logging.getLogger('core.database')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+LOCK_ERRORS = ('database is locked', 'database table is locked')
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(message in str(error) for message in LOCK_ERRORS)
+
+
+# SQLite has a single writer per database file. Threads of one process
+# queue here for it instead of polling the file lock, where a thread that
+# just committed keeps winning and the others can wait out the whole busy
+# timeout. Locks are taken directory first, then the mess shard.
+_sqlite_writers = {}
+_sqlite_writers_lock = threading.Lock()
+
+
+@contextmanager
+def _writer_turn():
+    with ExitStack() as stack:
+        for alias in dict.fromkeys([DEFAULT_DB_ALIAS, current_alias()]):
+            if connections[alias].vendor != 'sqlite':
+                continue
+            with _sqlite_writers_lock:
+                lock = _sqlite_writers.setdefault(alias, threading.Lock())
+            stack.enter_context(lock)
+        yield
+
+
+def run_with_retry(func, *args, attempts=None, base_delay=None, **kwargs):
+    """
+    Call func in a transaction and run it again with exponential backoff
+    and jitter when SQLite reports a lock. Inside an outer transaction the
+    call is made once, a retry could not undo the outer work.
+
+    Views wrap only their database writes: func may run several times, so
+    it must not flash messages or otherwise act outside the database.
+    """
+    attempts = attempts or getattr(settings, 'DB_LOCK_RETRIES', 5)
+    base_delay = base_delay or getattr(settings, 'DB_LOCK_RETRY_DELAY', 0.05)
+    if in_atomic_block():
+        return func(*args, **kwargs)
+
+    for attempt in range(1, attempts + 1):
+        try:
+            with _writer_turn(), mess_atomic():
+                return func(*args, **kwargs)
+        except OperationalError as e:
+            if not is_lock_error(e) or attempt == attempts:
+                raise
+            delay = base_delay * 2 ** (attempt - 1) * (0.5 + random.random())
+            logger.warning('Database locked, retry %d of %d in %.0f ms', attempt, attempts - 1, delay * 1000)
+            time.sleep(delay)
@@ -0,0 +1,176 @@
+import csv
+import zipfile
+from datetime import date
+from decimal import Decimal
+from xml.sax.saxutils import escape
+from .models import Meal, Expense, Deposit
+from .report_cache import cached_settlement
+from .settlement import month_bounds
+from .shards import shard_bound
+
+EXPORT_DATASETS = ('meals', 'expenses', 'deposits', 'settlement')
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_CHUNK_SIZE = 2000
+
+
+def export_rows(mess, dataset, months):
+    """
+    Header and a lazy iterator of rows for one dataset. Transactions are
+    read with chunked server-side iteration, so memory use does not grow
+    with the number of rows. The rows are read from the shard current when
+    this is called.
+    """
+    first_day = month_bounds(*months[0])[0]
+    last_day = month_bounds(*months[-1])[1]
+    in_range = {'mess': mess, 'date__range': [first_day, last_day]}
+
+    if dataset == 'meals':
+        header = ['Date', 'Member', 'Breakfast', 'Lunch', 'Dinner', 'Total']
+        rows = (
+            (day, username, breakfast, lunch, dinner, breakfast + lunch + dinner)
+            for day, username, breakfast, lunch, dinner in
+            Meal.objects.filter(**in_range).order_by('date', 'user_id', 'id')
+            .values_list('date', 'user__username', 'breakfast', 'lunch', 'dinner')
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+    elif dataset == 'expenses':
+        header = ['Date', 'Description', 'Amount', 'Added By']
+        rows = (
+            Expense.objects.filter(**in_range).order_by('date', 'id')
+            .values_list('date', 'description', 'amount', 'created_by__username')
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+    elif dataset == 'deposits':
+        header = ['Date', 'Member', 'Amount']
+        rows = (
+            Deposit.objects.filter(**in_range).order_by('date', 'id')
+            .values_list('date', 'user__username', 'amount')
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+    elif dataset == 'settlement':
+        header = ['Year', 'Month', 'Member', 'Role', 'Meals', 'Meal Rate', 'Cost', 'Deposit', 'Balance']
+        rows = _settlement_rows(mess, months)
+    else:
+        raise ValueError(f'Unknown dataset {dataset}')
+    return header, shard_bound(rows)
+
+
+def _settlement_rows(mess, months):
+    # One month's settlement in memory at a time
+    for year, month in months:
+        settlement = cached_settlement(mess, year, month)
+        for report in settlement['member_reports']:
+            yield (
+                year, month, report['user'].username, report['role'], report['total_meal'],
+                round(Decimal(settlement['meal_rate']), 4), round(Decimal(report['total_cost']), 2),
+                report['total_deposit'], round(Decimal(report['balance']), 2),
+            )
+
+
+class _Echo:
+    """File-like object handing back what csv.writer writes"""
+
+    def write(self, value):
+        return value
+
+
+def csv_stream(header, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+class _ChunkBuffer:
+    """Unseekable sink for zipfile, drained after every row"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_cell(value):
+    if value is None:
+        value = ''
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return f'<c t="n"><v>{value}</v></c>'
+    if isinstance(value, date):
+        value = value.isoformat()
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>'
+
+
+def _xlsx_row(row):
+    return '<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>'
+
+
+def xlsx_stream(header, rows, sheet_name='Export'):
+    """
+    Stream a single-sheet XLSX workbook. The zip is written without
+    seeking, so each row is compressed and handed on as soon as it is read.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in _XLSX_PARTS.items():
+            workbook.writestr(name, content)
+        workbook.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        yield buffer.drain()
+
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_row(header)
+            ).encode())
+            for row in rows:
+                sheet.write(_xlsx_row(row).encode())
+                chunk = buffer.drain()
+                if chunk:
+                    yield chunk
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.drain()
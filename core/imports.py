@@ -0,0 +1,170 @@
+import csv
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from .bulk import MEAL_FIELDS, upsert_meals
+from .closing import MonthClosedError, check_months_open
+from .ledger import record_created
+from .models import Deposit, Expense, Membership
+from .notifications import queue_notification
+from .report_cache import invalidate_month
+from .shards import MessMovingError, check_not_moving, copy_users, mess_atomic, mess_shard
+
+IMPORT_COLUMNS = ('type', 'date', 'member', 'breakfast', 'lunch', 'dinner', 'amount', 'description')
+IMPORT_TYPES = ('meal', 'expense', 'deposit')
+IMPORT_CHUNK_SIZE = 2000
+MAX_IMPORT_ERRORS = 20
+
+
+class LedgerImportError(ValueError):
+    """Raised with the offending lines when an import is rejected; nothing is written"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(f'line {line}: {error}' for line, error in errors))
+
+
+def _count(row, field):
+    value = int(row.get(field) or 0)
+    if value < 0:
+        raise ValueError(f'{field} cannot be negative')
+    return value
+
+
+def _amount(row, model):
+    """The row's amount, rounded to cents and checked against the model's amount column"""
+    field = model._meta.get_field('amount')
+    try:
+        value = Decimal(row.get('amount') or '')
+        if not value.is_finite():
+            raise InvalidOperation
+        value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+    except InvalidOperation:
+        raise ValueError(f'invalid amount {row.get("amount")!r}')
+    if abs(value) >= Decimal(10) ** (field.max_digits - field.decimal_places):
+        raise ValueError(f'amount {row.get("amount")!r} is too large')
+    return value
+
+
+class _Chunk:
+    def __init__(self):
+        self.meals = []
+        self.expenses = []
+        self.deposits = []
+
+    def __len__(self):
+        return len(self.meals) + len(self.expenses) + len(self.deposits)
+
+
+def import_ledger(mess, lines, user, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Import meals, expenses and deposits of a mess from CSV text lines with
+    the IMPORT_COLUMNS header. Members are given by username or id and
+    checked against the mess's memberships, loaded once. Rows are parsed
+    as they stream in and written chunk_size at a time with bulk_create,
+    meals as upserts on (user, mess, date). Expenses are recorded as added
+    by user. Members get one summary notification instead of one per row.
+
+    The import runs in one transaction: any invalid row raises
+    LedgerImportError listing up to MAX_IMPORT_ERRORS bad lines and
+    nothing is written. Returns the number of meals, expenses and deposits
+    written.
+    """
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None:
+        raise LedgerImportError([(1, 'the file is empty')])
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    missing = {'type', 'date', 'member'} - set(reader.fieldnames)
+    if missing:
+        raise LedgerImportError([(1, f'missing columns: {", ".join(sorted(missing))}')])
+
+    members = {}
+    for user_id, username in Membership.objects.filter(mess=mess).values_list('user_id', 'user__username'):
+        members[username.lower()] = user_id
+        members[str(user_id)] = user_id
+
+    counts = {'meals': 0, 'expenses': 0, 'deposits': 0}
+    errors = []
+    chunk = _Chunk()
+    # The importing user need not be a member, the mess's shard needs their row
+    copy_users(mess.shard, [user])
+
+    with mess_shard(mess), mess_atomic():
+        try:
+            for row in reader:
+                try:
+                    _add_row(chunk, row, mess, members, user)
+                except ValueError as e:
+                    errors.append((reader.line_num, str(e)))
+                    if len(errors) >= MAX_IMPORT_ERRORS:
+                        break
+                    continue
+
+                if len(chunk) >= chunk_size:
+                    if not errors:
+                        errors += _write_chunk(mess, chunk, counts, reader.line_num)
+                    chunk = _Chunk()
+        except csv.Error as e:
+            errors.append((reader.line_num, f'malformed CSV: {e}'))
+
+        if not errors:
+            errors += _write_chunk(mess, chunk, counts, reader.line_num)
+        if errors:
+            raise LedgerImportError(errors)
+
+        if any(counts.values()):
+            queue_notification(
+                title='Ledger Imported',
+                message=(f'{user.username} imported {counts["meals"]} meal entries, '
+                         f'{counts["expenses"]} expenses and {counts["deposits"]} deposits.'),
+                notification_type='info',
+                mess=mess
+            )
+    return counts
+
+
+def _add_row(chunk, row, mess, members, user):
+    kind = (row.get('type') or '').strip().lower()
+    if kind not in IMPORT_TYPES:
+        raise ValueError(f'type must be one of {", ".join(IMPORT_TYPES)}')
+    day = date.fromisoformat((row.get('date') or '').strip())
+
+    if kind == 'expense':
+        description = (row.get('description') or '').strip()
+        if not description:
+            raise ValueError('an expense needs a description')
+        chunk.expenses.append(Expense(
+            mess=mess, amount=_amount(row, Expense), description=description, date=day,
+            month=day.month, year=day.year, created_by=user,
+        ))
+        return
+
+    member = (row.get('member') or '').strip().lower()
+    if member not in members:
+        raise ValueError(f'{row.get("member")!r} is not a member of this mess')
+    if kind == 'meal':
+        chunk.meals.append((members[member], day, *(_count(row, field) for field in MEAL_FIELDS)))
+    else:
+        chunk.deposits.append(Deposit(
+            user_id=members[member], mess=mess, amount=_amount(row, Deposit), date=day,
+            month=day.month, year=day.year,
+        ))
+
+
+def _write_chunk(mess, chunk, counts, line):
+    try:
+        check_not_moving(mess.id)
+        if chunk.meals:
+            counts['meals'] += len(upsert_meals(mess, chunk.meals))
+        for model, rows, key in ((Expense, chunk.expenses, 'expenses'), (Deposit, chunk.deposits, 'deposits')):
+            if not rows:
+                continue
+            months = {(row.date.year, row.date.month) for row in rows}
+            check_months_open(mess.id, months)
+            model.objects.bulk_create(rows, batch_size=500)
+            record_created(mess.id, rows)
+            for year, month in months:
+                invalidate_month(mess.id, year, month)
+            counts[key] += len(rows)
+    except (MonthClosedError, MessMovingError) as e:
+        return [(line, str(e))]
+    return []
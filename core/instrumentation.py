@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+
+# Metrics of the request being handled, set by RequestMetricsMiddleware
+current_metrics = ContextVar('current_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Database execute wrapper counting and timing every query"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_time += time.perf_counter() - start
+
+
+class ViewMetricsStore:
+    """
+    Rolling window of the latest samples per URL name, kept in process
+    memory. Each worker process keeps its own window.
+    """
+
+    def __init__(self, window=None):
+        self.window = window or getattr(settings, 'VIEW_METRICS_WINDOW', 500)
+        self.lock = threading.Lock()
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, name, wall_time, queries, sql_time, template_time):
+        with self.lock:
+            self.samples[name].append((wall_time, queries, sql_time, template_time))
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+
+        return {
+            name: {
+                'count': len(values),
+                'wall_ms': percentiles([value[0] * 1000 for value in values]),
+                'queries': percentiles([value[1] for value in values]),
+                'sql_ms': percentiles([value[2] * 1000 for value in values]),
+                'template_ms': percentiles([value[3] * 1000 for value in values]),
+            }
+            for name, values in sorted(samples.items())
+        }
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles of a list of numbers"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        index = max(0, min(len(ordered) - 1, -(-point * len(ordered) // 100) - 1))
+        result[f'p{point}'] = round(ordered[index], 2)
+    result['max'] = round(ordered[-1], 2)
+    return result
+
+
+view_metrics = ViewMetricsStore()
+
+
+class TimedTemplate:
+    """Wraps a backend template to add its render time to the current request"""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics = current_metrics.get()
+            if metrics is not None:
+                metrics.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django template backend that reports render time to RequestMetricsMiddleware"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
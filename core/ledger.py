@@ -0,0 +1,243 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db import IntegrityError, models
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+from .models import MonthlyLedger, Meal, Expense, Deposit
+from .report_cache import invalidate_month
+from .settlement import meal_total_expression
+from .shards import mess_atomic
+
+LEDGER_FIELDS = ('meals', 'deposit', 'expense')
+
+
+def apply_delta(mess_id, user_id, year, month, create=True, **delta):
+    """Add the given amounts to one ledger row, creating the row if needed"""
+    delta = {field: value for field, value in delta.items() if value}
+    if not delta:
+        return
+
+    rows = MonthlyLedger.objects.filter(mess_id=mess_id, user_id=user_id, year=year, month=month)
+    changes = {field: models.F(field) + value for field, value in delta.items()}
+    changes['updated_at'] = timezone.now()
+
+    if rows.update(**changes) or not create:
+        return
+    try:
+        with mess_atomic():
+            MonthlyLedger.objects.create(mess_id=mess_id, user_id=user_id, year=year, month=month, **delta)
+    except IntegrityError:
+        # Another request created the row first
+        rows.update(**changes)
+
+
+def _bucket_deltas(previous, current):
+    deltas = defaultdict(dict)
+    for values, sign in ((previous, -1), (current, 1)):
+        if not values:
+            continue
+        key = (values['user_id'], values['date'].year, values['date'].month)
+        for field in LEDGER_FIELDS:
+            if field in values:
+                deltas[key][field] = deltas[key].get(field, 0) + sign * values[field]
+    return deltas
+
+
+def remember_stored(instance):
+    """
+    Before a Meal, Expense or Deposit without a snapshot of its loaded
+    values is saved, read what its row holds, so record_saved also
+    re-derives the bucket the row leaves
+    """
+    if instance.pk is None or getattr(instance, '_ledger_snapshot', None) is not None:
+        return
+    stored = type(instance).objects.filter(pk=instance.pk).first()
+    instance._ledger_stored = stored and stored.ledger_values()
+
+
+def record_saved(instance, created):
+    """Apply the change made by saving a Meal, Expense or Deposit"""
+    current = instance.ledger_values()
+    previous = getattr(instance, '_ledger_snapshot', None)
+
+    if not created and previous is None:
+        # We don't know what the row held before, so re-derive its buckets
+        buckets = {(current['user_id'], current['date'].year, current['date'].month)}
+        stored = instance.__dict__.pop('_ledger_stored', None)
+        if stored:
+            buckets.add((stored['user_id'], stored['date'].year, stored['date'].month))
+        for user_id, year, month in buckets:
+            rebuild_bucket(instance.mess_id, user_id, year, month)
+    else:
+        for (user_id, year, month), delta in _bucket_deltas(previous, current).items():
+            apply_delta(instance.mess_id, user_id, year, month, **delta)
+
+    instance._ledger_snapshot = current
+
+
+def record_deleted(instance):
+    """Remove a deleted Meal, Expense or Deposit from the ledger"""
+    previous = getattr(instance, '_ledger_snapshot', None) or instance.ledger_values()
+    for (user_id, year, month), delta in _bucket_deltas(previous, None).items():
+        apply_delta(instance.mess_id, user_id, year, month, create=False, **delta)
+
+
+def record_meal_changes(mess_id, previous_meals, meals):
+    """
+    Apply meal writes made without model signals, e.g. through bulk_create.
+    Both arguments are lists of Meal.ledger_values() before and after the
+    write. Members sharing the same delta are updated with one UPDATE.
+    """
+    deltas = defaultdict(int)
+    for values, sign in ((previous_meals, -1), (meals, 1)):
+        for value in values:
+            deltas[(value['user_id'], value['date'].year, value['date'].month)] += sign * value['meals']
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    existing = set(MonthlyLedger.objects.filter(
+        mess_id=mess_id,
+        user_id__in={user_id for user_id, year, month in deltas},
+        year__in={year for user_id, year, month in deltas},
+        month__in={month for user_id, year, month in deltas},
+    ).values_list('user_id', 'year', 'month'))
+
+    grouped = defaultdict(list)
+    for (user_id, year, month), delta in deltas.items():
+        if (user_id, year, month) in existing:
+            grouped[(year, month, delta)].append(user_id)
+    for (year, month, delta), user_ids in grouped.items():
+        MonthlyLedger.objects.filter(mess_id=mess_id, year=year, month=month, user_id__in=user_ids).update(
+            meals=models.F('meals') + delta, updated_at=timezone.now()
+        )
+
+    missing = [key for key in deltas if key not in existing]
+    try:
+        with mess_atomic():
+            MonthlyLedger.objects.bulk_create([
+                MonthlyLedger(mess_id=mess_id, user_id=user_id, year=year, month=month, meals=deltas[(user_id, year, month)])
+                for user_id, year, month in missing
+            ])
+    except IntegrityError:
+        # Some rows were created concurrently, fall back to one row at a time
+        for user_id, year, month in missing:
+            apply_delta(mess_id, user_id, year, month, meals=deltas[(user_id, year, month)])
+
+
+def record_created(mess_id, instances):
+    """
+    Apply Meals, Expenses or Deposits inserted with bulk_create, which
+    sends no signals. Amounts are summed per member and month first, so
+    each ledger row is touched once.
+    """
+    deltas = defaultdict(dict)
+    for instance in instances:
+        for key, delta in _bucket_deltas(None, instance.ledger_values()).items():
+            for field, value in delta.items():
+                deltas[key][field] = deltas[key].get(field, 0) + value
+    for (user_id, year, month), delta in deltas.items():
+        apply_delta(mess_id, user_id, year, month, **delta)
+
+
+def _by_month(queryset):
+    return queryset.annotate(
+        ledger_year=ExtractYear('date'),
+        ledger_month=ExtractMonth('date'),
+    ).order_by()
+
+
+def derive_ledger(mess_ids=None):
+    """
+    Compute ledger totals from the raw Meal, Expense and Deposit rows.
+
+    Returns a dict keyed by (mess_id, user_id, year, month).
+    """
+    filters = {}
+    if mess_ids is not None:
+        filters['mess_id__in'] = mess_ids
+
+    totals = defaultdict(lambda: {'meals': 0, 'deposit': Decimal('0'), 'expense': Decimal('0')})
+
+    meal_rows = _by_month(Meal.objects.filter(**filters)).values(
+        'mess', 'user', 'ledger_year', 'ledger_month'
+    ).annotate(total=models.Sum(meal_total_expression()))
+    for row in meal_rows:
+        totals[(row['mess'], row['user'], row['ledger_year'], row['ledger_month'])]['meals'] = row['total'] or 0
+
+    deposit_rows = _by_month(Deposit.objects.filter(**filters)).values(
+        'mess', 'user', 'ledger_year', 'ledger_month'
+    ).annotate(total=models.Sum('amount'))
+    for row in deposit_rows:
+        totals[(row['mess'], row['user'], row['ledger_year'], row['ledger_month'])]['deposit'] = row['total'] or 0
+
+    expense_rows = _by_month(Expense.objects.filter(**filters)).values(
+        'mess', 'ledger_year', 'ledger_month'
+    ).annotate(total=models.Sum('amount'))
+    for row in expense_rows:
+        totals[(row['mess'], None, row['ledger_year'], row['ledger_month'])]['expense'] = row['total'] or 0
+
+    return dict(totals)
+
+
+def _stored_ledger(queryset):
+    return {
+        (row.mess_id, row.user_id, row.year, row.month): {field: getattr(row, field) for field in LEDGER_FIELDS}
+        for row in queryset
+    }
+
+
+def find_drift(derived, stored):
+    """Return the keys whose stored totals differ from the derived ones"""
+    drift = []
+    for key in set(derived) | set(stored):
+        expected = derived.get(key)
+        actual = stored.get(key)
+        if expected is None:
+            if any(actual[field] for field in LEDGER_FIELDS):
+                drift.append((key, actual, None))
+        elif actual is None or any(expected[field] != actual[field] for field in LEDGER_FIELDS):
+            drift.append((key, actual, expected))
+    return sorted(drift, key=lambda item: tuple(-1 if part is None else part for part in item[0]))
+
+
+@mess_atomic()
+def rebuild_ledger(mess_ids=None, check_only=False):
+    """
+    Re-derive the ledger from scratch and return the rows that had drifted.
+    With check_only the stored ledger is left untouched.
+    """
+    stored_rows = MonthlyLedger.objects.all()
+    if mess_ids is not None:
+        stored_rows = stored_rows.filter(mess_id__in=mess_ids)
+
+    derived = derive_ledger(mess_ids)
+    drift = find_drift(derived, _stored_ledger(stored_rows))
+
+    if not check_only:
+        stored_rows.delete()
+        MonthlyLedger.objects.bulk_create([
+            MonthlyLedger(mess_id=mess_id, user_id=user_id, year=year, month=month, **values)
+            for (mess_id, user_id, year, month), values in derived.items()
+        ], batch_size=500)
+        for mess_id, user_id, year, month in {key for key, stored, expected in drift}:
+            invalidate_month(mess_id, year, month)
+    return drift
+
+
+def rebuild_bucket(mess_id, user_id, year, month):
+    """Re-derive a single ledger row from the raw transactions"""
+    filters = {'mess_id': mess_id, 'date__year': year, 'date__month': month}
+    if user_id is None:
+        values = {
+            'expense': Expense.objects.filter(**filters).aggregate(total=models.Sum('amount'))['total'] or 0,
+        }
+    else:
+        filters['user_id'] = user_id
+        values = {
+            'meals': Meal.objects.filter(**filters).aggregate(total=models.Sum(meal_total_expression()))['total'] or 0,
+            'deposit': Deposit.objects.filter(**filters).aggregate(total=models.Sum('amount'))['total'] or 0,
+        }
+    MonthlyLedger.objects.update_or_create(
+        mess_id=mess_id, user_id=user_id, year=year, month=month, defaults=values
+    )
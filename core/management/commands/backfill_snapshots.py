@@ -0,0 +1,43 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from core.closing import close_month, last_closed_month
+from core.models import Mess
+from core.settlement import previous_month
+from core.shards import mess_shard
+
+
+class Command(BaseCommand):
+    help = 'Close every open month up to a given month and store their snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--through', metavar='YYYY-MM',
+                            help='Last month to close, defaults to the previous month')
+        parser.add_argument('--mess', type=int, action='append', dest='mess_ids',
+                            help='Only close months of the given mess id (can be repeated)')
+
+    def handle(self, *args, **options):
+        if options['through']:
+            try:
+                year, month = (int(part) for part in options['through'].split('-'))
+                date(year, month, 1)
+            except ValueError:
+                raise CommandError('--through must be given as YYYY-MM.')
+        else:
+            today = date.today()
+            year, month = previous_month(today.year, today.month)
+
+        messes = Mess.objects.order_by('id')
+        if options['mess_ids']:
+            messes = messes.filter(id__in=options['mess_ids'])
+
+        total = 0
+        for mess in messes:
+            with mess_shard(mess):
+                last = last_closed_month(mess.id)
+            if last and tuple(last) >= (year, month):
+                continue
+            closed = close_month(mess, year, month)
+            total += len(closed)
+            self.stdout.write(f'{mess.name}: closed {len(closed)} months through {month}/{year}.')
+
+        self.stdout.write(self.style.SUCCESS(f'{total} months closed.'))
@@ -0,0 +1,56 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from core.benchmark import HOT_PATH_INDEXES, analyze, drop_indexes, hot_queries, seed_dataset
+from core.models import Mess, Membership
+
+
+class Command(BaseCommand):
+    help = ('Show EXPLAIN plans of the hot report, dashboard and notification queries '
+            'with and without the composite indexes. All changes are rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mess', type=int,
+                            help='Explain against an existing mess instead of seeding one')
+        parser.add_argument('--members', type=int, default=40)
+        parser.add_argument('--days', type=int, default=120)
+        parser.add_argument('--notifications', type=int, default=200)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Database backend: {connection.vendor}')
+
+        with transaction.atomic():
+            if options['mess']:
+                mess = Mess.objects.filter(id=options['mess']).first()
+                if mess is None:
+                    raise CommandError(f'Mess {options["mess"]} does not exist.')
+            else:
+                self.stdout.write('Seeding benchmark data...')
+                mess_ids = seed_dataset(
+                    members=options['members'],
+                    days=options['days'],
+                    notifications=options['notifications'],
+                )
+                mess = Mess.objects.get(id=mess_ids[0])
+
+            membership = Membership.objects.filter(mess=mess).select_related('user').first()
+            if membership is None:
+                raise CommandError(f'Mess {mess.id} has no members.')
+            today = date.today()
+
+            with transaction.atomic():
+                drop_indexes(HOT_PATH_INDEXES)
+                analyze()
+                self.print_plans('Before (without composite indexes)', mess, membership.user, today)
+                transaction.set_rollback(True)
+
+            analyze()
+            self.print_plans('After (with composite indexes)', mess, membership.user, today)
+            transaction.set_rollback(True)
+
+    def print_plans(self, heading, mess, user, today):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{heading}'))
+        for label, queryset in hot_queries(mess, user, today.year, today.month):
+            self.stdout.write(self.style.SUCCESS(label))
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f'    {line}')
@@ -0,0 +1,49 @@
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from core.imports import IMPORT_CHUNK_SIZE, IMPORT_COLUMNS, LedgerImportError, import_ledger
+from core.models import CustomUser, Mess, Membership
+
+
+class Command(BaseCommand):
+    help = f'Import meals, expenses and deposits of a mess from a CSV file with the columns {", ".join(IMPORT_COLUMNS)}'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to import, or - to read standard input')
+        parser.add_argument('--mess', type=int, required=True, help='Id of the mess to import into')
+        parser.add_argument('--user', help='Username recorded as adding the expenses, defaults to a manager of the mess')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                            help='Rows written per bulk insert')
+
+    def handle(self, *args, **options):
+        try:
+            mess = Mess.objects.get(id=options['mess'])
+        except Mess.DoesNotExist:
+            raise CommandError(f'Mess {options["mess"]} does not exist.')
+
+        if options['user']:
+            user = CustomUser.objects.filter(username=options['user']).first()
+        else:
+            manager = Membership.objects.filter(mess=mess, role='manager').select_related('user').first()
+            user = manager.user if manager else None
+        if user is None:
+            raise CommandError('No user to record the expenses under, pass --user.')
+
+        start = time.perf_counter()
+        try:
+            if options['path'] == '-':
+                counts = import_ledger(mess, sys.stdin, user, chunk_size=options['chunk_size'])
+            else:
+                with open(options['path'], encoding='utf-8-sig', newline='') as lines:
+                    counts = import_ledger(mess, lines, user, chunk_size=options['chunk_size'])
+        except LedgerImportError as e:
+            for line, error in e.errors:
+                self.stderr.write(f'Line {line}: {error}')
+            raise CommandError('Nothing was imported.')
+        except OSError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {counts["meals"]} meal entries, {counts["expenses"]} expenses and '
+            f'{counts["deposits"]} deposits into {mess.name} in {time.perf_counter() - start:.1f}s.'
+        ))
@@ -0,0 +1,29 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from core.notifications import purge_read_notifications
+
+
+class Command(BaseCommand):
+    help = 'Delete read notifications older than the retention period, optionally archiving them first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 90),
+                            help='Keep read notifications newer than this many days')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--archive',
+                            help='Append the purged notifications to this file as JSON lines')
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days=options['days'])
+
+        if options['archive']:
+            with open(options['archive'], 'a', encoding='utf-8') as archive:
+                deleted = purge_read_notifications(older_than, options['batch_size'], archive)
+        else:
+            deleted = purge_read_notifications(older_than, options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {deleted} read notifications older than {options["days"]} days.'
+        ))
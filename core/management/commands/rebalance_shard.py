@@ -0,0 +1,44 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from core.models import Mess
+from core.rebalance import MOVE_BATCH_SIZE, ShardMoveError, move_mess
+from core.shards import shard_aliases
+
+
+class Command(BaseCommand):
+    help = 'Move the data of a mess to another database shard while the mess stays readable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('mess', type=int, nargs='?', help='Id of the mess to move')
+        parser.add_argument('shard', nargs='?', help=f'Shard to move it to, one of {", ".join(shard_aliases())}')
+        parser.add_argument('--drain-seconds', type=float, default=2,
+                            help='Seconds to wait for writes already in progress once the mess is locked')
+        parser.add_argument('--batch-size', type=int, default=MOVE_BATCH_SIZE)
+        parser.add_argument('--list', action='store_true', help='Show how many messes each shard holds')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            counts = dict(Mess.objects.values_list('shard').annotate(total=models.Count('id')))
+            for alias in shard_aliases():
+                self.stdout.write(f'{alias:<12} {counts.get(alias, 0):>6} messes')
+            return
+        if options['mess'] is None or options['shard'] is None:
+            raise CommandError('Give the mess id and the shard to move it to, or --list.')
+
+        mess = Mess.objects.filter(id=options['mess']).first()
+        if mess is None:
+            raise CommandError(f'Mess {options["mess"]} does not exist.')
+
+        source = mess.shard
+        start = time.perf_counter()
+        try:
+            copied = move_mess(mess, options['shard'], options['drain_seconds'], options['batch_size'])
+        except ShardMoveError as e:
+            raise CommandError(str(e))
+
+        for label, count in copied.items():
+            self.stdout.write(f'{label:<20} {count:>8} rows')
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {mess.name} from {source} to {mess.shard} in {time.perf_counter() - start:.1f}s.'
+        ))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.ledger import rebuild_ledger
+from core.models import Mess
+from core.shards import shard_aliases, use_shard
+
+
+class Command(BaseCommand):
+    help = 'Re-derive the monthly ledger from meals, expenses and deposits and report any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mess', type=int, action='append', dest='mess_ids',
+                            help='Only rebuild the given mess id (can be repeated)')
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drift, do not rewrite the ledger')
+
+    def handle(self, *args, **options):
+        drift = []
+        for shard in shard_aliases():
+            messes = Mess.objects.filter(shard=shard)
+            if options['mess_ids']:
+                messes = messes.filter(id__in=options['mess_ids'])
+            if not options['check']:
+                # rebalance_shard is copying their rows
+                for name in messes.filter(shard_locked=True).values_list('name', flat=True):
+                    self.stderr.write(f'Skipping {name}, it is being moved to another database.')
+                messes = messes.filter(shard_locked=False)
+            mess_ids = list(messes.values_list('id', flat=True))
+            if not mess_ids:
+                continue
+            with use_shard(shard):
+                drift += rebuild_ledger(mess_ids, check_only=options['check'])
+
+        for (mess_id, user_id, year, month), stored, expected in drift:
+            owner = f'user {user_id}' if user_id else 'mess'
+            self.stdout.write(
+                f'Drift in mess {mess_id}, {owner}, {month}/{year}: stored {stored}, expected {expected}'
+            )
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Ledger is consistent.'))
+        elif options['check']:
+            raise CommandError(f'{len(drift)} ledger rows have drifted.')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Ledger rebuilt, {len(drift)} drifted rows corrected.'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.notifications import reconcile_unread_counts
+
+
+class Command(BaseCommand):
+    help = 'Recount unread notifications and fix drifted per-user counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drift, do not fix the counters')
+
+    def handle(self, *args, **options):
+        drift = reconcile_unread_counts(check_only=options['check'])
+
+        for user_id, stored, actual in drift:
+            self.stdout.write(f'User {user_id}: counter {stored}, actual unread {actual}')
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Unread counters are consistent.'))
+        elif options['check']:
+            raise CommandError(f'{len(drift)} unread counters have drifted.')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(drift)} unread counters.'))
@@ -0,0 +1,69 @@
+import json
+import subprocess
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core.benchmark import BENCHMARK_VIEWS, run_benchmark
+from core.models import Mess
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the dashboard, report, message and notification views and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mess', type=int,
+                            help='Mess to benchmark, defaults to the most recently seeded benchmark mess')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--view', action='append', dest='views',
+                            choices=[name for name, takes_mess, role in BENCHMARK_VIEWS],
+                            help='Only benchmark this view (can be repeated)')
+        parser.add_argument('--output', default='bench_results.json')
+        parser.add_argument('--compare',
+                            help='Earlier results file to compare p50 latency and queries against')
+
+    def handle(self, *args, **options):
+        if options['mess']:
+            mess = Mess.objects.filter(id=options['mess']).first()
+        else:
+            mess = Mess.objects.filter(name__startswith='Bench mess').order_by('-id').first()
+        if mess is None:
+            raise CommandError('No mess to benchmark, run seed_bench first or pass --mess.')
+
+        results = {
+            'meta': {
+                'commit': self.git_commit(),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'database': connection.vendor,
+                'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+                'pool': 'pool' in connection.settings_dict['OPTIONS'],
+                'mess': mess.id,
+                'members': mess.membership_set.count(),
+                'iterations': options['iterations'],
+            },
+            'views': run_benchmark(mess, options['iterations'], options['views']),
+        }
+
+        with open(options['output'], 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+
+        previous = {}
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as compare:
+                previous = json.load(compare)['views']
+
+        for name, result in results['views'].items():
+            line = f'{name:<22} p50 {result["wall_ms"]["p50"]:>8.1f} ms  p90 {result["wall_ms"]["p90"]:>8.1f} ms  ' \
+                   f'queries {result["queries"]["p50"]:>5}'
+            if name in previous:
+                before = previous[name]
+                line += f'  (was {before["wall_ms"]["p50"]:.1f} ms, {before["queries"]["p50"]} queries)'
+            self.stdout.write(line)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
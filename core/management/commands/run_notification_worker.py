@@ -0,0 +1,50 @@
+import os
+import socket
+import time
+from django.core.management.base import BaseCommand
+from core.notifications import claim_outbox_batch, deliver_outbox, release_outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued notifications from the notification outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of outbox rows claimed at a time')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--claim-timeout', type=int, default=300,
+                            help='Seconds after which rows claimed by a stopped worker are retried')
+        parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}',
+                            help='Name used to claim rows, must differ between concurrent workers')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the outbox and exit instead of polling')
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id']
+        self.stdout.write(f'Notification worker {worker_id} started.')
+
+        try:
+            while True:
+                entries = claim_outbox_batch(worker_id, options['batch_size'], options['claim_timeout'])
+                if not entries:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                try:
+                    notifications = deliver_outbox(entries)
+                except Exception as e:
+                    release_outbox(entries, e)
+                    self.stderr.write(f'Failed to deliver {len(entries)} outbox rows: {e}')
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                self.stdout.write(f'Delivered {len(notifications)} notifications from {len(entries)} outbox rows.')
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Notification worker {worker_id} stopped.'))
@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from django.db import connections
+from core.report_jobs import claim_report_jobs, fail_report_job
+from core.report_worker import render_job, setup_process
+from core.shards import shard_aliases, use_shard
+
+
+class Command(BaseCommand):
+    help = 'Render queued PDF report jobs in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Number of reports rendered in parallel')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds to wait when no job is queued')
+        parser.add_argument('--claim-timeout', type=int, default=600,
+                            help='Seconds after which jobs left running by a stopped worker are retried')
+        parser.add_argument('--worker-id', default=f'{socket.gethostname()}-{os.getpid()}',
+                            help='Name used to claim jobs, must differ between concurrent workers')
+        parser.add_argument('--once', action='store_true',
+                            help='Render the queued jobs and exit instead of polling')
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id']
+        processes = max(1, options['processes'])
+        self.stdout.write(f'Report worker {worker_id} started with {processes} processes.')
+
+        # Spawned processes open their own database connections
+        connections.close_all()
+        context = multiprocessing.get_context('spawn')
+        running = {}
+        try:
+            with ProcessPoolExecutor(processes, mp_context=context, initializer=setup_process) as pool:
+                while True:
+                    for shard in shard_aliases():
+                        if len(running) >= processes:
+                            break
+                        with use_shard(shard):
+                            jobs = claim_report_jobs(worker_id, processes - len(running), options['claim_timeout'])
+                        for job in jobs:
+                            running[pool.submit(render_job, job.id, shard)] = (job, shard)
+
+                    if not running:
+                        if options['once']:
+                            break
+                        time.sleep(options['interval'])
+                        continue
+
+                    finished, _ = wait(running, timeout=options['interval'], return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        job, shard = running.pop(future)
+                        error = future.exception()
+                        if error is None:
+                            self.stdout.write(f'Rendered report {job.month}/{job.year} of mess {job.mess_id}.')
+                        else:
+                            with use_shard(shard):
+                                fail_report_job(job.id, error)
+                            self.stderr.write(f'Report job {job.id} failed: {error}')
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Report worker {worker_id} stopped.'))
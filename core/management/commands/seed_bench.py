@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from core.benchmark import seed_dataset
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic messes with meals, expenses, deposits, messages and notifications for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messes', type=int, default=1)
+        parser.add_argument('--members', type=int, default=40)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--messages', type=int, default=1000,
+                            help='Chat messages per mess')
+        parser.add_argument('--notifications', type=int, default=200,
+                            help='Notifications per member')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        mess_ids = seed_dataset(
+            messes=options['messes'],
+            members=options['members'],
+            days=options['days'],
+            notifications=options['notifications'],
+            messages=options['messages'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded messes {", ".join(map(str, mess_ids))} with {options["members"]} members '
+            f'and {options["days"]} days of data each.'
+        ))
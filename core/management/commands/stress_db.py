@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core.models import Mess, Message
+from core.stress import run_stress
+
+
+class Command(BaseCommand):
+    help = 'Run concurrent reader and writer threads against the database and report throughput and lock errors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mess', type=int,
+                            help='Mess to write into, defaults to the most recently seeded benchmark mess')
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the chat messages written by the run')
+
+    def handle(self, *args, **options):
+        if options['mess']:
+            mess = Mess.objects.filter(id=options['mess']).first()
+        else:
+            mess = Mess.objects.filter(name__startswith='Bench mess').order_by('-id').first()
+        if mess is None:
+            raise CommandError('No mess to write into, run seed_bench first or pass --mess.')
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                self.stdout.write(f'SQLite journal mode: {cursor.fetchone()[0]}')
+
+        results = run_stress(mess, options['seconds'], options['writers'], options['readers'])
+
+        for role, result in results.items():
+            latency = result['latency_ms']
+            self.stdout.write(
+                f'{role:<6} {result["ops"]:>7} ops  {result["ops_per_second"]:>8.1f}/s  '
+                f'p50 {latency.get("p50", 0):>7.1f} ms  p99 {latency.get("p99", 0):>7.1f} ms  '
+                f'errors {result["errors"]}'
+            )
+
+        if not options['keep']:
+            Message.objects.filter(mess=mess, content__startswith='Stress message ').delete()
+
+        if any(result['errors'] for result in results.values()):
+            raise CommandError('Some operations failed with database errors.')
+        self.stdout.write(self.style.SUCCESS('No database errors.'))
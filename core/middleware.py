@@ -0,0 +1,75 @@
+import logging
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+from .database import SAFE_METHODS
+from .instrumentation import RequestMetrics, current_metrics, view_metrics
+from .replicas import mark_primary
+
+logger = logging.getLogger('core.performance')
+
+
+class RequestMetricsMiddleware:
+    """
+    Records query count, SQL time, template render time and wall time of
+    every request. The numbers are sent back in a Server-Timing header to
+    staff users, or to everyone with SERVER_TIMING_HEADER, slow views are
+    logged and samples are kept per URL name for the view_metrics endpoint.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'SLOW_VIEW_MS', 500)
+        self.slow_queries = getattr(settings, 'SLOW_VIEW_QUERIES', 50)
+        self.server_timing = getattr(settings, 'SERVER_TIMING_HEADER', False)
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        wall_time = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        name = match.view_name if match else 'unresolved'
+        view_metrics.record(name, wall_time, metrics.queries, metrics.sql_time, metrics.template_time)
+
+        user = getattr(request, 'user', None)
+        if self.server_timing or (user is not None and user.is_staff):
+            response['Server-Timing'] = ', '.join([
+                f'db;desc="{metrics.queries} queries";dur={metrics.sql_time * 1000:.1f}',
+                f'tpl;desc="Templates";dur={metrics.template_time * 1000:.1f}',
+                f'total;dur={wall_time * 1000:.1f}',
+            ])
+
+        if wall_time * 1000 > self.slow_ms or metrics.queries > self.slow_queries:
+            logger.warning(
+                'Slow view %s (%s %s): %.0f ms, %d queries, %.0f ms SQL, %.0f ms templates',
+                name, request.method, request.path, wall_time * 1000,
+                metrics.queries, metrics.sql_time * 1000, metrics.template_time * 1000,
+            )
+        return response
+
+
+class PrimaryAfterWriteMiddleware:
+    """
+    Keeps a user on the primary database for REPLICA_STICKY_SECONDS after
+    any request that may have written, so replica-routed pages they are
+    redirected to already show their change.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS and request.user.is_authenticated:
+            mark_primary(request.user.id)
+        return response
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def backfill_ledger(apps, schema_editor):
+    Meal = apps.get_model('core', 'Meal')
+    Expense = apps.get_model('core', 'Expense')
+    Deposit = apps.get_model('core', 'Deposit')
+    MonthlyLedger = apps.get_model('core', 'MonthlyLedger')
+    db = schema_editor.connection.alias
+
+    def by_month(queryset, fields):
+        return queryset.annotate(
+            ledger_year=ExtractYear('date'), ledger_month=ExtractMonth('date')
+        ).order_by().values(*fields, 'ledger_year', 'ledger_month')
+
+    rows = {}
+
+    def row(mess_id, user_id, year, month):
+        key = (mess_id, user_id, year, month)
+        if key not in rows:
+            rows[key] = MonthlyLedger(mess_id=mess_id, user_id=user_id, year=year, month=month)
+        return rows[key]
+
+    meal_total = models.F('breakfast') + models.F('lunch') + models.F('dinner')
+    for item in by_month(Meal.objects.using(db), ['mess', 'user']).annotate(total=models.Sum(meal_total)):
+        row(item['mess'], item['user'], item['ledger_year'], item['ledger_month']).meals = item['total'] or 0
+    for item in by_month(Deposit.objects.using(db), ['mess', 'user']).annotate(total=models.Sum('amount')):
+        row(item['mess'], item['user'], item['ledger_year'], item['ledger_month']).deposit = item['total'] or 0
+    for item in by_month(Expense.objects.using(db), ['mess']).annotate(total=models.Sum('amount')):
+        row(item['mess'], None, item['ledger_year'], item['ledger_month']).expense = item['total'] or 0
+
+    MonthlyLedger.objects.using(db).bulk_create(rows.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_deposit_month_deposit_year_expense_month_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField()),
+                ('month', models.PositiveIntegerField()),
+                ('meals', models.IntegerField(default=0)),
+                ('deposit', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('expense', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('mess', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.mess')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('user__isnull', True)), fields=('mess', 'year', 'month'), name='unique_mess_level_ledger')],
+                'unique_together': {('mess', 'user', 'year', 'month')},
+            },
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:37
+
+from django.db import migrations, models
+
+
+def count_unread_notifications(apps, schema_editor):
+    CustomUser = apps.get_model('core', 'CustomUser')
+    Notification = apps.get_model('core', 'Notification')
+    db = schema_editor.connection.alias
+
+    unread = Notification.objects.using(db).filter(is_read=False).values('user').order_by().annotate(total=models.Count('id'))
+    for row in unread:
+        CustomUser.objects.using(db).filter(id=row['user']).update(unread_notifications=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_notificationoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread_notifications, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_customuser_unread_notifications'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(fields=['mess', 'date'], name='deposit_mess_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(fields=['mess', 'user', 'date'], name='deposit_mess_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(fields=['mess', 'year', 'month'], name='deposit_mess_year_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['mess', 'date'], name='expense_mess_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['mess', 'year', 'month'], name='expense_mess_year_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['mess', 'date'], name='meal_mess_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['mess', 'user', 'date'], name='meal_mess_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['mess', 'year', 'month'], name='meal_mess_year_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='monthlyledger',
+            index=models.Index(fields=['mess', 'year', 'month'], name='ledger_mess_year_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', '-created_at'], name='notif_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['user', '-created_at'], name='notif_user_unread_idx'),
+        ),
+    ]
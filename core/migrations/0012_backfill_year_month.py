@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:58
+
+from django.db import migrations
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def backfill_year_month(apps, schema_editor):
+    # Rows created before 0006 have no year/month, the range reports group on them
+    db = schema_editor.connection.alias
+    for name in ('Meal', 'Expense', 'Deposit'):
+        model = apps.get_model('core', name)
+        model.objects.using(db).filter(year__isnull=True).update(year=ExtractYear('date'), month=ExtractMonth('date'))
+        model.objects.using(db).filter(month__isnull=True).update(month=ExtractMonth('date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_reportjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_year_month, migrations.RunPython.noop),
+    ]
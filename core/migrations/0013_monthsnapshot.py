@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_backfill_year_month'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField()),
+                ('month', models.PositiveIntegerField()),
+                ('meals', models.IntegerField(default=0)),
+                ('meal_rate', models.DecimalField(decimal_places=4, default=0, max_digits=12)),
+                ('cost', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('deposit', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('carried_forward', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('closed_at', models.DateTimeField(auto_now_add=True)),
+                ('closed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('mess', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.mess')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['mess', 'year', 'month'], name='snapshot_mess_year_month_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('user__isnull', True)), fields=('mess', 'year', 'month'), name='unique_mess_level_snapshot')],
+                'unique_together': {('mess', 'user', 'year', 'month')},
+            },
+        ),
+    ]
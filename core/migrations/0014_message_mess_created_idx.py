@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_monthsnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['-created_at', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['mess', 'created_at', 'id'], name='message_mess_created_idx'),
+        ),
+    ]
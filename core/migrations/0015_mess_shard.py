@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_message_mess_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mess',
+            name='shard',
+            field=models.CharField(default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='mess',
+            name='shard_locked',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -8,6 +8,7 @@ class CustomUser(AbstractUser):
     
     email = models.EmailField(blank=True, null=True)
     phone = models.CharField(max_length=15, blank=True, null=True)
+    unread_notifications = models.PositiveIntegerField(default=0)
     
     groups = models.ManyToManyField(
         'auth.Group',
@@ -34,6 +35,10 @@ class Mess(models.Model):
     address = models.TextField()
     code = models.CharField(max_length=6, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Database alias holding the mess's data, see core.shards
+    shard = models.CharField(max_length=32, default='default')
+    # Set while rebalance_shard moves the data, writes are refused meanwhile
+    shard_locked = models.BooleanField(default=False)
     
     def save(self, *args, **kwargs):
         if not self.code:
@@ -59,25 +64,28 @@ class Membership(models.Model):
     
     def __str__(self):
         return f"{self.user.username} - {self.mess.name} ({self.role})"
+
+class LedgerTrackedModel(models.Model):
+    """
+    Remembers the values a row was loaded with so the monthly ledger
+    can apply the difference when the row is saved again.
+
+    Subclasses define ledger_values(), returning a dict with the row's
+    'user_id' (None for mess-wide rows), its 'date' and the amounts it
+    adds to the ledger, keyed by 'meals', 'deposit' or 'expense'.
+    """
+    
+    class Meta:
+        abstract = True
     
-    def delete(self, *args, **kwargs):
-        """
-        Custom delete method that removes all member data when a membership is deleted
-        """
-        user = self.user
-        mess = self.mess
-        
-        try:
-            Meal.objects.filter(user=user, mess=mess).delete()
-            Deposit.objects.filter(user=user, mess=mess).delete()
-            print(f"Deleted all data for user {user.username} from mess {mess.name}")
-            
-        except Exception as e:
-            print(f"Error deleting member data: {str(e)}")
-        
-        super().delete(*args, **kwargs)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not instance.get_deferred_fields():
+            instance._ledger_snapshot = instance.ledger_values()
+        return instance
 
-class Meal(models.Model):
+class Meal(LedgerTrackedModel):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
     date = models.DateField(default=date.today)
@@ -90,6 +98,11 @@ class Meal(models.Model):
     
     class Meta:
         unique_together = ('user', 'mess', 'date')
+        indexes = [
+            models.Index(fields=['mess', 'date'], name='meal_mess_date_idx'),
+            models.Index(fields=['mess', 'user', 'date'], name='meal_mess_user_date_idx'),
+            models.Index(fields=['mess', 'year', 'month'], name='meal_mess_year_month_idx'),
+        ]
     
     def save(self, *args, **kwargs):
         if self.date:
@@ -100,10 +113,17 @@ class Meal(models.Model):
     def total_meals(self):
         return self.breakfast + self.lunch + self.dinner
     
+    def ledger_values(self):
+        return {
+            'user_id': self.user_id,
+            'date': self.date,
+            'meals': self.breakfast + self.lunch + self.dinner,
+        }
+    
     def __str__(self):
         return f"{self.user.username} - {self.date}"
 
-class Expense(models.Model):
+class Expense(LedgerTrackedModel):
     mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField()
@@ -113,16 +133,25 @@ class Expense(models.Model):
     month = models.PositiveIntegerField(blank=True, null=True) 
     year = models.PositiveIntegerField(blank=True, null=True)  
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['mess', 'date'], name='expense_mess_date_idx'),
+            models.Index(fields=['mess', 'year', 'month'], name='expense_mess_year_month_idx'),
+        ]
+    
     def save(self, *args, **kwargs):
         if self.date:
             self.month = self.date.month
             self.year = self.date.year
         super().save(*args, **kwargs)
     
+    def ledger_values(self):
+        return {'user_id': None, 'date': self.date, 'expense': self.amount}
+    
     def __str__(self):
         return f"{self.mess.name} - {self.amount} - {self.date}"
 
-class Deposit(models.Model):
+class Deposit(LedgerTrackedModel):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -131,15 +160,93 @@ class Deposit(models.Model):
     month = models.PositiveIntegerField(blank=True, null=True)  
     year = models.PositiveIntegerField(blank=True, null=True)   
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['mess', 'date'], name='deposit_mess_date_idx'),
+            models.Index(fields=['mess', 'user', 'date'], name='deposit_mess_user_date_idx'),
+            models.Index(fields=['mess', 'year', 'month'], name='deposit_mess_year_month_idx'),
+        ]
+    
     def save(self, *args, **kwargs):
         if self.date:
             self.month = self.date.month
             self.year = self.date.year
         super().save(*args, **kwargs)
     
+    def ledger_values(self):
+        return {'user_id': self.user_id, 'date': self.date, 'deposit': self.amount}
+    
     def __str__(self):
         return f"{self.user.username} - {self.amount} - {self.date}"
 
+class MonthlyLedger(models.Model):
+    """
+    Running monthly totals per member. The row with no user is the
+    mess-level row and holds the month's expense total.
+    """
+    mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True)
+    year = models.PositiveIntegerField()
+    month = models.PositiveIntegerField()
+    meals = models.IntegerField(default=0)
+    deposit = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    expense = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ('mess', 'user', 'year', 'month')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['mess', 'year', 'month'],
+                condition=models.Q(user__isnull=True),
+                name='unique_mess_level_ledger',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['mess', 'year', 'month'], name='ledger_mess_year_month_idx'),
+        ]
+    
+    def __str__(self):
+        owner = self.user.username if self.user_id else 'mess'
+        return f"{self.mess.name} - {owner} - {self.month}/{self.year}"
+
+class MonthSnapshot(models.Model):
+    """
+    Frozen settlement of a closed month per member. The row with no user is
+    the mess-level row: its cost is the month's expense and its balances are
+    the sums over members. The meals, expenses and deposits of a closed
+    month can no longer be changed.
+    """
+    mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True)
+    year = models.PositiveIntegerField()
+    month = models.PositiveIntegerField()
+    meals = models.IntegerField(default=0)
+    meal_rate = models.DecimalField(max_digits=12, decimal_places=4, default=0)
+    cost = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    deposit = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    carried_forward = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    closed_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    closed_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('mess', 'user', 'year', 'month')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['mess', 'year', 'month'],
+                condition=models.Q(user__isnull=True),
+                name='unique_mess_level_snapshot',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['mess', 'year', 'month'], name='snapshot_mess_year_month_idx'),
+        ]
+    
+    def __str__(self):
+        owner = self.user.username if self.user_id else 'mess'
+        return f"{self.mess.name} - {owner} - {self.month}/{self.year} (closed)"
+
 class Message(models.Model):
     mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -147,7 +254,10 @@ class Message(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['mess', 'created_at', 'id'], name='message_mess_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.created_at}"
@@ -170,6 +280,79 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='notif_user_created_idx'),
+            # Partial index, only built on backends that support it (SQLite, PostgreSQL)
+            models.Index(
+                fields=['user', '-created_at'],
+                condition=models.Q(is_read=False),
+                name='notif_user_unread_idx',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.title}"
+
+class NotificationOutbox(models.Model):
+    """
+    Notifications waiting to be expanded and written by the
+    run_notification_worker command.
+    """
+    RECIPIENT_CHOICES = (
+        ('user', 'Single user'),
+        ('mess', 'All mess members'),
+    )
+    
+    recipients = models.CharField(max_length=10, choices=RECIPIENT_CHOICES, default='user')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True)
+    mess = models.ForeignKey(Mess, on_delete=models.CASCADE, null=True, blank=True)
+    title = models.CharField(max_length=200)
+    message = models.TextField()
+    notification_type = models.CharField(max_length=10, choices=Notification.NOTIFICATION_TYPES, default='info')
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_by = models.CharField(max_length=100, blank=True, default='')
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    
+    class Meta:
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"{self.recipients} - {self.title}"
+
+class ReportJob(models.Model):
+    """A monthly PDF report rendered off the request path by the run_report_worker command"""
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    ACTIVE_STATUSES = ('queued', 'running')
+    
+    mess = models.ForeignKey(Mess, on_delete=models.CASCADE)
+    year = models.IntegerField()
+    month = models.IntegerField()
+    requested_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    file = models.FileField(upload_to='reports/', blank=True)
+    error = models.TextField(blank=True, default='')
+    claimed_by = models.CharField(max_length=100, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            # At most one pending job per mess-month, identical requests share it
+            models.UniqueConstraint(
+                fields=['mess', 'year', 'month'],
+                condition=models.Q(status__in=['queued', 'running']),
+                name='unique_active_report_job',
+            ),
+        ]
     
     def __str__(self):
-        return f"{self.user.username} - {self.title}"
\ No newline at end of file
+        return f"{self.mess.name} - {self.month}/{self.year} ({self.status})"
@@ -0,0 +1,259 @@
+import base64
+import json
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import CustomUser, Membership, Notification, NotificationOutbox
+from . import realtime
+
+MAX_DELIVERY_ATTEMPTS = 5
+NOTIFICATION_PAGE_SIZE = 20
+
+
+def notify_users(user_ids, title, message, notification_type='info', mess=None):
+    """
+    Create the same notification for many users with a single bulk INSERT.
+    Returns the created notifications.
+    """
+    notifications = [
+        Notification(
+            user_id=user_id,
+            mess=mess,
+            title=title,
+            message=message,
+            notification_type=notification_type
+        )
+        for user_id in user_ids
+    ]
+    if not notifications:
+        return []
+
+    with transaction.atomic():
+        created = Notification.objects.bulk_create(notifications)
+        adjust_unread_counts(Counter(notification.user_id for notification in created))
+    return created
+
+
+def notify_mess_members(mess, title, message, notification_type='info', exclude_user_ids=()):
+    """Send a notification to every member of a mess"""
+    user_ids = Membership.objects.filter(mess=mess).exclude(
+        user_id__in=exclude_user_ids
+    ).values_list('user_id', flat=True)
+    return notify_users(user_ids, title, message, notification_type, mess=mess)
+
+
+def queue_notification(title, message, notification_type='info', mess=None, user=None):
+    """
+    Queue a notification for one user, or for every member of the mess when
+    no user is given. The outbox row is written in the caller's transaction
+    and delivered later by the run_notification_worker command.
+    """
+    if not getattr(settings, 'NOTIFICATION_OUTBOX', True):
+        if user is None:
+            return notify_mess_members(mess, title, message, notification_type)
+        return notify_users([user.id], title, message, notification_type, mess=mess)
+
+    return NotificationOutbox.objects.create(
+        recipients='mess' if user is None else 'user',
+        user=user,
+        mess=mess,
+        title=title,
+        message=message,
+        notification_type=notification_type
+    )
+
+
+def queue_user_notifications(user_messages, title, notification_type='info', mess=None):
+    """
+    Queue one notification per (user_id, message) pair with a single bulk
+    INSERT, for broadcasts where every recipient gets their own text.
+    """
+    if not user_messages:
+        return []
+
+    if not getattr(settings, 'NOTIFICATION_OUTBOX', True):
+        with transaction.atomic():
+            created = Notification.objects.bulk_create([
+                Notification(user_id=user_id, mess=mess, title=title, message=message,
+                             notification_type=notification_type)
+                for user_id, message in user_messages
+            ])
+            adjust_unread_counts(Counter(notification.user_id for notification in created))
+        return created
+
+    return NotificationOutbox.objects.bulk_create([
+        NotificationOutbox(recipients='user', user_id=user_id, mess=mess, title=title, message=message,
+                           notification_type=notification_type)
+        for user_id, message in user_messages
+    ])
+
+
+def claim_outbox_batch(worker_id, batch_size=100, claim_timeout=300):
+    """
+    Claim up to batch_size pending outbox rows for this worker. Rows claimed
+    by a worker that stopped longer than claim_timeout seconds ago are
+    picked up again.
+    """
+    now = timezone.now()
+    available = NotificationOutbox.objects.filter(attempts__lt=MAX_DELIVERY_ATTEMPTS).filter(
+        models.Q(claimed_by='') | models.Q(claimed_at__lt=now - timedelta(seconds=claim_timeout))
+    )
+    ids = list(available.values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+
+    # The conditional UPDATE only succeeds for rows nobody else claimed meanwhile
+    available.filter(id__in=ids).update(claimed_by=worker_id, claimed_at=now)
+    return list(NotificationOutbox.objects.filter(id__in=ids, claimed_by=worker_id, claimed_at=now))
+
+
+def deliver_outbox(entries):
+    """Expand claimed outbox rows into notifications and remove them from the outbox"""
+    mess_ids = {entry.mess_id for entry in entries if entry.recipients == 'mess'}
+    mess_members = defaultdict(list)
+    for mess_id, user_id in Membership.objects.filter(mess_id__in=mess_ids).values_list('mess_id', 'user_id'):
+        mess_members[mess_id].append(user_id)
+
+    notifications = []
+    for entry in entries:
+        user_ids = mess_members[entry.mess_id] if entry.recipients == 'mess' else [entry.user_id]
+        notifications.extend(
+            Notification(
+                user_id=user_id,
+                mess_id=entry.mess_id,
+                title=entry.title,
+                message=entry.message,
+                notification_type=entry.notification_type
+            )
+            for user_id in user_ids
+        )
+
+    with transaction.atomic():
+        Notification.objects.bulk_create(notifications, batch_size=500)
+        adjust_unread_counts(Counter(notification.user_id for notification in notifications))
+        NotificationOutbox.objects.filter(id__in=[entry.id for entry in entries]).delete()
+    return notifications
+
+
+def release_outbox(entries, error):
+    """Hand failed rows back to the outbox so they are retried"""
+    NotificationOutbox.objects.filter(id__in=[entry.id for entry in entries]).update(
+        claimed_by='',
+        claimed_at=None,
+        attempts=models.F('attempts') + 1,
+        last_error=str(error)
+    )
+
+
+def adjust_unread_counts(deltas):
+    """
+    Apply {user_id: delta} to the users' unread notification counters,
+    with one UPDATE per distinct delta.
+    """
+    users_by_delta = defaultdict(list)
+    for user_id, delta in deltas.items():
+        if delta:
+            users_by_delta[delta].append(user_id)
+    for delta, user_ids in users_by_delta.items():
+        CustomUser.objects.filter(id__in=user_ids).update(
+            unread_notifications=Greatest(models.F('unread_notifications') + delta, 0)
+        )
+    if users_by_delta and getattr(settings, 'REALTIME_PUSH', False):
+        push_unread_counts([user_id for user_ids in users_by_delta.values() for user_id in user_ids])
+
+
+def push_unread_counts(user_ids):
+    """Push the users' current unread counters to their open event streams after commit"""
+    for user_id, unread_count in CustomUser.objects.filter(id__in=user_ids).values_list('id', 'unread_notifications'):
+        realtime.publish(realtime.user_channel(user_id), 'unread', {'unread_count': unread_count})
+
+
+def mark_read(user, notifications):
+    """Mark the user's unread notifications in the queryset as read and update the counter"""
+    with transaction.atomic():
+        marked = notifications.filter(user=user, is_read=False).update(is_read=True)
+        adjust_unread_counts({user.id: -marked})
+    user.unread_notifications = max(user.unread_notifications - marked, 0)
+    return marked
+
+
+def reconcile_unread_counts(check_only=False):
+    """
+    Recount every user's unread notifications and fix counters that drifted.
+    Returns a list of (user_id, stored, actual).
+    """
+    actual = dict(
+        Notification.objects.filter(is_read=False).values('user').order_by()
+        .annotate(total=models.Count('id')).values_list('user', 'total')
+    )
+    drift = []
+    for user_id, stored in CustomUser.objects.values_list('id', 'unread_notifications').iterator():
+        expected = actual.get(user_id, 0)
+        if stored != expected:
+            drift.append((user_id, stored, expected))
+
+    if not check_only:
+        for user_id, stored, expected in drift:
+            CustomUser.objects.filter(id=user_id).update(unread_notifications=expected)
+    return drift
+
+
+def encode_cursor(notification):
+    """Opaque keyset cursor pointing just after the given notification"""
+    position = f'{notification.created_at.isoformat()}|{notification.id}'
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (created_at, id) from a cursor, or None when it is missing or invalid"""
+    if not cursor:
+        return None
+    try:
+        created_at, notification_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(notification_id)
+    except (ValueError, UnicodeError):
+        return None
+
+
+def notification_page(user, cursor=None, page_size=NOTIFICATION_PAGE_SIZE):
+    """
+    One page of the user's notifications, newest first, using keyset
+    pagination on (created_at, id). Returns the notifications and the
+    cursor of the next page, or None on the last page.
+    """
+    notifications = Notification.objects.filter(user=user).select_related('mess').order_by('-created_at', '-id')
+    position = decode_cursor(cursor)
+    if position:
+        created_at, notification_id = position
+        notifications = notifications.filter(
+            models.Q(created_at__lt=created_at) | models.Q(created_at=created_at, id__lt=notification_id)
+        )
+
+    page = list(notifications[:page_size + 1])
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    return page[:page_size], next_cursor
+
+
+def purge_read_notifications(older_than, batch_size=1000, archive=None):
+    """
+    Delete read notifications created before older_than in batches of
+    batch_size. When archive is a file object each batch is written to it
+    as JSON lines first. Returns the number of deleted notifications.
+    """
+    expired = Notification.objects.filter(is_read=True, created_at__lt=older_than).order_by('id')
+    deleted = 0
+    while True:
+        batch = list(expired.values(
+            'id', 'user_id', 'mess_id', 'title', 'message', 'notification_type', 'created_at'
+        )[:batch_size])
+        if not batch:
+            return deleted
+        if archive is not None:
+            for row in batch:
+                archive.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+        with transaction.atomic():
+            deleted += Notification.objects.filter(id__in=[row['id'] for row in batch]).delete()[0]
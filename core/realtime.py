@@ -0,0 +1,138 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+from .models import Membership
+from .shards import on_commit
+
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def mess_channel(mess_id):
+    return f'mess:{mess_id}'
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+class InProcessBroker:
+    """
+    Publish/subscribe between the views of one process. Events published
+    from any thread are handed to the event loop of each subscriber.
+    Multi-worker deployments replace it through REALTIME_BROKER with a
+    class offering the same publish() and subscribe() methods backed by a
+    shared broker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def publish(self, channel, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, (event, data))
+            except RuntimeError:
+                # The subscriber's loop is closed, it unsubscribes on its way out
+                pass
+
+    @staticmethod
+    def _deliver(queue, item):
+        if queue.full():
+            # Slow readers lose their oldest event rather than block publishers
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    @contextmanager
+    def subscribe(self, channels):
+        """
+        Context manager yielding an asyncio.Queue that receives the
+        (event, data) pairs published to any of the channels
+        """
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(SUBSCRIBER_QUEUE_SIZE))
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].add(subscriber)
+        try:
+            yield subscriber[1]
+        finally:
+            with self._lock:
+                for channel in channels:
+                    self._subscribers[channel].discard(subscriber)
+                    if not self._subscribers[channel]:
+                        del self._subscribers[channel]
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'REALTIME_BROKER', 'core.realtime.InProcessBroker'))()
+    return _broker
+
+
+def streams_enabled(request):
+    """Whether the request may open an event stream: REALTIME_PUSH is on and it came in over ASGI"""
+    return getattr(settings, 'REALTIME_PUSH', False) and isinstance(request, ASGIRequest)
+
+
+def publish(channel, event, data):
+    """Publish an event once the current transaction commits"""
+    if getattr(settings, 'REALTIME_PUSH', False):
+        on_commit(lambda: get_broker().publish(channel, event, data))
+
+
+def publish_message(message):
+    """Push a new chat message to the open event streams of its mess"""
+    role = Membership.objects.filter(mess_id=message.mess_id, user_id=message.user_id).values_list(
+        'role', flat=True
+    ).first()
+    publish(mess_channel(message.mess_id), 'message', {
+        'id': message.id,
+        'user_id': message.user_id,
+        'username': message.user.username,
+        'role': role,
+        'content': message.content,
+        'created_at': message.created_at,
+    })
+
+
+def sse_frame(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+async def event_stream(channels, initial=()):
+    """
+    Server-sent events for the channels, starting with the (event, data)
+    pairs in initial. Sends a comment line every REALTIME_HEARTBEAT
+    seconds so proxies keep idle connections open; waiting costs no queries.
+    """
+    heartbeat = getattr(settings, 'REALTIME_HEARTBEAT', 25)
+    yield f'retry: {getattr(settings, "REALTIME_RETRY_MS", 5000)}\n\n'
+    with get_broker().subscribe(channels) as queue:
+        for event, data in initial:
+            yield sse_frame(event, data)
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            yield sse_frame(event, data)
@@ -0,0 +1,151 @@
+import hashlib
+import time
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from .access import invalidate_memberships
+from .models import CustomUser, Mess, ReportJob
+from .report_cache import invalidate_mess
+from .shards import copy_mess, copy_users, last_id, set_last_id, shard_aliases, sharded_models
+
+MOVE_BATCH_SIZE = 1000
+
+
+class ShardMoveError(Exception):
+    """Raised when a mess cannot be moved; it stays on its old shard"""
+
+
+def _delete_rows(alias, mess_id):
+    # Plain DELETEs: the rows are copies, ledger and closing signals must not run
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for model in reversed(sharded_models()):
+            column = model._meta.get_field('mess').column
+            cursor.execute(f'DELETE FROM {quote(model._meta.db_table)} WHERE {quote(column)} = %s', [mess_id])
+
+
+def _referenced_users(alias, mess_id):
+    user_ids = set()
+    for model in sharded_models():
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.related_model is CustomUser:
+                user_ids.update(
+                    model.objects.using(alias).filter(mess_id=mess_id, **{f'{field.name}__isnull': False})
+                    .values_list(field.attname, flat=True).distinct()
+                )
+    return CustomUser.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=user_ids)
+
+
+def _rows(model, mess_id, alias, batch_size):
+    return (
+        model.objects.using(alias).filter(mess_id=mess_id).order_by('pk')
+        .values_list(*[field.attname for field in model._meta.concrete_fields]).iterator(chunk_size=batch_size)
+    )
+
+
+def _fingerprint(rows):
+    """Number of rows and a checksum of their contents, as (count, digest)"""
+    count = 0
+    digest = hashlib.sha256()
+    for row in rows:
+        count += 1
+        digest.update(repr(row).encode())
+    return count, digest.hexdigest()
+
+
+def _copy_rows(model, mess_id, source, target, batch_size):
+    """
+    Insert the mess's rows of one model, ids included, into target. Returns
+    the _fingerprint of the rows copied.
+    """
+    fields = model._meta.concrete_fields
+    connection = connections[target]
+    quote = connection.ops.quote_name
+    sql = (f'INSERT INTO {quote(model._meta.db_table)} ({", ".join(quote(field.column) for field in fields)}) '
+           f'VALUES ({", ".join(["%s"] * len(fields))})')
+
+    copied = 0
+    digest = hashlib.sha256()
+    batch = []
+    with connection.cursor() as cursor:
+        for row in _rows(model, mess_id, source, batch_size):
+            digest.update(repr(row).encode())
+            batch.append([field.get_db_prep_save(value, connection) for field, value in zip(fields, row)])
+            if len(batch) >= batch_size:
+                cursor.executemany(sql, batch)
+                copied += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+            copied += len(batch)
+    return copied, digest.hexdigest()
+
+
+def _set_lock(mess, locked, **fields):
+    Mess.objects.filter(pk=mess.pk).update(shard_locked=locked, **fields)
+    invalidate_memberships(mess.pk)
+
+
+def move_mess(mess, target, drain_seconds=2, batch_size=MOVE_BATCH_SIZE):
+    """
+    Move the data of a mess to the target shard while it stays readable.
+    Writes are refused and report workers skip the mess while it is locked;
+    drain_seconds are given to requests already writing, and a report still
+    rendering makes the move fail. The rows are copied with their ids in one
+    transaction on the target and read again on the source: if any row was
+    added, changed or deleted meanwhile the copy is dropped and
+    ShardMoveError raised.
+    Otherwise the mess is pointed at the target, unlocked, and its rows
+    deleted from the source. Returns the rows copied per model.
+    """
+    source = mess.shard
+    if target not in shard_aliases():
+        raise ShardMoveError(f'{target} is not a configured shard, use one of {", ".join(shard_aliases())}.')
+    if target == source:
+        raise ShardMoveError(f'{mess.name} is already on {target}.')
+
+    copy_mess(mess, target)
+    copy_users(target, _referenced_users(source, mess.pk))
+    _set_lock(mess, True)
+    try:
+        time.sleep(drain_seconds)
+        if ReportJob.objects.using(source).filter(mess_id=mess.pk, status='running').exists():
+            raise ShardMoveError(f'A report of {mess.name} is being rendered, nothing was moved. Try again.')
+        # Explicit ids must not move the target's own numbering
+        last_ids = {model: last_id(target, model) for model in sharded_models()}
+        try:
+            with transaction.atomic(using=target):
+                # Rows left by an earlier aborted move
+                _delete_rows(target, mess.pk)
+                copied = {
+                    model._meta.label: _copy_rows(model, mess.pk, source, target, batch_size)
+                    for model in sharded_models()
+                }
+                for model, value in last_ids.items():
+                    set_last_id(target, model, value)
+        except IntegrityError as e:
+            raise ShardMoveError(f'Row ids of {mess.name} are taken on {target}, was it migrated? ({e})')
+        remaining = {
+            model._meta.label: _fingerprint(_rows(model, mess.pk, source, batch_size))
+            for model in sharded_models()
+        }
+        if remaining != copied:
+            with transaction.atomic(using=target):
+                _delete_rows(target, mess.pk)
+            raise ShardMoveError(f'{mess.name} was written to while moving, nothing was moved. Try again.')
+    except BaseException:
+        _set_lock(mess, False)
+        raise
+
+    _set_lock(mess, False, shard=target)
+    mess.shard, mess.shard_locked = target, False
+
+    with transaction.atomic(using=source):
+        _delete_rows(source, mess.pk)
+        if source != DEFAULT_DB_ALIAS:
+            # The source's copy of the mess; its user copies may serve other messes
+            quote = connections[source].ops.quote_name
+            with connections[source].cursor() as cursor:
+                cursor.execute(f'DELETE FROM {quote(Mess._meta.db_table)} WHERE id = %s', [mess.pk])
+    # Cached reports and remembered job ids point at the source's rows
+    invalidate_mess(mess.pk)
+    return {label: count for label, (count, digest) in copied.items()}
@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+def _cache():
+    return caches[getattr(settings, 'REPLICA_CACHE_ALIAS', 'default')]
+
+
+def _sticky_key(user_id):
+    return f'db-primary:{user_id}'
+
+
+def replica_alias():
+    """Alias of the read replica, or None when no replica is configured"""
+    return getattr(settings, 'REPLICA_DATABASE', None)
+
+
+def mark_primary(user_id):
+    """Keep the user's reads on the primary while the replica catches up with their write"""
+    seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+    if replica_alias() and seconds:
+        _cache().set(_sticky_key(user_id), 1, seconds)
+
+
+def is_sticky(user_id):
+    return _cache().get(_sticky_key(user_id)) is not None
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block, even in a replica-routed view"""
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def reads_from_replica(view):
+    """
+    Send the reads of a view to the replica. Only for views that do not
+    write. A user who wrote in the last REPLICA_STICKY_SECONDS keeps reading
+    from the primary so the redirect after their write shows it.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if not replica_alias() or (request.user.is_authenticated and is_sticky(request.user.id)):
+            return view(request, *args, **kwargs)
+        token = _replica_reads.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapped
+
+
+class ReplicaRouter:
+    """
+    Routes reads made inside reads_from_replica views to REPLICA_DATABASE.
+    Everything else, all writes and reads inside a transaction, uses the
+    default database. The replica is filled by replication, never migrated.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = replica_alias()
+        if alias and _replica_reads.get() and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases hold the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == replica_alias():
+            return False
+        return None
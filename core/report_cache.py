@@ -0,0 +1,143 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from .replicas import primary
+from .shards import on_commit
+from .settlement import mess_totals, monthly_settlement, range_settlement
+
+
+def _cache():
+    return caches[getattr(settings, 'REPORT_CACHE_ALIAS', 'default')]
+
+
+def _version_cache():
+    # Never culled, see VERSION_CACHE_ALIAS in settings
+    return caches[getattr(settings, 'VERSION_CACHE_ALIAS', 'default')]
+
+
+def _mess_version_key(mess_id):
+    return f'report-version:{mess_id}'
+
+
+def _month_version_key(mess_id, year, month):
+    return f'report-version:{mess_id}:{year}:{month}'
+
+
+def _bump(key):
+    cache = _version_cache()
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key was evicted between add and incr
+        cache.set(key, 1, timeout=None)
+
+
+def data_version(mess_id, year, month):
+    """
+    Version of a mess-month's report data. It changes whenever a meal,
+    expense or deposit of that month or a membership of the mess changes.
+    """
+    mess_key = _mess_version_key(mess_id)
+    month_key = _month_version_key(mess_id, year, month)
+    versions = _version_cache().get_many([mess_key, month_key])
+    return f'{versions.get(mess_key, 0)}.{versions.get(month_key, 0)}'
+
+
+def range_version(mess_id, months):
+    """Combined data version of several months of a mess, read with one cache round trip"""
+    mess_key = _mess_version_key(mess_id)
+    month_keys = [_month_version_key(mess_id, year, month) for year, month in months]
+    versions = _version_cache().get_many([mess_key, *month_keys])
+    combined = '.'.join(str(versions.get(key, 0)) for key in month_keys)
+    return f"{versions.get(mess_key, 0)}.{hashlib.md5(combined.encode()).hexdigest()}"
+
+
+def invalidate_month(mess_id, year, month):
+    """Drop the cached reports of one mess-month once the current transaction commits"""
+    on_commit(lambda: _bump(_month_version_key(mess_id, year, month)))
+
+
+def invalidate_mess(mess_id):
+    """Drop every cached report of a mess once the current transaction commits"""
+    on_commit(lambda: _bump(_mess_version_key(mess_id)))
+
+
+def invalidate_instance(instance):
+    """Invalidate the months a Meal, Expense or Deposit belonged to before and after a change"""
+    months = {(instance.date.year, instance.date.month)}
+    previous = getattr(instance, '_ledger_snapshot', None)
+    if previous:
+        months.add((previous['date'].year, previous['date'].month))
+    for year, month in months:
+        invalidate_month(instance.mess_id, year, month)
+
+
+def _report_key(kind, mess_id, year, month, version=None):
+    if version is None:
+        version = data_version(mess_id, year, month)
+    return f'report:{kind}:{mess_id}:{year}:{month}:{version}'
+
+
+def _timeout():
+    return getattr(settings, 'REPORT_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+
+
+def _get_or_build(kind, mess_id, year, month, build):
+    cache = _cache()
+    key = _report_key(kind, mess_id, year, month)
+    value = cache.get(key)
+    if value is None:
+        # Built from the primary: a lagging replica would store stale data
+        # under the version its write just bumped, for every user
+        with primary():
+            value = build()
+        cache.set(key, value, _timeout())
+    return value
+
+
+def cached_settlement(mess, year, month):
+    """monthly_settlement served from the cache while the month's data is unchanged"""
+    return _get_or_build('settlement', mess.id, year, month, lambda: monthly_settlement(mess, year, month))
+
+
+def cached_mess_totals(mess, year, month):
+    """
+    Meal, expense and deposit totals and the meal rate of a mess-month,
+    shared by every member's dashboard while the month's data is unchanged.
+    """
+    def build():
+        totals = mess_totals(mess, year, month)
+        meals = totals['total_meals']
+        totals['meal_rate'] = totals['total_expense'] / meals if meals > 0 else 0
+        return totals
+    return _get_or_build('totals', mess.id, year, month, build)
+
+
+def cached_range_settlement(mess, months):
+    """range_settlement served from the cache while none of the months' data changed"""
+    (start_year, start_month), (end_year, end_month) = months[0], months[-1]
+    key = (f'report:range:{mess.id}:{start_year}-{start_month}:{end_year}-{end_month}:'
+           f'{range_version(mess.id, months)}')
+    cache = _cache()
+    value = cache.get(key)
+    if value is None:
+        with primary():
+            value = range_settlement(mess, months)
+        cache.set(key, value, _timeout())
+    return value
+
+
+def cached_pdf(mess, year, month, render):
+    """Rendered PDF bytes of a monthly report; render() is only called on a cache miss"""
+    return _get_or_build('pdf', mess.id, year, month, render)
+
+
+def report_job_id(mess_id, year, month, version):
+    """Id of the ReportJob queued for the month's data of the given version, if any"""
+    return _cache().get(_report_key('job', mess_id, year, month, version))
+
+
+def remember_report_job(mess_id, year, month, version, job_id):
+    """Record that job_id was queued once the month's data had the given version"""
+    _cache().set(_report_key('job', mess_id, year, month, version), job_id, _timeout())
@@ -0,0 +1,136 @@
+from datetime import timedelta
+from io import BytesIO
+from django.core.files.base import ContentFile
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from xhtml2pdf import pisa
+from .models import Expense, Deposit, Mess, ReportJob
+from .replicas import primary
+from .report_cache import data_version, remember_report_job, report_job_id
+from .settlement import month_bounds, monthly_settlement
+from .shards import mess_atomic
+
+
+def render_report_pdf(mess, year, month):
+    """
+    Render the monthly report of a mess and return the PDF bytes. Reads the
+    database directly: report workers have no view of the web processes'
+    cache versions, so anything they cached could be stale.
+    """
+    first_day, last_day = month_bounds(year, month)
+
+    expenses = Expense.objects.filter(mess=mess, date__range=[first_day, last_day]).select_related('created_by')
+    deposits = Deposit.objects.filter(mess=mess, date__range=[first_day, last_day]).select_related('user')
+    settlement = monthly_settlement(mess, year, month)
+
+    context = {
+        'mess': mess,
+        'month': first_day.strftime("%B %Y"),
+        'selected_month': month,
+        'selected_year': year,
+        'expenses': expenses,
+        'deposits': deposits,
+        **settlement,
+    }
+
+    html_string = render_to_string('core/manager/report_pdf_simple.html', context)
+    result = BytesIO()
+    pdf = pisa.pisaDocument(BytesIO(html_string.encode("UTF-8")), result)
+    if pdf.err:
+        raise ValueError(pdf.err)
+    return result.getvalue()
+
+
+def report_filename(mess, year, month):
+    return f"{mess.name}_report_{month}_{year}.pdf"
+
+
+def request_report(mess, year, month, user=None):
+    """
+    Return the job producing this month's report. A finished job queued
+    since the data last changed is reused, otherwise requests for the same
+    mess-month share one queued or running job.
+    """
+    # Jobs are looked up right after being queued, so never on a replica
+    with primary():
+        # Read before queueing: a job renders data at least this new
+        version = data_version(mess.id, year, month)
+        job_id = report_job_id(mess.id, year, month, version)
+        if job_id:
+            job = ReportJob.objects.filter(id=job_id, status='done').first()
+            if job and job.file and job.file.storage.exists(job.file.name):
+                return job
+
+        active = ReportJob.objects.filter(mess=mess, year=year, month=month, status__in=ReportJob.ACTIVE_STATUSES)
+        for _ in range(2):
+            job = active.first()
+            if job:
+                return job
+            try:
+                with mess_atomic():
+                    job = ReportJob.objects.create(mess=mess, year=year, month=month, requested_by=user)
+            except IntegrityError:
+                # A concurrent request queued the same report first
+                continue
+            remember_report_job(mess.id, year, month, version, job.id)
+            return job
+        return active.get()
+
+
+def claim_report_jobs(worker_id, limit, claim_timeout=600):
+    """
+    Move up to `limit` queued jobs to running for this worker. Jobs left
+    running by a worker that stopped more than claim_timeout seconds ago
+    are picked up again. Jobs of messes being moved to another shard wait.
+    """
+    now = timezone.now()
+    moving = list(Mess.objects.using(DEFAULT_DB_ALIAS).filter(shard_locked=True).values_list('id', flat=True))
+    available = ReportJob.objects.filter(
+        models.Q(status='queued') |
+        models.Q(status='running', started_at__lt=now - timedelta(seconds=claim_timeout))
+    ).exclude(mess_id__in=moving)
+    ids = list(available.order_by('created_at').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+
+    # The conditional UPDATE only succeeds for jobs nobody else claimed meanwhile
+    available.filter(id__in=ids).update(status='running', claimed_by=worker_id, started_at=now)
+    return list(ReportJob.objects.filter(id__in=ids, claimed_by=worker_id, started_at=now))
+
+
+def run_report_job(job_id):
+    """Render a claimed job's PDF, store it and mark the job done"""
+    job = ReportJob.objects.select_related('mess').get(id=job_id)
+    content = render_report_pdf(job.mess, job.year, job.month)
+
+    name = job.file.storage.save(
+        f'reports/{job.mess_id}/{job.year}-{job.month:02d}-{job.id}.pdf', ContentFile(content)
+    )
+    ReportJob.objects.filter(id=job.id).update(
+        status='done', file=name, error='', finished_at=timezone.now()
+    )
+    return name
+
+
+def fail_report_job(job_id, error):
+    ReportJob.objects.filter(id=job_id).update(
+        status='failed', error=str(error)[:1000], finished_at=timezone.now()
+    )
+
+
+def report_job_json(job):
+    data = {
+        'id': job.id,
+        'status': job.status,
+        'year': job.year,
+        'month': job.month,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'download_url': None,
+        'error': job.error or None,
+    }
+    if job.status == 'done':
+        data['download_url'] = reverse('download_report_job', args=[job.mess_id, job.id])
+    return data
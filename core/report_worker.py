@@ -0,0 +1,17 @@
+"""
+Entry points of the run_report_worker process pool. This module does not
+import models at load time, spawned processes import it before Django is
+set up.
+"""
+import django
+
+
+def setup_process():
+    django.setup()
+
+
+def render_job(job_id, shard='default'):
+    from .report_jobs import run_report_job
+    from .shards import use_shard
+    with use_shard(shard):
+        return run_report_job(job_id)
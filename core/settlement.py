@@ -0,0 +1,268 @@
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+from django.db import models
+from .models import Membership, Meal, Expense, Deposit, MonthlyLedger
+
+
+def month_bounds(year, month):
+    """Return the first and last day of the given month"""
+    first_day = date(year, month, 1)
+    if month == 12:
+        last_day = date(year + 1, 1, 1) - timedelta(days=1)
+    else:
+        last_day = date(year, month + 1, 1) - timedelta(days=1)
+    return first_day, last_day
+
+
+MAX_RANGE_MONTHS = 60
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def previous_month(year, month):
+    return (year - 1, 12) if month == 1 else (year, month - 1)
+
+
+def months_between(start_year, start_month, end_year, end_month):
+    """(year, month) pairs from the start month through the end month"""
+    months = []
+    year, month = start_year, start_month
+    while (year, month) <= (end_year, end_month):
+        months.append((year, month))
+        year, month = next_month(year, month)
+    return months
+
+
+def parse_month_range(params, today=None):
+    """
+    Read a range of months from request parameters: `start` and `end`
+    (YYYY-MM), `year` with `quarter` (1-4), or `year` alone for the whole
+    year. Defaults to the current month. Raises ValueError on bad input.
+    """
+    today = today or date.today()
+    if params.get('start') or params.get('end'):
+        start = params.get('start') or params.get('end')
+        end = params.get('end') or start
+        start_year, start_month = (int(part) for part in start.split('-'))
+        end_year, end_month = (int(part) for part in end.split('-'))
+    elif params.get('year') and params.get('quarter'):
+        quarter = int(params['quarter'])
+        if not 1 <= quarter <= 4:
+            raise ValueError('Invalid quarter')
+        start_year = end_year = int(params['year'])
+        start_month, end_month = quarter * 3 - 2, quarter * 3
+    elif params.get('year'):
+        start_year = end_year = int(params['year'])
+        start_month, end_month = 1, 12
+    else:
+        start_year = end_year = today.year
+        start_month = end_month = today.month
+
+    if not (1 <= start_month <= 12 and 1 <= end_month <= 12):
+        raise ValueError('Invalid month')
+    months = months_between(start_year, start_month, end_year, end_month)
+    if not months:
+        raise ValueError('The start month is after the end month')
+    if len(months) > MAX_RANGE_MONTHS:
+        raise ValueError(f'At most {MAX_RANGE_MONTHS} months can be selected at once')
+    return months
+
+
+def report_years(mess, minimum=3):
+    """Years from the mess's first recorded month, or at least the last `minimum` years, through this year"""
+    current_year = date.today().year
+    first_year = MonthlyLedger.objects.filter(mess=mess).aggregate(first=models.Min('year'))['first']
+    return list(range(min(first_year or current_year, current_year - minimum + 1), current_year + 1))
+
+
+def month_range_filter(months):
+    """Filter on the year/month columns matching a continuous range of months"""
+    (start_year, start_month), (end_year, end_month) = months[0], months[-1]
+    if start_year == end_year:
+        return models.Q(year=start_year, month__range=(start_month, end_month))
+    return (
+        models.Q(year=start_year, month__gte=start_month) |
+        models.Q(year__gt=start_year, year__lt=end_year) |
+        models.Q(year=end_year, month__lte=end_month)
+    )
+
+
+def meal_total_expression():
+    return models.F('breakfast') + models.F('lunch') + models.F('dinner')
+
+
+def build_settlement(mess, meal_totals, deposit_totals, total_expense):
+    """Turn per-user meal and deposit totals into a settlement"""
+    grand_total_meals = sum(total or 0 for total in meal_totals.values())
+    total_deposit = sum(total or 0 for total in deposit_totals.values())
+    meal_rate = total_expense / grand_total_meals if grand_total_meals > 0 else 0
+
+    member_reports = []
+    for member in Membership.objects.filter(mess=mess).select_related('user'):
+        total_meal = meal_totals.get(member.user_id) or 0
+        total_cost = total_meal * meal_rate
+        member_deposit = deposit_totals.get(member.user_id) or 0
+        balance = member_deposit - total_cost
+
+        member_reports.append({
+            'user': member.user,
+            'total_meal': total_meal,
+            'total_cost': total_cost,
+            'total_deposit': member_deposit,
+            'balance': balance,
+            'role': member.role
+        })
+
+    return {
+        'grand_total_meals': grand_total_meals,
+        'total_expense': total_expense,
+        'total_deposit': total_deposit,
+        'meal_rate': meal_rate,
+        'member_reports': member_reports,
+    }
+
+
+def range_settlement(mess, months, opening=None):
+    """
+    Settlement of a mess over a continuous range of months. Every month is
+    settled at its own meal rate and member balances are carried from one
+    month to the next, starting from the `opening` balances (user id to
+    amount) if given. Besides the usual totals the result has a `trend`
+    series with one entry per month, and each member report has the
+    `carried_forward` opening balance, a `running_balance` list and the
+    per-month figures in `monthly`.
+
+    Uses one grouped query per table on the year/month columns, however
+    many months the range covers.
+    """
+    in_range = month_range_filter(months)
+    meals = defaultdict(dict)
+    for year, month, user_id, total in (
+        Meal.objects.filter(in_range, mess=mess)
+        .values('year', 'month', 'user')
+        .order_by()
+        .annotate(total=models.Sum(meal_total_expression()))
+        .values_list('year', 'month', 'user', 'total')
+    ):
+        meals[(year, month)][user_id] = total or 0
+    deposits = defaultdict(dict)
+    for year, month, user_id, total in (
+        Deposit.objects.filter(in_range, mess=mess)
+        .values('year', 'month', 'user')
+        .order_by()
+        .annotate(total=models.Sum('amount'))
+        .values_list('year', 'month', 'user', 'total')
+    ):
+        deposits[(year, month)][user_id] = total or 0
+    expenses = {
+        (year, month): total or 0
+        for year, month, total in (
+            Expense.objects.filter(in_range, mess=mess)
+            .values('year', 'month')
+            .order_by()
+            .annotate(total=models.Sum('amount'))
+            .values_list('year', 'month', 'total')
+        )
+    }
+
+    opening = opening or {}
+    member_reports = {
+        member.user_id: {
+            'user': member.user,
+            'total_meal': 0,
+            'total_cost': Decimal('0'),
+            'total_deposit': Decimal('0'),
+            'carried_forward': Decimal(opening.get(member.user_id, 0)),
+            'balance': Decimal(opening.get(member.user_id, 0)),
+            'role': member.role,
+            'running_balance': [],
+            'monthly': [],
+        }
+        for member in Membership.objects.filter(mess=mess).select_related('user')
+    }
+
+    trend = []
+    for year, month in months:
+        month_meals = meals[(year, month)]
+        month_deposits = deposits[(year, month)]
+        total_meals = sum(month_meals.values())
+        total_expense = Decimal(expenses.get((year, month), 0))
+        meal_rate = total_expense / total_meals if total_meals > 0 else Decimal('0')
+
+        trend.append({
+            'year': year,
+            'month': month,
+            'label': date(year, month, 1).strftime('%b %Y'),
+            'total_meals': total_meals,
+            'total_expense': total_expense,
+            'total_deposit': sum(month_deposits.values(), Decimal('0')),
+            'meal_rate': meal_rate,
+        })
+
+        for user_id, report in member_reports.items():
+            total_meal = month_meals.get(user_id, 0)
+            deposit = month_deposits.get(user_id, 0)
+            cost = total_meal * meal_rate
+            report['total_meal'] += total_meal
+            report['total_cost'] += cost
+            report['total_deposit'] += deposit
+            report['balance'] += deposit - cost
+            report['running_balance'].append(report['balance'])
+            report['monthly'].append({'meals': total_meal, 'cost': cost, 'deposit': deposit, 'balance': report['balance']})
+
+    grand_total_meals = sum(entry['total_meals'] for entry in trend)
+    total_expense = sum((entry['total_expense'] for entry in trend), Decimal('0'))
+    return {
+        'grand_total_meals': grand_total_meals,
+        'total_expense': total_expense,
+        'total_deposit': sum((entry['total_deposit'] for entry in trend), Decimal('0')),
+        'meal_rate': total_expense / grand_total_meals if grand_total_meals > 0 else 0,
+        'member_reports': list(member_reports.values()),
+        'trend': trend,
+    }
+
+
+def monthly_settlement(mess, year, month):
+    """
+    Settlement of a mess for a single calendar month, read from the
+    monthly ledger instead of the month's transactions.
+    """
+    meal_totals = {}
+    deposit_totals = {}
+    total_expense = 0
+    for row in MonthlyLedger.objects.filter(mess=mess, year=year, month=month):
+        if row.user_id is None:
+            total_expense = row.expense
+        else:
+            meal_totals[row.user_id] = row.meals
+            deposit_totals[row.user_id] = row.deposit
+    return build_settlement(mess, meal_totals, deposit_totals, total_expense)
+
+
+def mess_totals(mess, year=None, month=None):
+    """
+    Headline meal, expense and deposit totals of a mess in one aggregate
+    query over the monthly ledger. Without a year and month the totals
+    cover the whole history of the mess.
+    """
+    rows = MonthlyLedger.objects.filter(mess=mess)
+    if year is not None and month is not None:
+        rows = rows.filter(year=year, month=month)
+    totals = rows.aggregate(
+        total_meals=models.Sum('meals'),
+        total_expense=models.Sum('expense'),
+        total_deposit=models.Sum('deposit'),
+    )
+    return {key: value or 0 for key, value in totals.items()}
+
+
+def member_totals(mess, user, year, month):
+    """A member's meal and deposit totals for one month, read from their ledger row"""
+    row = MonthlyLedger.objects.filter(mess=mess, user=user, year=year, month=month).values('meals', 'deposit').first()
+    return {
+        'total_meal': row['meals'] if row else 0,
+        'total_deposit': row['deposit'] if row else 0,
+    }
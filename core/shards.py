@@ -0,0 +1,232 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from .models import CustomUser, Mess
+
+# Models holding the data of one mess. They live in the database the mess
+# is mapped to by Mess.shard; users, messes, memberships and notifications
+# stay in the default (directory) database.
+SHARDED_MODELS = (
+    'core.monthlyledger', 'core.monthsnapshot', 'core.meal', 'core.expense',
+    'core.deposit', 'core.message', 'core.reportjob',
+)
+
+_current_shard = ContextVar('mess_shard', default=None)
+
+
+class MessMovingError(ValueError):
+    """Raised when the data of a mess is written while rebalance_shard moves it"""
+
+
+def shard_aliases():
+    """Every database alias messes can live in, the default database first"""
+    return list(getattr(settings, 'MESS_SHARDS', [DEFAULT_DB_ALIAS]))
+
+
+def sharded_models():
+    return [apps.get_model(label) for label in SHARDED_MODELS]
+
+
+def current_alias():
+    """Database holding the mess data of the current request or command"""
+    return _current_shard.get() or DEFAULT_DB_ALIAS
+
+
+def shard_of(mess_id):
+    return Mess.objects.using(DEFAULT_DB_ALIAS).filter(id=mess_id).values_list('shard', flat=True).first() \
+        or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_shard(alias):
+    """Route the mess data queries of the block to the given alias"""
+    token = _current_shard.set(alias)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+def mess_shard(mess):
+    return use_shard(mess.shard)
+
+
+def check_not_moving(mess_id):
+    """Raise MessMovingError if the mess is locked for a move, as read from the directory now"""
+    if Mess.objects.using(DEFAULT_DB_ALIAS).filter(id=mess_id, shard_locked=True).exists():
+        raise MessMovingError('This mess is being moved to another database, please try again in a minute.')
+
+
+def shard_bound(rows):
+    """
+    Iterate rows in the shard current now. For lazy iterators consumed
+    after the view returned, such as streamed responses.
+    """
+    alias = _current_shard.get()
+    iterator = iter(rows)
+    while True:
+        with use_shard(alias):
+            try:
+                row = next(iterator)
+            except StopIteration:
+                return
+        yield row
+
+
+def assign_shard():
+    """Shard for a new mess: the configured alias holding the fewest messes"""
+    aliases = shard_aliases()
+    if len(aliases) == 1:
+        return aliases[0]
+    counts = dict(Mess.objects.filter(shard__in=aliases).values_list('shard').annotate(total=models.Count('id')))
+    return min(aliases, key=lambda alias: counts.get(alias, 0))
+
+
+@contextmanager
+def mess_atomic():
+    """
+    A transaction on the directory and, when it is another database, on the
+    current mess shard. The shard commits first; the two are not atomic
+    with each other.
+    """
+    alias = current_alias()
+    with transaction.atomic():
+        if alias == DEFAULT_DB_ALIAS:
+            yield
+        else:
+            with transaction.atomic(using=alias):
+                yield
+
+
+def in_atomic_block():
+    return connections[DEFAULT_DB_ALIAS].in_atomic_block or connections[current_alias()].in_atomic_block
+
+
+def on_commit(func):
+    """Run func once the open directory or shard transaction commits"""
+    using = DEFAULT_DB_ALIAS if connections[DEFAULT_DB_ALIAS].in_atomic_block else current_alias()
+    transaction.on_commit(func, using=using)
+
+
+def last_id(alias, model):
+    """Last id the model's table in alias handed out, 0 if none or unknown"""
+    connection = connections[alias]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, model._meta.pk.column])
+            sequence = cursor.fetchone()[0]
+            if sequence is None:
+                return 0
+            cursor.execute(f'SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {sequence}')
+        else:
+            return 0
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def set_last_id(alias, model, value):
+    """Make the model's table in alias hand out ids after value"""
+    connection = connections[alias]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [value, table])
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, value])
+        elif connection.vendor == 'postgresql' and value:
+            cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), %s)', [table, model._meta.pk.column, value])
+
+
+def reserve_ids(alias):
+    """
+    Number the mess data rows of a shard from its SHARD_ID_STARTS entry, so
+    ids are unique across shards and a moved mess keeps its row ids
+    """
+    start = getattr(settings, 'SHARD_ID_STARTS', {}).get(alias)
+    if not start:
+        return
+    for model in sharded_models():
+        if last_id(alias, model) < start:
+            set_last_id(alias, model, start)
+
+
+def _row_fields(instance, exclude=()):
+    return {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in exclude
+    }
+
+
+def copy_users(alias, users):
+    """
+    Keep copies of the users in a shard so mess data can reference and join
+    them there. Copies carry no usable password.
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    for user in users:
+        CustomUser.objects.using(alias).update_or_create(
+            pk=user.pk, defaults={**_row_fields(user, exclude=('password',)), 'password': '!'}
+        )
+
+
+def copy_mess(mess, alias=None):
+    """Copy the mess row and its members into the shard it is mapped to, or into alias"""
+    alias = alias or mess.shard
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    Mess.objects.using(alias).update_or_create(pk=mess.pk, defaults=_row_fields(mess))
+    users = CustomUser.objects.using(DEFAULT_DB_ALIAS).filter(membership__mess=mess)
+    copy_users(alias, users)
+
+
+class ShardRouter:
+    """
+    Sends the queries of SHARDED_MODELS to the shard of their mess: the
+    alias of a Mess or mess-data instance in the hints, else the shard set
+    with use_shard() (mess_member_required sets it for mess views), else
+    the mess of a new row. Everything on the default shard is left to the
+    next router. Other models reached from a row of a shard, such as
+    meal.user, are read from the directory rather than the shard's copies.
+    """
+
+    def _shard(self, model, hints):
+        if model._meta.apps is not apps:
+            # Historical models of a migration stay on the database being migrated
+            return None
+        instance = hints.get('instance')
+        if model._meta.label_lower not in SHARDED_MODELS:
+            if instance is not None and instance._state.db in shard_aliases()[1:]:
+                return DEFAULT_DB_ALIAS
+            return None
+        if isinstance(instance, Mess):
+            alias = instance.shard
+        elif instance is not None and instance._meta.label_lower in SHARDED_MODELS and not instance._state.adding:
+            alias = instance._state.db
+        elif _current_shard.get() is None and getattr(instance, 'mess_id', None) is not None:
+            alias = shard_of(instance.mess_id)
+        else:
+            alias = _current_shard.get()
+        if alias == DEFAULT_DB_ALIAS:
+            return None
+        return alias
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Shards hold copies of the messes and users their rows point to
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Every shard has the full schema
+        return None
@@ -1,12 +1,89 @@
-from django.db.models.signals import post_save
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, post_migrate
 from django.dispatch import receiver
-from .models import Meal, Expense, Deposit, Membership
-from .views import create_notification
+from .models import CustomUser, Meal, Expense, Deposit, Mess, Membership, Message
+from .notifications import queue_notification
+from . import access, closing, ledger, realtime, report_cache, shards
+
+@receiver(pre_save, sender=Meal)
+@receiver(pre_save, sender=Expense)
+@receiver(pre_save, sender=Deposit)
+def refuse_closed_month_changes(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    ledger.remember_stored(instance)
+    shards.check_not_moving(instance.mess_id)
+    closing.check_instance_open(instance)
+
+@receiver(post_save, sender=Meal)
+@receiver(post_save, sender=Expense)
+@receiver(post_save, sender=Deposit)
+def update_monthly_ledger(sender, instance, created, **kwargs):
+    if kwargs.get('raw'):
+        return
+    report_cache.invalidate_instance(instance)
+    ledger.record_saved(instance, created)
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def invalidate_mess_reports(sender, instance, **kwargs):
+    report_cache.invalidate_mess(instance.mess_id)
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def invalidate_cached_membership(sender, instance, **kwargs):
+    access.invalidate_memberships(instance.mess_id)
+
+@receiver(post_save, sender=Mess)
+@receiver(post_delete, sender=Mess)
+def invalidate_cached_mess(sender, instance, **kwargs):
+    access.invalidate_memberships(instance.id)
+
+# Shards keep copies of their messes and of the members' users, which the
+# mess data references. Saves of the copies themselves are ignored.
+@receiver(post_save, sender=Mess)
+def copy_mess_to_shard(sender, instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS and not kwargs.get('raw'):
+        shards.copy_mess(instance)
+
+@receiver(post_migrate)
+def reserve_shard_ids(sender, using, **kwargs):
+    if sender.name == 'core':
+        shards.reserve_ids(using)
+
+@receiver(post_save, sender=Membership)
+def copy_member_to_shard(sender, instance, created, using, **kwargs):
+    if created and using == DEFAULT_DB_ALIAS and not kwargs.get('raw'):
+        shards.copy_users(instance.mess.shard, [instance.user])
+
+@receiver(post_save, sender=CustomUser)
+def update_user_copies(sender, instance, created, using, update_fields=None, **kwargs):
+    if created or using != DEFAULT_DB_ALIAS or kwargs.get('raw'):
+        return
+    if update_fields and set(update_fields) <= {'last_login', 'password', 'unread_notifications'}:
+        return
+    for alias in set(Mess.objects.filter(membership__user=instance).values_list('shard', flat=True)):
+        shards.copy_users(alias, [instance])
+
+@receiver(pre_delete, sender=Mess)
+def delete_mess_from_shard(sender, instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS and instance.shard != DEFAULT_DB_ALIAS:
+        with shards.mess_shard(instance):
+            Mess.objects.using(instance.shard).filter(pk=instance.pk).delete()
+
+@receiver(pre_delete, sender=CustomUser)
+def delete_user_copies(sender, instance, using, **kwargs):
+    if using != DEFAULT_DB_ALIAS:
+        return
+    for alias in shards.shard_aliases():
+        if alias != DEFAULT_DB_ALIAS:
+            with shards.use_shard(alias):
+                CustomUser.objects.using(alias).filter(pk=instance.pk).delete()
 
 @receiver(post_save, sender=Meal)
 def meal_created_notification(sender, instance, created, **kwargs):
     if created:
-        create_notification(
+        queue_notification(
             user=instance.user,
             title='Meal Entry Added',
             message=f'Meal entry added for {instance.date}: B{instance.breakfast}, L{instance.lunch}, D{instance.dinner}',
@@ -17,20 +94,17 @@ def meal_created_notification(sender, instance, created, **kwargs):
 @receiver(post_save, sender=Expense)
 def expense_created_notification(sender, instance, created, **kwargs):
     if created:
-        members = Membership.objects.filter(mess=instance.mess)
-        for member in members:
-            create_notification(
-                user=member.user,
-                title='New Expense Added',
-                message=f'New expense: ৳{instance.amount} - {instance.description}',
-                notification_type='warning',
-                mess=instance.mess
-            )
+        queue_notification(
+            title='New Expense Added',
+            message=f'New expense: ৳{instance.amount} - {instance.description}',
+            notification_type='warning',
+            mess=instance.mess
+        )
 
 @receiver(post_save, sender=Deposit)
 def deposit_created_notification(sender, instance, created, **kwargs):
     if created:
-        create_notification(
+        queue_notification(
             user=instance.user,
             title='Deposit Recorded',
             message=f'Deposit of ৳{instance.amount} recorded on {instance.date}',
@@ -38,17 +112,43 @@ def deposit_created_notification(sender, instance, created, **kwargs):
             mess=instance.mess
         )
 
+@receiver(post_save, sender=Message)
+def push_new_message(sender, instance, created, **kwargs):
+    if created and not kwargs.get('raw'):
+        realtime.publish_message(instance)
 
+from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from .models import Membership, Meal, Deposit, Message
 
+@receiver(pre_delete, sender=Meal)
+@receiver(pre_delete, sender=Expense)
+@receiver(pre_delete, sender=Deposit)
+def remove_from_monthly_ledger(sender, instance, origin=None, **kwargs):
+    origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    if origin is None or origin_model is sender:
+        # Deleting a mess or user takes its closed months' rows and snapshots with it
+        shards.check_not_moving(instance.mess_id)
+        closing.check_instance_open(instance)
+    report_cache.invalidate_instance(instance)
+    ledger.record_deleted(instance)
+
 @receiver(pre_delete, sender=Membership)
 def delete_member_data(sender, instance, **kwargs):
-   
+    """Delete a leaving member's meals and deposits, except those of closed months"""
     user = instance.user
     mess = instance.mess
 
-    Meal.objects.filter(user=user, mess=mess).delete()
-    Deposit.objects.filter(user=user, mess=mess).delete()
+    meals = Meal.objects.filter(user=user, mess=mess)
+    deposits = Deposit.objects.filter(user=user, mess=mess)
+    last_closed = closing.last_closed_month(mess.id)
+    if last_closed:
+        # Rows of closed months stay, their snapshots are final
+        open_months = models.Q(year__gt=last_closed[0]) | models.Q(year=last_closed[0], month__gt=last_closed[1])
+        meals = meals.filter(open_months)
+        deposits = deposits.filter(open_months)
+
+    meals.delete()
+    deposits.delete()
     print(f"Deleted all data for user {user.username} from mess {mess.name}")
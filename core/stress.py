@@ -0,0 +1,80 @@
+import threading
+import time
+from datetime import date
+from django.db import OperationalError, connections
+from .database import run_with_retry
+from .instrumentation import percentiles
+from .models import Meal, Message
+from .settlement import mess_totals
+from .shards import mess_shard
+
+
+def _write(mess, user_id, index):
+    Message.objects.create(mess=mess, user_id=user_id, content=f'Stress message {index}')
+    today = date.today()
+    Meal.objects.update_or_create(
+        user_id=user_id, mess=mess, date=today,
+        defaults={'breakfast': index % 2, 'lunch': index % 3, 'dinner': 1},
+    )
+
+
+def _read(mess):
+    list(Message.objects.filter(mess=mess).select_related('user').order_by('-created_at', '-id')[:50])
+    today = date.today()
+    mess_totals(mess, today.year, today.month)
+
+
+def run_stress(mess, seconds=10, writers=4, readers=8):
+    """
+    Hammer the database from writer and reader threads for the given
+    number of seconds. Writers post a chat message and upsert a meal in one
+    retried transaction, as the add_meal and messages views do; readers load
+    the latest messages and the month's totals. Returns throughput, latency
+    percentiles and the errors seen per role.
+    """
+    user_ids = list(mess.membership_set.values_list('user_id', flat=True))
+    deadline = time.perf_counter() + seconds
+    results = {role: {'ops': 0, 'errors': 0, 'latency_ms': []} for role in ('write', 'read')}
+    lock = threading.Lock()
+
+    def worker(role, number):
+        latencies = []
+        ops = errors = 0
+        try:
+            with mess_shard(mess):
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        if role == 'write':
+                            run_with_retry(_write, mess, user_ids[number % len(user_ids)], ops)
+                        else:
+                            _read(mess)
+                        ops += 1
+                        latencies.append((time.perf_counter() - start) * 1000)
+                    except OperationalError:
+                        errors += 1
+        finally:
+            connections.close_all()
+            with lock:
+                results[role]['ops'] += ops
+                results[role]['errors'] += errors
+                results[role]['latency_ms'] += latencies
+
+    threads = [threading.Thread(target=worker, args=('write', i)) for i in range(writers)]
+    threads += [threading.Thread(target=worker, args=('read', i)) for i in range(readers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        role: {
+            'ops': result['ops'],
+            'ops_per_second': round(result['ops'] / elapsed, 1),
+            'errors': result['errors'],
+            'latency_ms': percentiles(result['latency_ms']),
+        }
+        for role, result in results.items()
+    }
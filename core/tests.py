@@ -1,3 +1,1331 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+import zipfile
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, connection, connections, router, transaction
+from django.db.migrations.loader import MigrationLoader
+import shutil
+import tempfile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .access import invalidate_memberships
+from .benchmark import BENCHMARK_VIEWS, HOT_PATH_INDEXES, hot_queries
+from .instrumentation import view_metrics
+from .ledger import rebuild_ledger
+from .models import CustomUser, Mess, Membership, Meal, Expense, Deposit, Message, Notification, NotificationOutbox, MonthSnapshot, MonthlyLedger, ReportJob
+from .bulk import upsert_meals
+from .database import run_with_retry
+from .replicas import primary, reads_from_replica
+from .imports import LedgerImportError, import_ledger
+from .closing import MonthClosedError, close_month, opening_balances, snapshot_settlement
+from .report_cache import cached_settlement
+from .settlement import monthly_settlement, months_between, range_settlement
+from .rebalance import ShardMoveError, move_mess
+from .shards import MessMovingError, set_last_id
+from .report_jobs import claim_report_jobs, fail_report_job, request_report, run_report_job
+from .notifications import (
+    claim_outbox_batch, deliver_outbox, mark_read, notification_page, notify_users,
+    purge_read_notifications, reconcile_unread_counts,
+)
 
 
+class ExpenseNotificationTests(TestCase):
+    def setUp(self):
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+
+    def create_mess(self, name, member_count):
+        mess = Mess.objects.create(name=name, address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=mess, role='manager')
+        for i in range(member_count):
+            user = CustomUser.objects.create_user(username=f'{name}-member-{i}', password='pass')
+            Membership.objects.create(user=user, mess=mess)
+        return mess
+
+    def add_expense(self, mess):
+        with CaptureQueriesContext(connection) as queries:
+            Expense.objects.create(mess=mess, amount=100, description='Rice', created_by=self.manager)
+        return len(queries)
+
+    def test_every_member_is_notified(self):
+        mess = self.create_mess('small', 3)
+        self.add_expense(mess)
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+        deliver_outbox(claim_outbox_batch('worker'))
+        self.assertEqual(Notification.objects.filter(mess=mess, title='New Expense Added').count(), 4)
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_query_count_does_not_grow_with_members(self):
+        small = self.create_mess('small', 2)
+        large = self.create_mess('large', 40)
+        self.add_expense(small)
+        self.add_expense(large)
+
+        self.assertEqual(self.add_expense(small), self.add_expense(large))
+        deliver_outbox(claim_outbox_batch('worker'))
+        self.assertEqual(Notification.objects.filter(mess=large).count(), 41 * 2)
+
+
+class NotificationOutboxTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='member', password='pass')
+        for i in range(5):
+            NotificationOutbox.objects.create(user=self.user, title=f'Title {i}', message='Message')
+
+    def test_workers_claim_disjoint_rows(self):
+        first = claim_outbox_batch('worker-1', batch_size=3)
+        second = claim_outbox_batch('worker-2', batch_size=3)
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({entry.id for entry in first} & {entry.id for entry in second})
+        self.assertEqual(claim_outbox_batch('worker-3'), [])
+
+    def test_stale_claims_are_retried(self):
+        claim_outbox_batch('crashed-worker')
+        self.assertEqual(claim_outbox_batch('worker', claim_timeout=300), [])
+        self.assertEqual(len(claim_outbox_batch('worker', claim_timeout=-1)), 5)
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='member', password='pass')
+
+    def unread(self):
+        self.user.refresh_from_db()
+        return self.user.unread_notifications
+
+    def test_counter_follows_creation_and_reads(self):
+        notify_users([self.user.id, self.user.id], 'Title', 'Message')
+        NotificationOutbox.objects.create(user=self.user, title='Queued', message='Message')
+        deliver_outbox(claim_outbox_batch('worker'))
+        self.assertEqual(self.unread(), 3)
+
+        first = Notification.objects.filter(user=self.user).first()
+        mark_read(self.user, Notification.objects.filter(id=first.id))
+        mark_read(self.user, Notification.objects.filter(id=first.id))
+        self.assertEqual(self.unread(), 2)
+
+        mark_read(self.user, Notification.objects.all())
+        self.assertEqual(self.unread(), 0)
+        self.assertEqual(reconcile_unread_counts(check_only=True), [])
+
+    def test_reconcile_fixes_drift(self):
+        notify_users([self.user.id], 'Title', 'Message')
+        CustomUser.objects.filter(id=self.user.id).update(unread_notifications=7)
+
+        self.assertEqual(reconcile_unread_counts(), [(self.user.id, 7, 1)])
+        self.assertEqual(self.unread(), 1)
+
+
+class NotificationPageTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='member', password='pass')
+        notify_users([self.user.id] * 25, 'Title', 'Message')
+        self.client.force_login(self.user)
+
+    def test_keyset_pages_cover_every_notification_once(self):
+        first, cursor = notification_page(self.user, page_size=10)
+        second, cursor = notification_page(self.user, cursor, page_size=10)
+        third, cursor = notification_page(self.user, cursor, page_size=10)
+
+        ids = [n.id for n in first + second + third]
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(len(set(ids)), 25)
+        self.assertIsNone(cursor)
+
+    def test_only_displayed_notifications_are_marked_read(self):
+        response = self.client.get(reverse('notifications'))
+        self.assertEqual(Notification.objects.filter(user=self.user, is_read=False).count(), 5)
+
+        response = self.client.get(reverse('notifications_page'), {'cursor': response.context['next_cursor']})
+        data = response.json()
+        self.assertEqual(len(data['notifications']), 5)
+        self.assertIsNone(data['next_cursor'])
+        self.assertEqual(data['unread_count'], 0)
+
+    def test_purge_only_removes_old_read_notifications(self):
+        Notification.objects.filter(id__in=Notification.objects.values('id')[:10]).update(is_read=True)
+        Notification.objects.update(created_at=timezone.now() - timedelta(days=100))
+        archive = StringIO()
+
+        deleted = purge_read_notifications(timezone.now() - timedelta(days=90), batch_size=3, archive=archive)
+
+        self.assertEqual(deleted, 10)
+        self.assertEqual(len(archive.getvalue().splitlines()), 10)
+        self.assertEqual(Notification.objects.count(), 15)
+
+
+class BulkMealEntryTests(TestCase):
+    def setUp(self):
+        self.mess = Mess.objects.create(name='Mess', address='Dhaka')
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        self.members = [self.manager]
+        for i in range(5):
+            user = CustomUser.objects.create_user(username=f'member-{i}', password='pass')
+            Membership.objects.create(user=user, mess=self.mess)
+            self.members.append(user)
+        self.client.force_login(self.manager)
+        self.url = reverse('add_meals_bulk', args=[self.mess.id])
+
+    def grid(self, users, breakfast=1, lunch=2, dinner=2, **extra):
+        data = {'date': '2025-03-30', 'user': [user.id for user in users], **extra}
+        for user in users:
+            data.update({f'breakfast_{user.id}': breakfast, f'lunch_{user.id}': lunch, f'dinner_{user.id}': dinner})
+        return data
+
+    def test_records_a_date_range_for_every_member(self):
+        Meal.objects.create(user=self.members[1], mess=self.mess, date=date(2025, 3, 31), lunch=1)
+
+        self.client.post(self.url, self.grid(self.members, end_date='2025-04-02'))
+
+        self.assertEqual(Meal.objects.filter(mess=self.mess).count(), 6 * 4)
+        self.assertEqual(Meal.objects.get(user=self.members[1], date=date(2025, 3, 31)).total_meals(), 5)
+        self.assertEqual(NotificationOutbox.objects.filter(title='Meal Entries Updated').count(), 6)
+        self.assertEqual(rebuild_ledger([self.mess.id], check_only=True), [])
+
+    def test_rejects_users_outside_the_mess(self):
+        outsider = CustomUser.objects.create_user(username='outsider', password='pass')
+
+        self.client.post(self.url, self.grid(self.members + [outsider]))
+
+        self.assertFalse(Meal.objects.exists())
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        view_metrics.clear()
+        self.user = CustomUser.objects.create_user(username='member', password='pass')
+        self.client.force_login(self.user)
+
+    def test_server_timing_header_is_staff_only(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('notifications')))
+
+        CustomUser.objects.filter(id=self.user.id).update(is_staff=True)
+        response = self.client.get(reverse('notifications'))
+
+        timing = response['Server-Timing']
+        self.assertIn('db;desc=', timing)
+        self.assertIn('tpl;desc="Templates"', timing)
+        self.assertIn('total;dur=', timing)
+
+    @override_settings(SERVER_TIMING_HEADER=True)
+    def test_server_timing_header_can_be_sent_to_everyone(self):
+        self.assertIn('Server-Timing', self.client.get(reverse('notifications')))
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.client.get(reverse('notifications'))
+        self.assertEqual(self.client.get(reverse('view_metrics')).status_code, 403)
+
+        CustomUser.objects.filter(id=self.user.id).update(is_staff=True)
+        views = self.client.get(reverse('view_metrics')).json()['views']
+        self.assertEqual(views['notifications']['count'], 1)
+        self.assertIn('p90', views['notifications']['wall_ms'])
+
+
+class HotPathIndexTests(TestCase):
+    def test_hot_path_indexes_are_created(self):
+        declared = {index.name for model in (Meal, Expense, Deposit, MonthlyLedger, Notification)
+                    for index in model._meta.indexes}
+        with connection.cursor() as cursor:
+            created = set()
+            for table in ('core_meal', 'core_expense', 'core_deposit', 'core_monthlyledger', 'core_notification'):
+                created.update(connection.introspection.get_constraints(cursor, table))
+
+        self.assertLessEqual(set(HOT_PATH_INDEXES), declared)
+        self.assertLessEqual(set(HOT_PATH_INDEXES), created)
+
+    @skipUnless(connection.vendor == 'sqlite', 'plans of other backends depend on table statistics')
+    def test_hot_queries_use_the_indexes(self):
+        user = CustomUser.objects.create_user(username='indexed', password='pass')
+        mess = Mess.objects.create(name='Indexed', address='Dhaka')
+
+        for label, queryset in hot_queries(mess, user, 2025, 3):
+            plan = queryset.explain()
+            self.assertTrue(any(f'USING INDEX {name} ' in plan for name in HOT_PATH_INDEXES), f'{label}: {plan}')
+
+
+class BenchmarkCommandTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_seed_and_run_a_small_benchmark(self):
+        output = StringIO()
+        call_command('seed_bench', members=3, days=3, messages=5, notifications=2, stdout=output)
+
+        mess = Mess.objects.get(name__startswith='Bench mess')
+        self.assertIn(f'Seeded messes {mess.id} with 3 members', output.getvalue())
+        self.assertEqual(Meal.objects.filter(mess=mess).count(), 9)
+        self.assertEqual(rebuild_ledger(check_only=True), [])
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'bench.json')
+        output = StringIO()
+        call_command('run_bench', iterations=1, output=path, stdout=output)
+
+        with open(path, encoding='utf-8') as results_file:
+            results = json.load(results_file)
+        self.assertEqual(results['meta']['mess'], mess.id)
+        self.assertEqual(list(results['views']), [name for name, takes_mess, role in BENCHMARK_VIEWS])
+        for name, result in results['views'].items():
+            self.assertTrue(all(status < 400 for status in result['status']), name)
+            self.assertGreater(result['queries']['p50'], 0, name)
+            self.assertIn(name, output.getvalue())
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='ledger-member', password='pass')
+        self.mess = Mess.objects.create(name='Ledgered', address='Dhaka')
+        Membership.objects.create(user=self.user, mess=self.mess, role='member')
+
+    def ledger(self, year, month, user=True):
+        row = MonthlyLedger.objects.filter(
+            mess=self.mess, user=self.user if user else None, year=year, month=month
+        ).first()
+        return row and (row.meals, row.deposit, row.expense)
+
+    def test_editing_a_meal_applies_the_difference(self):
+        meal = Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 4), lunch=1, dinner=1)
+        self.assertEqual(self.ledger(2025, 3), (2, 0, 0))
+
+        meal = Meal.objects.get(pk=meal.pk)
+        meal.breakfast = 1
+        meal.save()
+        self.assertEqual(self.ledger(2025, 3), (3, 0, 0))
+
+    def test_moving_a_meal_to_another_month_moves_its_total(self):
+        meal = Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 31), lunch=2)
+        meal.date = date(2025, 4, 1)
+        meal.save()
+
+        self.assertEqual(self.ledger(2025, 3), (0, 0, 0))
+        self.assertEqual(self.ledger(2025, 4), (2, 0, 0))
+
+    def test_saving_an_unloaded_meal_into_another_month_moves_its_total(self):
+        meal = Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 31), lunch=2)
+
+        moved = Meal(pk=meal.pk, user=self.user, mess=self.mess, date=date(2025, 4, 1), lunch=2)
+        moved.created_at = meal.created_at
+        moved.save()
+
+        self.assertEqual(self.ledger(2025, 3), (0, 0, 0))
+        self.assertEqual(self.ledger(2025, 4), (2, 0, 0))
+        self.assertEqual(rebuild_ledger(check_only=True), [])
+
+    def test_deleting_rows_removes_them(self):
+        meal = Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 4), lunch=1)
+        Deposit.objects.create(user=self.user, mess=self.mess, amount=Decimal('250.50'), date=date(2025, 3, 5))
+        expense = Expense.objects.create(mess=self.mess, amount=120, description='Oil', date=date(2025, 3, 6),
+                                         created_by=self.user)
+
+        Meal.objects.get(pk=meal.pk).delete()
+        expense.delete()
+
+        self.assertEqual(self.ledger(2025, 3), (0, Decimal('250.50'), 0))
+        self.assertEqual(self.ledger(2025, 3, user=False), (0, 0, 0))
+
+    def test_delete_does_not_create_missing_rows(self):
+        meal = Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 4), lunch=1)
+        MonthlyLedger.objects.all().delete()
+
+        meal.delete()
+
+        self.assertFalse(MonthlyLedger.objects.exists())
+
+    def test_save_without_snapshot_rebuilds_the_bucket(self):
+        Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 3), lunch=1)
+        meal = Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 4), lunch=1)
+        Meal.objects.filter(pk=meal.pk).update(lunch=3)
+
+        meal = Meal.objects.only('id', 'user', 'mess', 'date').get(pk=meal.pk)
+        meal.dinner = 1
+        meal.save()
+
+        self.assertEqual(self.ledger(2025, 3), (5, 0, 0))
+
+    def test_check_reports_drift_without_fixing_it(self):
+        Meal.objects.create(user=self.user, mess=self.mess, date=date(2025, 3, 4), lunch=2)
+        MonthlyLedger.objects.filter(mess=self.mess, user=self.user).update(meals=7)
+
+        out = StringIO()
+        with self.assertRaisesMessage(CommandError, '1 ledger rows have drifted.'):
+            call_command('rebuild_ledger', check=True, mess_ids=[self.mess.id], stdout=out)
+        self.assertIn(f'user {self.user.id}, 3/2025: stored', out.getvalue())
+        self.assertEqual(self.ledger(2025, 3), (7, 0, 0))
+
+        call_command('rebuild_ledger', mess_ids=[self.mess.id], stdout=StringIO())
+        self.assertEqual(self.ledger(2025, 3), (2, 0, 0))
+        call_command('rebuild_ledger', check=True, mess_ids=[self.mess.id], stdout=StringIO())
+
+
+class MonthlySettlementTests(TestCase):
+    def setUp(self):
+        self.mess = Mess.objects.create(name='Settled', address='Dhaka')
+
+    def add_members(self, count):
+        for i in range(count):
+            user = CustomUser.objects.create_user(username=f'member-{self.mess.membership_set.count()}', password='pass')
+            Membership.objects.create(user=user, mess=self.mess, role='member')
+            Meal.objects.create(user=user, mess=self.mess, date=date(2025, 3, 1 + i % 28), lunch=1)
+            Deposit.objects.create(user=user, mess=self.mess, amount=500, date=date(2025, 3, 2))
+        Expense.objects.create(mess=self.mess, amount=300, description='Rice', date=date(2025, 3, 3),
+                               created_by=user)
+
+    def test_query_count_does_not_grow_with_members(self):
+        self.add_members(2)
+        with self.assertNumQueries(2):
+            settlement = monthly_settlement(self.mess, 2025, 3)
+        self.assertEqual(settlement['grand_total_meals'], 2)
+
+        self.add_members(20)
+        with self.assertNumQueries(2):
+            settlement = monthly_settlement(self.mess, 2025, 3)
+        self.assertEqual(settlement['grand_total_meals'], 22)
+        self.assertEqual(settlement['total_expense'], 600)
+        self.assertEqual(len(settlement['member_reports']), 22)
+
+
+class ReportCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.mess = Mess.objects.create(name='Cached', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        self.meal = Meal.objects.create(user=self.manager, mess=self.mess, date=date(2025, 3, 10), lunch=1)
+        self.url = reverse('view_reports', args=[self.mess.id]) + '?month=3&year=2025'
+        self.client.force_login(self.manager)
+
+    def test_unchanged_month_is_served_from_cache(self):
+        cached_settlement(self.mess, 2025, 3)
+
+        with self.assertNumQueries(0):
+            settlement = cached_settlement(self.mess, 2025, 3)
+        self.assertEqual(settlement['grand_total_meals'], 1)
+
+    def test_saving_a_meal_invalidates_its_month(self):
+        self.assertEqual(self.client.get(self.url).context['grand_total_meals'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.meal.dinner = 2
+            self.meal.save()
+
+        self.assertEqual(self.client.get(self.url).context['grand_total_meals'], 3)
+
+    def test_culling_cached_reports_keeps_the_versions(self):
+        cached_settlement(self.mess, 2025, 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.meal.dinner = 2
+            self.meal.save()
+
+        # What a culling cache may drop: the counters, not the stale entry
+        cache.delete_many([f'report-version:{self.mess.id}', f'report-version:{self.mess.id}:2025:3'])
+
+        self.assertEqual(cached_settlement(self.mess, 2025, 3)['grand_total_meals'], 3)
+
+    @override_settings(REPORT_JOBS=False)
+    def test_pdf_is_rendered_once_per_data_version(self):
+        url = reverse('download_report_pdf', args=[self.mess.id]) + '?month=3&year=2025'
+        first = self.client.get(url)
+
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(url)
+
+        self.assertEqual(first.content, second.content)
+        self.assertFalse([q for q in queries if 'core_meal' in q['sql'] or 'core_expense' in q['sql']])
+
+
+class ReportJobTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.mess = Mess.objects.create(name='Jobs', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        self.meal = Meal.objects.create(user=self.manager, mess=self.mess, date=date(2025, 3, 10), lunch=1)
+        self.url = reverse('request_report_job', args=[self.mess.id])
+        self.client.force_login(self.manager)
+
+    def request_job(self):
+        return self.client.post(self.url, {'month': 3, 'year': 2025}).json()
+
+    def render_queued(self):
+        for job in claim_report_jobs('test-worker', 10):
+            run_report_job(job.id)
+
+    def render_in_worker(self):
+        # Worker processes have local memory caches of their own
+        worker_caches = {
+            alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'report-worker-{alias}'}
+            for alias in settings.CACHES
+        }
+        with override_settings(CACHES=worker_caches):
+            self.render_queued()
+
+    def test_identical_requests_share_one_job(self):
+        first = self.request_job()
+        second = self.request_job()
+
+        self.assertEqual(first['id'], second['id'])
+        self.assertEqual(first['status'], 'queued')
+        self.assertEqual(ReportJob.objects.count(), 1)
+
+    def test_finished_job_is_downloaded_and_reused(self):
+        job = self.request_job()
+        self.render_in_worker()
+
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual(status['status'], 'done')
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+        self.assertEqual(self.request_job()['id'], job['id'])
+
+    def test_data_change_queues_a_new_job(self):
+        job = self.request_job()
+        self.render_queued()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.meal.dinner = 1
+            self.meal.save()
+
+        new_job = self.request_job()
+        self.assertNotEqual(new_job['id'], job['id'])
+        self.assertEqual(new_job['status'], 'queued')
+
+    def test_worker_renders_the_data_changed_after_a_finished_job(self):
+        rendered = []
+
+        def settlement(mess, year, month):
+            result = monthly_settlement(mess, year, month)
+            rendered.append(result['grand_total_meals'])
+            return result
+
+        with mock.patch('core.report_jobs.monthly_settlement', side_effect=settlement):
+            first = self.request_job()
+            self.render_in_worker()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.meal.dinner = 1
+                self.meal.save()
+            second = self.request_job()
+            self.render_in_worker()
+
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(rendered, [1, 2])
+        self.assertEqual(self.request_job()['id'], second['id'])
+
+    def test_failed_job_reports_its_error(self):
+        job = self.request_job()
+        fail_report_job(job['id'], 'renderer crashed')
+
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['error'], 'renderer crashed')
+        self.assertNotEqual(self.request_job()['id'], job['id'])
+
+    def test_download_link_queues_a_job(self):
+        response = self.client.get(reverse('download_report_pdf', args=[self.mess.id]) + '?month=3&year=2025')
+
+        job = ReportJob.objects.get()
+        self.assertRedirects(response, reverse('view_reports', args=[self.mess.id]) + f'?month=3&year=2025&job={job.id}')
+
+    def test_invalid_months_are_rejected_before_queueing(self):
+        response = self.client.post(reverse('request_report_job', args=[self.mess.id]), {'month': 13, 'year': 2025})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Invalid month or year')
+
+        response = self.client.get(reverse('download_report_pdf', args=[self.mess.id]) + '?month=13&year=2025',
+                                   follow=True)
+        self.assertEqual([str(message) for message in response.context['messages']], ['Invalid month or year'])
+        self.assertFalse(ReportJob.objects.exists())
+
+
+class LedgerExportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.mess = Mess.objects.create(name='Export', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        Membership.objects.create(user=self.member, mess=self.mess)
+        for day in (date(2025, 1, 31), date(2025, 2, 1), date(2025, 3, 1)):
+            Meal.objects.create(user=self.member, mess=self.mess, date=day, lunch=1, dinner=1)
+        Expense.objects.create(mess=self.mess, created_by=self.manager, amount=90,
+                               description='Rice, oil & "spices"', date=date(2025, 2, 3))
+        self.url = reverse('export_ledger', args=[self.mess.id])
+        self.client.force_login(self.manager)
+
+    def test_csv_covers_a_month_range(self):
+        response = self.client.get(self.url, {'dataset': 'meals', 'start': '2025-01', 'end': '2025-02'})
+
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Date,Member,Breakfast,Lunch,Dinner,Total')
+        self.assertEqual(lines[1:], ['2025-01-31,member,0,1,1,2', '2025-02-01,member,0,1,1,2'])
+
+    def test_yearly_settlement_has_a_row_per_member_and_month(self):
+        response = self.client.get(self.url, {'dataset': 'settlement', 'year': '2025'})
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1 + 12 * 2)
+        self.assertIn('2025,2,member,member,2,45.0000,90.00,0,-90.00', lines)
+
+    def test_xlsx_workbook(self):
+        response = self.client.get(self.url, {'dataset': 'expenses', 'format': 'xlsx', 'year': '2025'})
+
+        workbook = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        self.assertIn('xl/workbook.xml', workbook.namelist())
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row>'), 2)
+        self.assertIn('Rice, oil &amp; "spices"', sheet)
+        self.assertIn('<c t="n"><v>90.00</v></c>', sheet)
+
+    def test_rejects_reversed_range(self):
+        response = self.client.get(self.url, {'start': '2025-03', 'end': '2025-01'})
+
+        self.assertRedirects(response, reverse('view_reports', args=[self.mess.id]), fetch_redirect_response=False)
+
+
+class RangeReportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.mess = Mess.objects.create(name='Range', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        Membership.objects.create(user=self.member, mess=self.mess)
+
+        # January: 4 meals for 100, February: 5 meals for 50
+        Meal.objects.create(user=self.manager, mess=self.mess, date=date(2025, 1, 5), lunch=1, dinner=1)
+        Meal.objects.create(user=self.member, mess=self.mess, date=date(2025, 1, 5), lunch=1, dinner=1)
+        Meal.objects.create(user=self.member, mess=self.mess, date=date(2025, 2, 5), breakfast=1, lunch=2, dinner=2)
+        Expense.objects.create(mess=self.mess, created_by=self.manager, amount=100, date=date(2025, 1, 6))
+        Expense.objects.create(mess=self.mess, created_by=self.manager, amount=50, date=date(2025, 2, 6))
+        Deposit.objects.create(user=self.member, mess=self.mess, amount=80, date=date(2025, 1, 7))
+
+    def test_months_are_settled_at_their_own_rate(self):
+        settlement = range_settlement(self.mess, months_between(2025, 1, 2025, 3))
+
+        self.assertEqual([entry['meal_rate'] for entry in settlement['trend']], [25, 10, 0])
+        member = next(r for r in settlement['member_reports'] if r['user'] == self.member)
+        self.assertEqual(member['total_meal'], 7)
+        self.assertEqual(member['total_cost'], 100)
+        self.assertEqual(member['running_balance'], [30, -20, -20])
+        self.assertEqual(member['balance'], -20)
+
+    def test_query_count_does_not_grow_with_the_range(self):
+        with self.assertNumQueries(4):
+            range_settlement(self.mess, months_between(2025, 1, 2025, 1))
+        with self.assertNumQueries(4):
+            range_settlement(self.mess, months_between(2023, 1, 2025, 12))
+
+    def test_quarterly_view(self):
+        self.client.force_login(self.manager)
+
+        response = self.client.get(reverse('range_reports', args=[self.mess.id]),
+                                   {'mode': 'quarter', 'year': 2025, 'quarter': 1})
+
+        self.assertEqual(response.context['period_label'], 'Jan 2025 - Mar 2025')
+        self.assertEqual(response.context['grand_total_meals'], 9)
+        self.assertEqual(len(response.context['trend']), 3)
+
+
+class MonthCloseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.mess = Mess.objects.create(name='Closing', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        Membership.objects.create(user=self.member, mess=self.mess)
+
+        # January rate 25, February rate 10
+        Meal.objects.create(user=self.manager, mess=self.mess, date=date(2025, 1, 5), lunch=1, dinner=1)
+        self.meal = Meal.objects.create(user=self.member, mess=self.mess, date=date(2025, 1, 5), lunch=1, dinner=1)
+        Meal.objects.create(user=self.member, mess=self.mess, date=date(2025, 2, 5), breakfast=1, lunch=2, dinner=2)
+        Expense.objects.create(mess=self.mess, created_by=self.manager, amount=100, date=date(2025, 1, 6))
+        Expense.objects.create(mess=self.mess, created_by=self.manager, amount=50, date=date(2025, 2, 6))
+        Deposit.objects.create(user=self.member, mess=self.mess, amount=80, date=date(2025, 1, 7))
+
+    def test_closing_carries_balances_forward(self):
+        self.assertEqual(close_month(self.mess, 2025, 2), [(2025, 1), (2025, 2)])
+
+        january, february = MonthSnapshot.objects.filter(mess=self.mess, user=self.member).order_by('month')
+        self.assertEqual((january.carried_forward, january.balance), (0, 30))
+        self.assertEqual((february.carried_forward, february.cost, february.balance), (30, 50, -20))
+        self.assertEqual(opening_balances(self.mess, 2025, 3)[self.member.id], -20)
+
+    def test_closed_month_rows_are_locked(self):
+        close_month(self.mess, 2025, 1)
+
+        self.meal.dinner = 3
+        with self.assertRaises(MonthClosedError):
+            self.meal.save()
+        with self.assertRaises(MonthClosedError), transaction.atomic():
+            self.meal.delete()
+        with self.assertRaises(MonthClosedError):
+            upsert_meals(self.mess, [(self.member.id, date(2025, 1, 9), 1, 1, 1)])
+        Meal.objects.create(user=self.member, mess=self.mess, date=date(2025, 2, 9), lunch=1)
+
+    def test_range_reports_carry_balances_and_read_closed_months_from_snapshots(self):
+        close_month(self.mess, 2025, 1)
+        january = snapshot_settlement(self.mess, 2025, 1)
+        # Bypasses the closed-month guard; the report must keep the closed figures
+        Expense.objects.filter(date__month=1).update(amount=999)
+        self.client.force_login(self.manager)
+        url = reverse('range_reports', args=[self.mess.id])
+
+        both = self.client.get(url, {'mode': 'range', 'start': '2025-01', 'end': '2025-02'}).context
+        february = self.client.get(url, {'mode': 'range', 'start': '2025-02', 'end': '2025-02'}).context
+
+        self.assertEqual(both['trend'][0]['total_expense'], january['total_expense'])
+        closed = next(r for r in january['member_reports'] if r['user'] == self.member)
+        member = next(r for r in february['member_reports'] if r['user'] == self.member)
+        self.assertEqual(member['carried_forward'], closed['closing_balance'])
+        self.assertEqual(next(r for r in both['member_reports'] if r['user'] == self.member)['running_balance'],
+                         [closed['closing_balance'], member['balance']])
+
+    def test_writers_take_the_mess_lock_close_month_takes(self):
+        with mock.patch.object(Mess.objects, 'select_for_update', wraps=Mess.objects.select_for_update) as lock:
+            run_with_retry(Meal.objects.create, user=self.manager, mess=self.mess, date=date(2025, 3, 1), lunch=1)
+            upsert_meals(self.mess, [(self.member.id, date(2025, 3, 2), 1, 0, 0)])
+
+        self.assertEqual(lock.call_count, 2)
+
+    def test_mess_and_users_can_be_deleted_after_a_month_is_closed(self):
+        close_month(self.mess, 2025, 1)
+
+        self.member.delete()
+        self.assertFalse(Meal.objects.filter(date__month=1, user_id=self.member.id).exists())
+        self.mess.delete()
+
+        self.assertFalse(Meal.objects.exists())
+        self.assertFalse(MonthSnapshot.objects.exists())
+        self.assertFalse(MonthlyLedger.objects.exists())
+
+    def test_member_can_be_removed_after_a_month_is_closed(self):
+        close_month(self.mess, 2025, 1)
+        self.client.force_login(self.manager)
+
+        response = self.client.post(reverse('remove_member', args=[self.mess.id, self.member.id]), follow=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([str(message) for message in response.context['messages']],
+                         ['Member member has been removed successfully.'])
+        self.assertFalse(Membership.objects.filter(user=self.member, mess=self.mess).exists())
+        self.assertEqual(list(Meal.objects.filter(user=self.member).values_list('date', flat=True)), [date(2025, 1, 5)])
+        self.assertEqual(Deposit.objects.filter(user=self.member).count(), 1)
+
+    def test_close_month_view_and_report(self):
+        self.client.force_login(self.manager)
+
+        self.client.post(reverse('close_month', args=[self.mess.id]), {'month': 1, 'year': 2025})
+        response = self.client.get(reverse('view_reports', args=[self.mess.id]), {'month': 2, 'year': 2025})
+
+        member = next(r for r in response.context['member_reports'] if r['user'] == self.member)
+        self.assertEqual(member['carried_forward'], 30)
+        self.assertEqual(member['closing_balance'], -20)
+        self.assertTrue(response.context['can_close'])
+
+    def test_backfill_command(self):
+        call_command('backfill_snapshots', through='2025-02', stdout=StringIO())
+        call_command('backfill_snapshots', through='2025-02', stdout=StringIO())
+
+        self.assertEqual(MonthSnapshot.objects.filter(mess=self.mess, user__isnull=True).count(), 2)
+
+
+class MemberDashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.mess = Mess.objects.create(name='Dashboard', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        self.members = []
+        today = date.today()
+        for i in range(3):
+            member = CustomUser.objects.create_user(username=f'member-{i}', password='pass')
+            Membership.objects.create(user=member, mess=self.mess)
+            self.members.append(member)
+        for day in range(1, min(today.day, 20) + 1):
+            for member in self.members:
+                Meal.objects.create(user=member, mess=self.mess, date=today.replace(day=day), lunch=1)
+        Expense.objects.create(mess=self.mess, created_by=self.manager, amount=300)
+        Deposit.objects.create(user=self.members[0], mess=self.mess, amount=100)
+        self.url = reverse('member_dashboard', args=[self.mess.id])
+        self.days = min(today.day, 20)
+
+    def test_members_share_the_cached_mess_aggregate(self):
+        self.client.force_login(self.members[1])
+        self.client.get(self.url)
+
+        self.client.force_login(self.members[0])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+
+        self.assertFalse([q for q in queries if 'SUM(' in q['sql'] and 'core_monthlyledger' in q['sql']])
+        self.assertEqual(response.context['total_meals'], self.days)
+        self.assertAlmostEqual(float(response.context['total_cost']), 100.0)
+        self.assertAlmostEqual(float(response.context['balance']), 0.0)
+
+    def test_meal_listing_is_paginated(self):
+        self.client.force_login(self.members[0])
+
+        response = self.client.get(self.url, {'meals_page': 2})
+
+        page = response.context['member_meals']
+        self.assertEqual(page.paginator.count, self.days)
+        self.assertEqual(len(page), max(0, self.days - 15) or self.days)
+
+
+class MessAccessTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.outsider = CustomUser.objects.create_user(username='outsider', password='pass')
+        self.mess = Mess.objects.create(name='Access', address='Dhaka')
+        self.manager_membership = Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        self.member_membership = Membership.objects.create(user=self.member, mess=self.mess)
+
+    def test_membership_is_resolved_with_one_query(self):
+        self.client.force_login(self.manager)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('manage_members', args=[self.mess.id]))
+
+        self.assertEqual(response.status_code, 200)
+        lookups = [q for q in queries if 'FROM "core_membership"' in q['sql'] and 'core_mess' in q['sql']]
+        self.assertEqual(len(lookups), 1)
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT') and 'FROM "core_mess"' in q['sql']])
+
+    def test_non_members_get_404_and_members_are_kept_out_of_manager_views(self):
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(reverse('member_dashboard', args=[self.mess.id])).status_code, 404)
+
+        self.client.force_login(self.member)
+        response = self.client.get(reverse('view_reports', args=[self.mess.id]))
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        response = self.client.get(reverse('report_job_status', args=[self.mess.id, 1]))
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(MEMBERSHIP_CACHE_TIMEOUT=60)
+    def test_role_change_invalidates_cached_membership(self):
+        self.client.force_login(self.manager)
+        url = reverse('view_reports', args=[self.mess.id])
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([q for q in queries if 'FROM "core_membership"' in q['sql'] and 'core_mess' in q['sql']])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('role_change', args=[self.mess.id]),
+                             {'new_manager': self.member_membership.id})
+
+        response = self.client.get(url)
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+
+
+@override_settings(REALTIME_HEARTBEAT=0.05)
+@override_settings(REALTIME_PUSH=True)
+class RealtimeEventTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.mess = Mess.objects.create(name='Realtime', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        Membership.objects.create(user=self.member, mess=self.mess)
+
+    async def open_stream(self, user, url):
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        self.assertTrue((await anext(stream)).startswith(b'retry:'))
+        self.assertIn(b'event: unread', await anext(stream))
+        return stream
+
+    async def test_new_messages_are_pushed_to_the_mess_stream(self):
+        stream = await self.open_stream(self.member, reverse('mess_events', args=[self.mess.id]))
+        page = await self.async_client.get(reverse('member_messages', args=[self.mess.id]))
+        self.assertContains(page, f'data-events-url="{reverse("mess_events", args=[self.mess.id])}"')
+
+        def send():
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(mess=self.mess, user=self.manager, content='Dinner at 9')
+        await sync_to_async(send)()
+
+        frame = await asyncio.wait_for(anext(stream), 5)
+        self.assertTrue(frame.startswith(b'event: message\n'))
+        data = json.loads(frame.split(b'data: ', 1)[1])
+        self.assertEqual((data['username'], data['role'], data['content']), ('manager', 'manager', 'Dinner at 9'))
+        await stream.aclose()
+
+    async def test_idle_stream_sends_heartbeats_and_unread_changes(self):
+        stream = await self.open_stream(self.member, reverse('notification_events'))
+        self.assertEqual(await asyncio.wait_for(anext(stream), 5), b': keepalive\n\n')
+
+        def notify():
+            with self.captureOnCommitCallbacks(execute=True):
+                notify_users([self.member.id], 'Hello', 'Pushed')
+        await sync_to_async(notify)()
+
+        frame = await asyncio.wait_for(anext(stream), 5)
+        while frame.startswith(b':'):
+            frame = await asyncio.wait_for(anext(stream), 5)
+        self.assertEqual(frame, b'event: unread\ndata: {"unread_count": 1}\n\n')
+        await stream.aclose()
+
+    async def test_outsiders_cannot_open_a_mess_stream(self):
+        outsider = await CustomUser.objects.acreate(username='outsider')
+        await self.async_client.aforce_login(outsider)
+        response = await self.async_client.get(reverse('mess_events', args=[self.mess.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_streams_are_not_served_over_wsgi(self):
+        self.client.force_login(self.member)
+
+        self.assertEqual(self.client.get(reverse('notification_events')).status_code, 404)
+        self.assertNotContains(self.client.get(reverse('notifications')), 'data-events-url')
+
+    @override_settings(REALTIME_PUSH=False)
+    async def test_streams_are_off_by_default(self):
+        await self.async_client.aforce_login(self.member)
+
+        response = await self.async_client.get(reverse('notification_events'))
+        self.assertEqual(response.status_code, 404)
+        page = await self.async_client.get(reverse('notifications'))
+        self.assertNotContains(page, 'data-events-url')
+
+
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.mess = Mess.objects.create(name='Chat', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        Membership.objects.create(user=self.member, mess=self.mess)
+        Message.objects.bulk_create([
+            Message(mess=self.mess, user=self.manager if i % 2 else self.member, content=f'Message {i}')
+            for i in range(120)
+        ])
+        # bulk_create shares one created_at, so the id breaks the ties
+        self.ids = list(Message.objects.filter(mess=self.mess).order_by('-created_at', '-id').values_list('id', flat=True))
+        self.url = reverse('message_history', args=[self.mess.id])
+        self.client.force_login(self.member)
+
+    def test_pages_back_through_history_without_gaps(self):
+        seen = []
+        response = self.client.get(self.url).json()
+        seen += [message['id'] for message in response['messages']]
+        while response['has_more']:
+            response = self.client.get(self.url, {'before': seen[-1]}).json()
+            seen += [message['id'] for message in response['messages']]
+
+        self.assertEqual(seen, self.ids)
+
+    def test_after_returns_only_newer_messages(self):
+        response = self.client.get(self.url, {'after': self.ids[3]}).json()
+
+        self.assertEqual([message['id'] for message in response['messages']], self.ids[:3])
+        self.assertFalse(response['has_more'])
+        self.assertIn('badge bg-warning', response['html'])
+
+    def test_unchanged_history_returns_304(self):
+        response = self.client.get(self.url, {'after': self.ids[0]})
+        self.assertEqual(response.json()['messages'], [])
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(self.url, {'after': self.ids[0]}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertFalse([q for q in queries if 'FROM "core_message"' in q['sql'] and 'INNER JOIN' in q['sql']])
+
+        Message.objects.create(mess=self.mess, user=self.manager, content='New')
+        fresh = self.client.get(self.url, {'after': self.ids[0]}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual([message['content'] for message in fresh.json()['messages']], ['New'])
+
+    def test_messages_page_query_count_does_not_depend_on_authors(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('member_messages', args=[self.mess.id]))
+
+        self.assertEqual(len(response.context['messages']), 50)
+        self.assertTrue(response.context['has_more_messages'])
+        # The access check and the manager badge lookup, not one per message author
+        self.assertEqual(len([q for q in queries if 'FROM "core_membership"' in q['sql']]), 2)
+
+
+class LedgerImportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.mess = Mess.objects.create(name='Import', address='Dhaka')
+        Membership.objects.create(user=self.manager, mess=self.mess, role='manager')
+        Membership.objects.create(user=self.member, mess=self.mess)
+        Meal.objects.create(user=self.member, mess=self.mess, date=date(2024, 3, 1), lunch=5)
+        NotificationOutbox.objects.all().delete()
+
+    def csv_lines(self, *rows):
+        return ['type,date,member,breakfast,lunch,dinner,amount,description\n', *(f'{row}\n' for row in rows)]
+
+    def test_import_upserts_meals_and_keeps_the_ledger_consistent(self):
+        counts = import_ledger(self.mess, self.csv_lines(
+            'meal,2024-03-01,member,1,1,1,,',
+            'meal,2024-03-02,Manager,0,2,1,,',
+            'expense,2024-03-02,,,,,450.50,Rice',
+            'deposit,2024-03-05,member,,,,1000,',
+            f'deposit,2024-04-01,{self.manager.id},,,,200,',
+        ), self.manager, chunk_size=2)
+
+        self.assertEqual(counts, {'meals': 2, 'expenses': 1, 'deposits': 2})
+        self.assertEqual(Meal.objects.get(user=self.member, date=date(2024, 3, 1)).total_meals(), 3)
+        self.assertEqual(Expense.objects.get().created_by, self.manager)
+        self.assertEqual(rebuild_ledger([self.mess.id], check_only=True), [])
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_invalid_rows_reject_the_whole_import(self):
+        with self.assertRaises(LedgerImportError) as raised:
+            import_ledger(self.mess, self.csv_lines(
+                'deposit,2024-03-05,member,,,,1000,',
+                'meal,2024-03-02,stranger,0,2,1,,',
+                'expense,2024-03-02,,,,,abc,Rice',
+            ), self.manager, chunk_size=1)
+
+        self.assertEqual([line for line, error in raised.exception.errors], [3, 4])
+        self.assertFalse(Deposit.objects.exists())
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_non_finite_and_oversized_amounts_are_row_errors(self):
+        with self.assertRaises(LedgerImportError) as raised:
+            import_ledger(self.mess, self.csv_lines(
+                'expense,2024-03-02,,,,,NaN,Rice',
+                'deposit,2024-03-05,member,,,,Infinity,',
+                'deposit,2024-03-05,member,,,,-inf,',
+                'expense,2024-03-02,,,,,100000000,Rice',
+                'deposit,2024-03-05,member,,,,1e30,',
+                'deposit,2024-03-05,member,,,,99999999.994,',
+            ), self.manager)
+
+        errors = raised.exception.errors
+        self.assertEqual([line for line, error in errors], [2, 3, 4, 5, 6])
+        self.assertIn("invalid amount 'NaN'", errors[0][1])
+        self.assertIn("amount '100000000' is too large", errors[3][1])
+        self.assertFalse(Deposit.objects.exists())
+
+    def test_upload_and_command(self):
+        self.client.force_login(self.manager)
+        upload = SimpleUploadedFile('ledger.csv', ''.join(self.csv_lines('deposit,2024-03-05,member,,,,1000,')).encode())
+        response = self.client.post(reverse('import_ledger', args=[self.mess.id]), {'file': upload})
+        self.assertRedirects(response, reverse('update_accounts', args=[self.mess.id]), fetch_redirect_response=False)
+        self.assertEqual(Deposit.objects.count(), 1)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as handle:
+            handle.writelines(self.csv_lines('expense,2024-03-02,,,,,100,Oil'))
+        self.addCleanup(os.remove, handle.name)
+        out = StringIO()
+        call_command('import_ledger', handle.name, mess=self.mess.id, stdout=out)
+        self.assertIn('1 expenses', out.getvalue())
+        self.assertEqual(Expense.objects.get().created_by, self.manager)
+
+
+class DatabaseContentionTests(TransactionTestCase):
+    def test_retry_backs_off_on_lock_errors(self):
+        calls = []
+
+        def locked_twice():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'done'
+
+        self.assertEqual(run_with_retry(locked_twice, base_delay=0.001), 'done')
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        def broken():
+            calls.append(1)
+            raise OperationalError('no such table: core_missing')
+
+        with self.assertRaises(OperationalError):
+            run_with_retry(broken, base_delay=0.001)
+        self.assertEqual(len(calls), 1)
+
+    @skipUnless(connection.vendor == 'sqlite', 'stresses the SQLite settings')
+    def test_stress_command_sees_no_lock_errors(self):
+        # On a database file like in production: the in-memory test database
+        # locks whole tables, so its readers fail where WAL readers never wait
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        environ = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'mess_manager.settings',
+                   'SQLITE_PATH': os.path.join(directory, 'stress.sqlite3'), 'SQLITE_SHARD_PATHS': ''}
+
+        for command in (['migrate'],
+                        ['seed_bench', '--members', '2', '--days', '1', '--messages', '1', '--notifications', '1'],
+                        ['stress_db', '--seconds', '1', '--writers', '2', '--readers', '2']):
+            result = subprocess.run([sys.executable, '-m', 'django', *command], cwd=settings.BASE_DIR, env=environ,
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+        self.assertIn('No database errors.', result.stdout)
+        self.assertNotIn('database is locked', result.stdout + result.stderr)
+
+
+@override_settings(REPLICA_DATABASE='replica', REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user(username='member', password='pass')
+        self.other = CustomUser.objects.create_user(username='other', password='pass')
+
+    def routed_read(self, user, inside=None):
+        @reads_from_replica
+        def view(request):
+            if inside:
+                with inside():
+                    return HttpResponse(router.db_for_read(Meal))
+            return HttpResponse(router.db_for_read(Meal))
+
+        request = RequestFactory().get('/')
+        request.user = user
+        return view(request).content.decode()
+
+    def test_replica_views_read_from_the_replica(self):
+        self.assertEqual(self.routed_read(self.user), 'replica')
+        self.assertEqual(router.db_for_read(Meal), 'default')
+        self.assertEqual(router.db_for_write(Meal), 'default')
+        with override_settings(REPLICA_DATABASE=None):
+            self.assertEqual(self.routed_read(self.user), 'default')
+
+    def test_cache_builds_and_transactions_read_from_the_primary(self):
+        self.assertEqual(self.routed_read(self.user, inside=primary), 'default')
+        self.assertEqual(self.routed_read(self.user, inside=transaction.atomic), 'default')
+
+    def test_writer_reads_from_the_primary_after_a_post(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('mark_all_notifications_read'))
+
+        self.assertEqual(self.routed_read(self.user), 'default')
+        self.assertEqual(self.routed_read(self.other), 'replica')
+
+
+@skipUnless(len(settings.TEST_MESS_SHARDS) > 1, 'needs a second shard database')
+@override_settings(MESS_SHARDS=settings.TEST_MESS_SHARDS)
+class ShardingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.shard = settings.MESS_SHARDS[1]
+        self.manager = CustomUser.objects.create_user(username='manager', password='pass')
+        self.member = CustomUser.objects.create_user(username='member', password='pass')
+        self.client.force_login(self.manager)
+        self.today = date.today()
+
+    def create_mess(self, shard):
+        mess = Mess.objects.create(name='Sharded', address='Dhaka', shard=shard)
+        Membership.objects.create(user=self.manager, mess=mess, role='manager')
+        Membership.objects.create(user=self.member, mess=mess, role='member')
+        return mess
+
+    def add_data(self, mess):
+        day = self.today.isoformat()
+        self.client.post(reverse('add_meal', args=[mess.id]),
+                         {'user': self.member.id, 'date': day, 'breakfast': 1, 'lunch': 1, 'dinner': 1})
+        self.client.post(reverse('add_expense', args=[mess.id]), {'amount': 300, 'description': 'Rice', 'date': day})
+        self.client.post(reverse('manager_messages', args=[mess.id]), {'content': 'Hello'})
+
+    def report(self, mess):
+        response = self.client.get(reverse('view_reports', args=[mess.id]))
+        return response.context['total_expense'], response.context['grand_total_meals']
+
+    def test_mess_data_is_written_to_its_shard(self):
+        mess = self.create_mess(self.shard)
+        self.add_data(mess)
+
+        for model in (Meal, Expense, Message, MonthlyLedger):
+            self.assertTrue(model.objects.using(self.shard).filter(mess_id=mess.id).exists(), model)
+            self.assertFalse(model.objects.using('default').filter(mess_id=mess.id).exists(), model)
+        self.assertEqual(CustomUser.objects.using(self.shard).get(pk=self.member.pk).username, 'member')
+        self.assertGreater(Meal.objects.using(self.shard).get(mess=mess).id, settings.SHARD_ID_STARTS[self.shard])
+        self.assertEqual(self.report(mess), (Decimal('300'), 3))
+
+    def test_rebalance_moves_a_mess_and_keeps_its_reports(self):
+        mess = self.create_mess('default')
+        self.add_data(mess)
+        before = self.report(mess)
+
+        call_command('rebalance_shard', mess.id, self.shard, drain_seconds=0, stdout=StringIO())
+
+        mess.refresh_from_db()
+        self.assertEqual((mess.shard, mess.shard_locked), (self.shard, False))
+        self.assertFalse(Meal.objects.using('default').filter(mess_id=mess.id).exists())
+        self.assertEqual(Message.objects.using(self.shard).filter(mess_id=mess.id).count(), 1)
+        self.assertEqual(self.report(mess), before)
+
+        self.client.post(reverse('add_expense', args=[mess.id]), {'amount': 100, 'description': 'Oil'})
+        self.assertEqual(Expense.objects.using(self.shard).filter(mess_id=mess.id).count(), 2)
+
+    def test_migration_backfills_stay_on_the_migrated_database(self):
+        mess = self.create_mess('default')
+        self.add_data(mess)
+        connection = connections[self.shard]
+        state = MigrationLoader(connection).project_state(('core', '0012_backfill_year_month'))
+
+        for name, function in (('0007_monthlyledger', 'backfill_ledger'),
+                               ('0009_customuser_unread_notifications', 'count_unread_notifications'),
+                               ('0012_backfill_year_month', 'backfill_year_month')):
+            migration = importlib.import_module(f'core.migrations.{name}')
+            getattr(migration, function)(state.apps, SimpleNamespace(connection=connection))
+
+        self.assertFalse(MonthlyLedger.objects.using(self.shard).exists())
+        self.assertEqual(MonthlyLedger.objects.using('default').filter(mess=mess).count(), 2)
+
+    def test_moved_rows_keep_their_ids(self):
+        source, target = settings.MESS_SHARDS[1], settings.MESS_SHARDS[-1]
+        mess = self.create_mess(source)
+        self.add_data(mess)
+        other = self.create_mess(target)
+        self.add_data(other)
+        ids = {model: set(model.objects.using(source).filter(mess=mess).values_list('id', flat=True))
+               for model in (Meal, Expense, Message, MonthlyLedger)}
+
+        move_mess(mess, target, drain_seconds=0)
+
+        for model, model_ids in ids.items():
+            self.assertEqual(set(model.objects.using(target).filter(mess=mess).values_list('id', flat=True)), model_ids)
+        self.client.post(reverse('manager_messages', args=[other.id]), {'content': 'After the move'})
+        self.assertEqual(Message.objects.using(target).count(), 3)
+
+    def test_rendering_report_blocks_the_move(self):
+        mess = self.create_mess('default')
+        self.add_data(mess)
+        job = request_report(mess, self.today.year, self.today.month)
+        Mess.objects.filter(id=mess.id).update(shard_locked=True)
+        self.assertEqual(claim_report_jobs('test-worker', 10), [])
+        Mess.objects.filter(id=mess.id).update(shard_locked=False)
+        self.assertEqual(claim_report_jobs('test-worker', 10), [job])
+
+        with self.assertRaises(ShardMoveError):
+            move_mess(mess, self.shard, drain_seconds=0)
+
+        mess.refresh_from_db()
+        self.assertEqual((mess.shard, mess.shard_locked), ('default', False))
+        self.assertTrue(Meal.objects.using('default').filter(mess_id=mess.id).exists())
+
+    @override_settings(MEMBERSHIP_CACHE_TIMEOUT=60)
+    def test_cached_memberships_see_where_the_mess_lives(self):
+        mess = self.create_mess('default')
+        url = reverse('mess_dashboard', args=[mess.id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([q for q in queries if 'FROM "core_mess"' in q['sql']])
+
+        Mess.objects.filter(id=mess.id).update(shard_locked=True)
+        invalidate_memberships(mess.id)
+        response = self.client.post(reverse('add_expense', args=[mess.id]), {'amount': 100, 'description': 'Oil'})
+
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        self.assertFalse(Expense.objects.exists())
+
+    def test_a_row_changed_during_the_move_aborts_it(self):
+        mess = self.create_mess('default')
+        self.add_data(mess)
+
+        def change_meal_then_set_last_id(alias, model, value):
+            Meal.objects.using('default').filter(mess_id=mess.id).update(lunch=2)
+            set_last_id(alias, model, value)
+
+        with mock.patch('core.rebalance.set_last_id', side_effect=change_meal_then_set_last_id):
+            with self.assertRaises(ShardMoveError):
+                move_mess(mess, self.shard, drain_seconds=0)
+
+        mess.refresh_from_db()
+        self.assertEqual((mess.shard, mess.shard_locked), ('default', False))
+        self.assertFalse(Meal.objects.using(self.shard).filter(mess_id=mess.id).exists())
+        self.assertEqual(Meal.objects.using('default').get(mess_id=mess.id).lunch, 2)
+
+    def test_writes_are_refused_while_a_mess_moves(self):
+        mess = self.create_mess('default')
+        Mess.objects.filter(id=mess.id).update(shard_locked=True)
+
+        with self.assertRaises(MessMovingError):
+            upsert_meals(mess, [(self.member.id, self.today, 1, 1, 1)])
+        with self.assertRaises(LedgerImportError):
+            import_ledger(mess, ['type,date,member,amount', f'deposit,{self.today},member,100'], self.manager)
+        with self.assertRaises(MessMovingError):
+            Deposit.objects.create(mess=mess, user=self.member, amount=100, date=self.today)
+
+        response = self.client.post(reverse('add_expense', args=[mess.id]), {'amount': 100, 'description': 'Oil'})
+
+        self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+        self.assertFalse(Expense.objects.exists())
+        self.assertEqual(self.client.get(reverse('mess_dashboard', args=[mess.id])).status_code, 200)
+
+
+class SettingsTests(SimpleTestCase):
+    def load_settings(self, argv, find_spec=importlib.util.find_spec, **environ):
+        spec = importlib.util.find_spec('mess_manager.settings')
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.object(sys, 'argv', argv), mock.patch.dict(os.environ, environ), \
+                mock.patch('importlib.util.find_spec', find_spec):
+            spec.loader.exec_module(module)
+        return module
+
+    def test_postgresql_connections_are_pooled_when_psycopg_pool_is_installed(self):
+        check = object()
+        psycopg_pool = SimpleNamespace(ConnectionPool=SimpleNamespace(check_connection=check))
+        installed = mock.Mock(return_value=True)
+        environ = {'DB_POOL_MIN_SIZE': '2', 'DB_POOL_MAX_SIZE': '20', 'DB_CONN_MAX_AGE': '60', 'DB_CONN_HEALTH_CHECKS': '1'}
+
+        with mock.patch.dict(sys.modules, {'psycopg_pool': psycopg_pool}):
+            pooled = self.load_settings(['manage.py', 'runserver'], installed, DB_POOL='1', **environ)
+            unpooled = self.load_settings(['manage.py', 'runserver'], installed, DB_POOL='0', **environ)
+
+        default = pooled.DATABASES['default']
+        self.assertEqual(default['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual(default['CONN_MAX_AGE'], 0)
+        self.assertEqual(default['OPTIONS']['pool'], {
+            'min_size': 2, 'max_size': 20, 'max_idle': 300.0, 'timeout': 10.0, 'check': check,
+        })
+        self.assertNotIn('pool', unpooled.DATABASES['default']['OPTIONS'])
+        self.assertEqual(unpooled.DATABASES['default']['CONN_MAX_AGE'], 60)
+
+    def test_test_shard_databases_only_exist_in_test_runs(self):
+        served = self.load_settings(['manage.py', 'runserver'], SQLITE_SHARD_PATHS='')
+        self.assertEqual(list(served.DATABASES), ['default'])
+        self.assertEqual(served.SHARD_ID_STARTS, {})
+
+        tested = self.load_settings(['manage.py', 'test'], SQLITE_SHARD_PATHS='')
+        self.assertEqual(tested.TEST_MESS_SHARDS, ['default', 'shard_1', 'shard_2'])
+        self.assertEqual(tested.MESS_SHARDS, ['default'])
+
@@ -18,10 +18,18 @@ urlpatterns = [
     path('mess/<int:mess_id>/remove-member/<int:user_id>/', views.remove_member, name='remove_member'),
     path('mess/<int:mess_id>/update-accounts/', views.update_accounts, name='update_accounts'),
     path('mess/<int:mess_id>/add-meal/', views.add_meal, name='add_meal'),
+    path('mess/<int:mess_id>/add-meals-bulk/', views.add_meals_bulk, name='add_meals_bulk'),
     path('mess/<int:mess_id>/add-expense/', views.add_expense, name='add_expense'),
     path('mess/<int:mess_id>/add-deposit/', views.add_deposit, name='add_deposit'),
+    path('mess/<int:mess_id>/import/', views.import_ledger_view, name='import_ledger'),
     path('mess/<int:mess_id>/view-reports/', views.view_reports, name='view_reports'),
+    path('mess/<int:mess_id>/range-reports/', views.range_reports, name='range_reports'),
+    path('mess/<int:mess_id>/close-month/', views.close_month_view, name='close_month'),
     path('mess/<int:mess_id>/download-report-pdf/', views.download_report_pdf, name='download_report_pdf'),
+    path('mess/<int:mess_id>/export/', views.export_ledger, name='export_ledger'),
+    path('mess/<int:mess_id>/reports/jobs/', views.request_report_job, name='request_report_job'),
+    path('mess/<int:mess_id>/reports/jobs/<int:job_id>/', views.report_job_status, name='report_job_status'),
+    path('mess/<int:mess_id>/reports/jobs/<int:job_id>/download/', views.download_report_job, name='download_report_job'),
     path('mess/<int:mess_id>/role-change/', views.role_change, name='role_change'),
     
     path('member/mess-list/', views.member_mess_list, name='member_mess_list'),
@@ -29,9 +37,15 @@ urlpatterns = [
     
     path('mess/<int:mess_id>/messages/', views.messages_view, name='manager_messages'),
     path('member/mess/<int:mess_id>/messages/', views.messages_view, name='member_messages'),
+    path('mess/<int:mess_id>/messages/history/', views.message_history, name='message_history'),
+    path('mess/<int:mess_id>/events/', views.mess_events, name='mess_events'),
     
     path('notifications/', views.notifications_view, name='notifications'),
+    path('notifications/page/', views.notifications_page, name='notifications_page'),
     path('notifications/mark-read/<int:notification_id>/', views.mark_notification_read, name='mark_notification_read'),
     path('notifications/mark-all-read/', views.mark_all_notifications_read, name='mark_all_notifications_read'),
     path('notifications/unread-count/', views.get_unread_count, name='get_unread_count'),
+    path('notifications/events/', views.notification_events, name='notification_events'),
+    
+    path('metrics/views/', views.view_metrics_json, name='view_metrics'),
 ]
\ No newline at end of file
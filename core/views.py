@@ -2,18 +2,39 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
-from .models import Mess, Membership, Meal, Expense, Deposit, Message, CustomUser, Notification
+from .models import Mess, Membership, Meal, Expense, Deposit, Message, CustomUser, Notification, ReportJob
 from .forms import CustomUserCreationForm, CustomAuthenticationForm
+from .access import membership_version, mess_member_required
+from .database import run_with_retry
+from .replicas import reads_from_replica
+from .shards import assign_shard
+from . import realtime
+from .bulk import MEAL_FIELDS, upsert_meals
+from .chat import latest_message, manager_ids, message_page
+from .instrumentation import view_metrics
+from .closing import carried_range_settlement, close_month, opening_balances, snapshot_settlement, with_balances
+from .imports import LedgerImportError, import_ledger
+from .exports import EXPORT_DATASETS, EXPORT_FORMATS, csv_stream, export_rows, xlsx_stream
+from .report_cache import cached_mess_totals, cached_pdf, cached_settlement
+from .report_jobs import render_report_pdf, report_filename, report_job_json, request_report
+from .notifications import mark_read, notification_page, notify_users, queue_notification, queue_user_notifications
+from .settlement import mess_totals, member_totals, month_bounds, parse_month_range, report_years
+from django.conf import settings
 from django.contrib import messages
+from django.core.paginator import Paginator
 from django.db import models
 from datetime import date, datetime, timedelta
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
-from xhtml2pdf import pisa
-from io import BytesIO
+from django.urls import reverse
+from django.views.decorators.http import condition
+import io
 import json
 from calendar import month_name
 
+MAX_BULK_MEAL_DAYS = 31
+MEMBER_DASHBOARD_PAGE_SIZE = 15
+
 def home(request):
     user_messes = None
     if request.user.is_authenticated:
@@ -75,8 +96,11 @@ def create_mess(request):
         name = request.POST.get('name')
         address = request.POST.get('address')
 
-        mess = Mess.objects.create(name=name, address=address)
-        Membership.objects.create(user=request.user, mess=mess, role='manager')
+        def create():
+            mess = Mess.objects.create(name=name, address=address, shard=assign_shard())
+            Membership.objects.create(user=request.user, mess=mess, role='manager')
+            return mess
+        mess = run_with_retry(create)
         
         messages.success(request, f'Mess "{name}" created successfully! Your mess code is: {mess.code}')
         return redirect('home')
@@ -91,7 +115,7 @@ def join_mess(request):
         try:
             mess = Mess.objects.get(code=code)
             if not Membership.objects.filter(user=request.user, mess=mess).exists():
-                Membership.objects.create(user=request.user, mess=mess, role='member')
+                run_with_retry(Membership.objects.create, user=request.user, mess=mess, role='member')
                 messages.success(request, f'Successfully joined {mess.name}!')
                 
                 return redirect('member_dashboard', mess_id=mess.id)
@@ -126,133 +150,98 @@ def dashboard(request):
         return redirect('home')
 
 @login_required
+@mess_member_required('manager', 'You do not have permission to access this mess.')
+@reads_from_replica
 def mess_dashboard(request, mess_id):
-    try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-        
-        if membership.role != 'manager':
-            messages.error(request, 'You do not have permission to access this mess.')
-            return redirect('home')
-
-        total_members = Membership.objects.filter(mess=mess).count()
-        
-        meals = Meal.objects.filter(mess=mess)
-        total_meals = 0
-        for meal in meals:
-            total_meals += meal.breakfast + meal.lunch + meal.dinner
-        
-        expense_agg = Expense.objects.filter(mess=mess).aggregate(total=models.Sum('amount'))
-        total_expense = expense_agg['total'] or 0
-         
-        deposit_agg = Deposit.objects.filter(mess=mess).aggregate(total=models.Sum('amount'))
-        total_deposit = deposit_agg['total'] or 0
-        
-        context = {
-            'mess': mess,
-            'membership': membership,
-            'total_members': total_members,
-            'total_meals': total_meals,
-            'total_expense': total_expense,
-            'total_deposit': total_deposit,
-        }
-        
-        return render(request, 'core/manager/dashboard.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+    mess = request.mess
+    membership = request.membership
+    
+    total_members = Membership.objects.filter(mess=mess).count()
+    
+    period = request.GET.get('period', 'month')
+    today = date.today()
+    if period == 'all':
+        totals = mess_totals(mess)
+        period_label = 'All Time'
+    else:
+        period = 'month'
+        totals = mess_totals(mess, today.year, today.month)
+        period_label = today.strftime("%B %Y")
+    
+    context = {
+        'mess': mess,
+        'membership': membership,
+        'total_members': total_members,
+        'period': period,
+        'period_label': period_label,
+        **totals,
+    }
+    
+    return render(request, 'core/manager/dashboard.html', context)
 
 @login_required
+@mess_member_required('manager', 'You do not have permission to manage members.')
 def manage_members(request, mess_id):
-    try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-
-        if membership.role != 'manager':
-            messages.error(request, 'You do not have permission to manage members.')
-            return redirect('home')
-        
-        members = Membership.objects.filter(mess=mess).select_related('user')
-        
-        context = {
-            'mess': mess,
-            'members': members,
-        }
-        
-        return render(request, 'core/manager/manage_members.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+    mess = request.mess
+    
+    members = Membership.objects.filter(mess=mess).select_related('user')
+    
+    context = {
+        'mess': mess,
+        'members': members,
+    }
+    
+    return render(request, 'core/manager/manage_members.html', context)
 
 @login_required
+@mess_member_required('manager', 'You do not have permission to remove members.')
 def remove_member(request, mess_id, user_id):
-    try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        user_membership = get_object_or_404(Membership, user=request.user, mess=mess)
-
-        if user_membership.role != 'manager':
-            messages.error(request, 'You do not have permission to remove members.')
-            return redirect('home')
-        
-        if request.user.id == user_id:
-            messages.error(request, 'You cannot remove yourself as manager.')
-            return redirect('manage_members', mess_id=mess_id)
-
-        member_to_remove = get_object_or_404(Membership, user__id=user_id, mess=mess)
-        username = member_to_remove.user.username
-        member_to_remove.delete()
-        
-        messages.success(request, f'Member {username} has been removed successfully.')
+    mess = request.mess
+    
+    if request.user.id == user_id:
+        messages.error(request, 'You cannot remove yourself as manager.')
         return redirect('manage_members', mess_id=mess_id)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Member not found or you do not have access.')
-        return redirect('home')
+
+    member_to_remove = get_object_or_404(Membership, user__id=user_id, mess=mess)
+    username = member_to_remove.user.username
+    run_with_retry(member_to_remove.delete)
+    
+    messages.success(request, f'Member {username} has been removed successfully.')
+    return redirect('manage_members', mess_id=mess_id)
 
 @login_required
+@mess_member_required('manager', 'You do not have permission to update accounts.')
 def update_accounts(request, mess_id):
-    try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-
-        if membership.role != 'manager':
-            messages.error(request, 'You do not have permission to update accounts.')
-            return redirect('home')
-        
-        members = Membership.objects.filter(mess=mess).select_related('user')
-        today = date.today()
-        
-        today_meals = Meal.objects.filter(mess=mess, date=today)
-        today_expenses = Expense.objects.filter(mess=mess, date=today)
-        today_deposits = Deposit.objects.filter(mess=mess, date=today)
-        
-        context = {
-            'mess': mess,
-            'members': members,
-            'today': today,
-            'today_meals': today_meals,
-            'today_expenses': today_expenses,
-            'today_deposits': today_deposits,
-        }
-        
-        return render(request, 'core/manager/update_accounts.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+    mess = request.mess
+    
+    members = Membership.objects.filter(mess=mess).select_related('user')
+    today = date.today()
+    
+    today_meals = Meal.objects.filter(mess=mess, date=today).select_related('user')
+    today_expenses = Expense.objects.filter(mess=mess, date=today).select_related('created_by')
+    today_deposits = Deposit.objects.filter(mess=mess, date=today).select_related('user')
+    
+    meals_by_user = {meal.user_id: meal for meal in today_meals}
+    meal_grid = [(member, meals_by_user.get(member.user_id)) for member in members]
+    
+    context = {
+        'mess': mess,
+        'members': members,
+        'meal_grid': meal_grid,
+        'today': today,
+        'today_meals': today_meals,
+        'today_expenses': today_expenses,
+        'today_deposits': today_deposits,
+    }
+    
+    return render(request, 'core/manager/update_accounts.html', context)
 
 @login_required
+@mess_member_required('manager', 'Permission denied.')
 def add_meal(request, mess_id):
     if request.method == 'POST':
         try:
-            mess = get_object_or_404(Mess, id=mess_id)
-            membership = get_object_or_404(Membership, user=request.user, mess=mess)
-            
-            if membership.role != 'manager':
-                messages.error(request, 'Permission denied.')
-                return redirect('home')
+            mess = request.mess
             
             user_id = request.POST.get('user')
             meal_date_str = request.POST.get('date')  
@@ -268,7 +257,8 @@ def add_meal(request, mess_id):
             
             user = get_object_or_404(CustomUser, id=user_id)
             
-            meal, created = Meal.objects.update_or_create(
+            meal, created = run_with_retry(
+                Meal.objects.update_or_create,
                 user=user, mess=mess, date=meal_date,  
                 defaults={'breakfast': breakfast, 'lunch': lunch, 'dinner': dinner}
             )
@@ -284,17 +274,74 @@ def add_meal(request, mess_id):
         return redirect('update_accounts', mess_id=mess_id)
     return redirect('update_accounts', mess_id=mess_id)
 
+@login_required
+@mess_member_required('manager', 'Permission denied.')
+def add_meals_bulk(request, mess_id):
+    """Record breakfast/lunch/dinner for every member over a date or date range in one request"""
+    if request.method == 'POST':
+        try:
+            mess = request.mess
+            
+            try:
+                start_date = datetime.strptime(request.POST.get('date'), '%Y-%m-%d').date()
+            except (ValueError, TypeError):
+                start_date = date.today()
+            try:
+                end_date = datetime.strptime(request.POST.get('end_date'), '%Y-%m-%d').date()
+            except (ValueError, TypeError):
+                end_date = start_date
+            
+            if end_date < start_date or (end_date - start_date).days >= MAX_BULK_MEAL_DAYS:
+                messages.error(request, f'Please choose a date range of at most {MAX_BULK_MEAL_DAYS} days.')
+                return redirect('update_accounts', mess_id=mess_id)
+            
+            member_ids = set(Membership.objects.filter(mess=mess).values_list('user_id', flat=True))
+            counts = {}
+            for user_id in request.POST.getlist('user'):
+                user_id = int(user_id)
+                if user_id not in member_ids:
+                    messages.error(request, f'User {user_id} is not a member of this mess.')
+                    return redirect('update_accounts', mess_id=mess_id)
+                counts[user_id] = [int(request.POST.get(f'{meal}_{user_id}') or 0) for meal in MEAL_FIELDS]
+                if min(counts[user_id]) < 0:
+                    raise ValueError('meal counts cannot be negative')
+            
+            days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+            period = f'{start_date}' if start_date == end_date else f'{start_date} to {end_date}'
+
+            def save():
+                written = upsert_meals(mess, [
+                    (user_id, day, *user_counts)
+                    for day in days
+                    for user_id, user_counts in counts.items()
+                ])
+                changed_users = sorted({meal.user_id for meal, created in written})
+                queue_user_notifications(
+                    [
+                        (user_id, f'Meal entries recorded for {period}: B{counts[user_id][0]}, L{counts[user_id][1]}, D{counts[user_id][2]}')
+                        for user_id in changed_users
+                    ],
+                    title='Meal Entries Updated',
+                    notification_type='info',
+                    mess=mess
+                )
+                return written
+            written = run_with_retry(save)
+            
+            messages.success(request, f'Saved {len(written)} meal entries for {period}.')
+            
+        except ValueError as e:
+            messages.error(request, f'Invalid data provided: {str(e)}')
+        
+        return redirect('update_accounts', mess_id=mess_id)
+    return redirect('update_accounts', mess_id=mess_id)
 
 @login_required
+@mess_member_required('manager', 'Permission denied.')
 def add_expense(request, mess_id):
     if request.method == 'POST':
         try:
-            mess = get_object_or_404(Mess, id=mess_id)
-            membership = get_object_or_404(Membership, user=request.user, mess=mess)
-            
-            if membership.role != 'manager':
-                messages.error(request, 'Permission denied.')
-                return redirect('home')
+            mess = request.mess
             
             amount = float(request.POST.get('amount', 0))
             description = request.POST.get('description', '').strip()
@@ -308,7 +355,8 @@ def add_expense(request, mess_id):
             
            
             if description:
-                Expense.objects.create(
+                run_with_retry(
+                    Expense.objects.create,
                     mess=mess,
                     amount=amount,
                     description=description,
@@ -329,15 +377,11 @@ def add_expense(request, mess_id):
     return redirect('update_accounts', mess_id=mess_id)
 
 @login_required
+@mess_member_required('manager', 'Permission denied.')
 def add_deposit(request, mess_id):
     if request.method == 'POST':
         try:
-            mess = get_object_or_404(Mess, id=mess_id)
-            membership = get_object_or_404(Membership, user=request.user, mess=mess)
-            
-            if membership.role != 'manager':
-                messages.error(request, 'Permission denied.')
-                return redirect('home')
+            mess = request.mess
             
             user_id = request.POST.get('user')
             amount = float(request.POST.get('amount', 0))
@@ -352,7 +396,8 @@ def add_deposit(request, mess_id):
             user = get_object_or_404(CustomUser, id=user_id)
             
             
-            Deposit.objects.create(
+            run_with_retry(
+                Deposit.objects.create,
                 user=user,
                 mess=mess,
                 amount=amount,
@@ -372,231 +417,299 @@ def add_deposit(request, mess_id):
 
 
 @login_required
+@mess_member_required('manager', 'Permission denied.')
+def import_ledger_view(request, mess_id):
+    """Import a CSV of meals, expenses and deposits, see core.imports for the format"""
+    if request.method != 'POST' or 'file' not in request.FILES:
+        messages.error(request, 'Please choose a CSV file to import.')
+        return redirect('update_accounts', mess_id=mess_id)
+    
+    # Decoded as it is read, the upload is never held in memory as a whole
+    lines = io.TextIOWrapper(request.FILES['file'].file, encoding='utf-8-sig', newline='')
+    try:
+        counts = import_ledger(request.mess, lines, request.user)
+    except LedgerImportError as e:
+        shown = e.errors[:5]
+        more = f' and {len(e.errors) - len(shown)} more' if len(e.errors) > len(shown) else ''
+        messages.error(request, 'Nothing was imported: ' + '; '.join(
+            f'line {line}: {error}' for line, error in shown
+        ) + more)
+    except UnicodeDecodeError:
+        messages.error(request, 'Nothing was imported: the file is not UTF-8 encoded CSV.')
+    else:
+        messages.success(
+            request,
+            f'Imported {counts["meals"]} meal entries, {counts["expenses"]} expenses and {counts["deposits"]} deposits.'
+        )
+    return redirect('update_accounts', mess_id=mess_id)
+
+@login_required
+@mess_member_required('manager', 'You do not have permission to view reports.')
+@reads_from_replica
 def view_reports(request, mess_id):
+    mess = request.mess
+    
+    selected_month = request.GET.get('month', datetime.now().month)
+    selected_year = request.GET.get('year', datetime.now().year)
+    
     try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-        
-        if membership.role != 'manager':
-            messages.error(request, 'You do not have permission to view reports.')
-            return redirect('home')
+        selected_month = int(selected_month)
+        selected_year = int(selected_year)
+    except (ValueError, TypeError):
+        selected_month = datetime.now().month
+        selected_year = datetime.now().year
+
+    first_day, last_day = month_bounds(selected_year, selected_month)
+
+    expenses = Expense.objects.filter(mess=mess, date__range=[first_day, last_day]).select_related('created_by')
+    deposits = Deposit.objects.filter(mess=mess, date__range=[first_day, last_day]).select_related('user')
+    settlement = snapshot_settlement(mess, selected_year, selected_month)
+    if settlement is None:
+        settlement = with_balances(
+            cached_settlement(mess, selected_year, selected_month),
+            opening_balances(mess, selected_year, selected_month),
+        )
+    today = date.today()
+    
+    months = [(i, month_name[i]) for i in range(1, 13)]
+    years = report_years(mess)
+    
+    context = {
+        'mess': mess,
+        'month': first_day.strftime("%B %Y"),
+        'selected_month': selected_month,
+        'selected_year': selected_year,
+        'months': months,
+        'years': years,
+        'expenses': expenses,
+        'deposits': deposits,
+        'can_close': not settlement['closed'] and (selected_year, selected_month) <= (today.year, today.month),
+        'report_jobs': getattr(settings, 'REPORT_JOBS', True),
+        'report_job_id': request.GET.get('job', '') if request.GET.get('job', '').isdigit() else '',
+        **settlement,
+    }
+    
+    return render(request, 'core/manager/view_reports.html', context)
 
-        selected_month = request.GET.get('month', datetime.now().month)
-        selected_year = request.GET.get('year', datetime.now().year)
-        
-        try:
-            selected_month = int(selected_month)
-            selected_year = int(selected_year)
-        except (ValueError, TypeError):
-            selected_month = datetime.now().month
-            selected_year = datetime.now().year
-
-        first_day = date(selected_year, selected_month, 1)
-        if selected_month == 12:
-            last_day = date(selected_year + 1, 1, 1) - timedelta(days=1)
-        else:
-            last_day = date(selected_year, selected_month + 1, 1) - timedelta(days=1)
+@login_required
+@mess_member_required('manager', 'Only managers can close months.')
+def close_month_view(request, mess_id):
+    if request.method != 'POST':
+        return redirect('view_reports', mess_id=mess_id)
+    
+    mess = request.mess
+    
+    try:
+        selected_month = int(request.POST.get('month'))
+        selected_year = int(request.POST.get('year'))
+        if not 1 <= selected_month <= 12:
+            raise ValueError('Invalid month')
+
+        def close():
+            closed = close_month(mess, selected_year, selected_month, user=request.user)
+            labels = ', '.join(date(year, month, 1).strftime('%B %Y') for year, month in closed)
+            queue_notification(
+                title='Month Closed',
+                message=f'{labels} closed by {request.user.username}. Balances are carried forward.',
+                notification_type='info',
+                mess=mess
+            )
+            return labels
+        labels = run_with_retry(close)
+    except (ValueError, TypeError) as e:
+        messages.error(request, f'Could not close the month: {e}')
+        return redirect('view_reports', mess_id=mess_id)
+    
+    messages.success(request, f'Closed {labels}.')
+    return redirect(f"{reverse('view_reports', args=[mess.id])}?month={selected_month}&year={selected_year}")
 
-        meals = Meal.objects.filter(mess=mess, date__range=[first_day, last_day])
-        expenses = Expense.objects.filter(mess=mess, date__range=[first_day, last_day])
-        deposits = Deposit.objects.filter(mess=mess, date__range=[first_day, last_day])
-        members = Membership.objects.filter(mess=mess)
-        
-        total_expense = expenses.aggregate(total=models.Sum('amount'))['total'] or 0
-        total_deposit = deposits.aggregate(total=models.Sum('amount'))['total'] or 0
-        
-        grand_total_meals = 0
-        member_meals = {}
-        
-        for meal in meals:
-            total_meals = meal.breakfast + meal.lunch + meal.dinner
-            grand_total_meals += total_meals
-            if meal.user.id not in member_meals:
-                member_meals[meal.user.id] = 0
-            member_meals[meal.user.id] += total_meals
-        
-        meal_rate = total_expense / grand_total_meals if grand_total_meals > 0 else 0
-        
-        member_reports = []
-        for member in members:
-            total_meal = member_meals.get(member.user.id, 0)
-            total_cost = total_meal * meal_rate
-            member_deposit = deposits.filter(user=member.user).aggregate(total=models.Sum('amount'))['total'] or 0
-            balance = member_deposit - total_cost
-            
-            member_reports.append({
-                'user': member.user,
-                'total_meal': total_meal,
-                'total_cost': total_cost,
-                'total_deposit': member_deposit,
-                'balance': balance,
-                'role': member.role
-            })
-        
-        months = [(i, month_name[i]) for i in range(1, 13)]
-        current_year = datetime.now().year
-        years = list(range(current_year - 2, current_year + 1))
-        
-        context = {
-            'mess': mess,
-            'month': first_day.strftime("%B %Y"),
-            'selected_month': selected_month,
-            'selected_year': selected_year,
-            'months': months,
-            'years': years,
-            'grand_total_meals': grand_total_meals,
-            'total_expense': total_expense,
-            'total_deposit': total_deposit,
-            'meal_rate': meal_rate,
-            'member_reports': member_reports,
-            'expenses': expenses,
-            'deposits': deposits,
-        }
-        
-        return render(request, 'core/manager/view_reports.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+# Request parameters read by each range report mode
+RANGE_REPORT_MODES = {
+    'year': ('year',),
+    'quarter': ('year', 'quarter'),
+    'range': ('start', 'end'),
+}
+
+@login_required
+@mess_member_required('manager', 'You do not have permission to view reports.')
+def range_reports(request, mess_id):
+    mess = request.mess
+    
+    today = date.today()
+    mode = request.GET.get('mode', 'year')
+    if mode not in RANGE_REPORT_MODES:
+        mode = 'year'
+    params = {key: request.GET.get(key, '') for key in RANGE_REPORT_MODES[mode]}
+    if mode != 'range':
+        params['year'] = params['year'] or str(today.year)
+    
+    try:
+        months = parse_month_range(params)
+    except ValueError as e:
+        messages.error(request, f'Invalid report period: {e}')
+        months = parse_month_range({'year': str(today.year)})
+        mode = 'year'
+    
+    settlement = carried_range_settlement(mess, months)
+    trend = settlement['trend']
+    (start_year, start_month), (end_year, end_month) = months[0], months[-1]
+    
+    context = {
+        'mess': mess,
+        'mode': mode,
+        'period_label': f"{trend[0]['label']} - {trend[-1]['label']}" if len(trend) > 1 else trend[0]['label'],
+        'years': report_years(mess),
+        'quarters': range(1, 5),
+        'selected_year': end_year,
+        'selected_quarter': (start_month - 1) // 3 + 1,
+        'start': f'{start_year}-{start_month:02d}',
+        'end': f'{end_year}-{end_month:02d}',
+        'max_meals': max(entry['total_meals'] for entry in trend) or 1,
+        'max_expense': max(entry['total_expense'] for entry in trend) or 1,
+        'max_deposit': max(entry['total_deposit'] for entry in trend) or 1,
+        **settlement,
+    }
+    
+    return render(request, 'core/manager/range_reports.html', context)
 
 @login_required
+@mess_member_required('manager', 'Only managers can download reports.')
+@reads_from_replica
 def download_report_pdf(request, mess_id):
+    mess = request.mess
     try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-        
-        if membership.role != 'manager':
-            messages.error(request, 'Only managers can download reports.')
-            return redirect('home')
-        
-        selected_month = request.GET.get('month', datetime.now().month)
-        selected_year = request.GET.get('year', datetime.now().year)
-        
-        try:
-            selected_month = int(selected_month)
-            selected_year = int(selected_year)
-        except (ValueError, TypeError):
-            selected_month = datetime.now().month
-            selected_year = datetime.now().year
-
-        first_day = date(selected_year, selected_month, 1)
-        if selected_month == 12:
-            last_day = date(selected_year + 1, 1, 1) - timedelta(days=1)
-        else:
-            last_day = date(selected_year, selected_month + 1, 1) - timedelta(days=1)
-        
-        meals = Meal.objects.filter(mess=mess, date__range=[first_day, last_day])
-        expenses = Expense.objects.filter(mess=mess, date__range=[first_day, last_day])
-        deposits = Deposit.objects.filter(mess=mess, date__range=[first_day, last_day])
-        members = Membership.objects.filter(mess=mess)
-        
-        total_expense = expenses.aggregate(total=models.Sum('amount'))['total'] or 0
-        total_deposit = deposits.aggregate(total=models.Sum('amount'))['total'] or 0
-     
-        grand_total_meals = 0
-        member_meals = {}
-        
-        for meal in meals:
-            total_meals = meal.breakfast + meal.lunch + meal.dinner
-            grand_total_meals += total_meals
-            if meal.user.id not in member_meals:
-                member_meals[meal.user.id] = 0
-            member_meals[meal.user.id] += total_meals
-        
-        meal_rate = total_expense / grand_total_meals if grand_total_meals > 0 else 0
-        
-        member_reports = []
-        for member in members:
-            total_meal = member_meals.get(member.user.id, 0)
-            total_cost = total_meal * meal_rate
-            member_deposit = deposits.filter(user=member.user).aggregate(total=models.Sum('amount'))['total'] or 0
-            balance = member_deposit - total_cost
-            
-            member_reports.append({
-                'user': member.user,
-                'total_meal': total_meal,
-                'total_cost': total_cost,
-                'total_deposit': member_deposit,
-                'balance': balance,
-                'role': member.role
-            })
-        
-        context = {
-            'mess': mess,
-            'month': first_day.strftime("%B %Y"),
-            'selected_month': selected_month,
-            'selected_year': selected_year,
-            'grand_total_meals': grand_total_meals,
-            'total_expense': total_expense,
-            'total_deposit': total_deposit,
-            'meal_rate': meal_rate,
-            'member_reports': member_reports,
-            'expenses': expenses,
-            'deposits': deposits,
-        }
-        
-        html_string = render_to_string('core/manager/report_pdf_simple.html', context)
-        
-        result = BytesIO()
+        selected_month = int(request.GET.get('month', datetime.now().month))
+        selected_year = int(request.GET.get('year', datetime.now().year))
+        if not 1 <= selected_month <= 12:
+            raise ValueError
+    except (ValueError, TypeError):
+        messages.error(request, 'Invalid month or year')
+        return redirect('view_reports', mess_id=mess_id)
 
-        pdf = pisa.pisaDocument(BytesIO(html_string.encode("UTF-8")), result)
-        
-        if not pdf.err:
-            response = HttpResponse(result.getvalue(), content_type='application/pdf')
-            filename = f"{mess.name}_report_{selected_month}_{selected_year}.pdf"
-            response['Content-Disposition'] = f'attachment; filename="{filename}"'
-            return response
+    try:
+        if getattr(settings, 'REPORT_JOBS', True):
+            job = request_report(mess, selected_year, selected_month, request.user)
+            if job.status == 'done':
+                return redirect('download_report_job', mess_id=mess.id, job_id=job.id)
+            messages.info(request, 'Your PDF report is being generated. The download starts when it is ready.')
+            return redirect(
+                f"{reverse('view_reports', args=[mess.id])}?month={selected_month}&year={selected_year}&job={job.id}"
+            )
         
-        return HttpResponse('Error generating PDF: ' + str(pdf.err))
+        content = cached_pdf(mess, selected_year, selected_month,
+                             lambda: render_report_pdf(mess, selected_year, selected_month))
+        response = HttpResponse(content, content_type='application/pdf')
+        response['Content-Disposition'] = f'attachment; filename="{report_filename(mess, selected_year, selected_month)}"'
+        return response
         
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
     except Exception as e:
         messages.error(request, f'Error generating PDF: {str(e)}')
         return redirect('view_reports', mess_id=mess_id)
     
 @login_required
-def role_change(request, mess_id):
+@mess_member_required('manager', 'Only managers can export reports.')
+def export_ledger(request, mess_id):
+    mess = request.mess
+    
+    dataset = request.GET.get('dataset', 'settlement')
+    export_format = request.GET.get('format', 'csv')
     try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        current_user_membership = get_object_or_404(Membership, user=request.user, mess=mess)
-        
-        if current_user_membership.role != 'manager':
-            messages.error(request, 'Only managers can change roles.')
-            return redirect('home')
-        
-        members = Membership.objects.filter(mess=mess).exclude(user=request.user)
+        if dataset not in EXPORT_DATASETS or export_format not in EXPORT_FORMATS:
+            raise ValueError('Unknown export type')
+        months = parse_month_range(request.GET)
+    except ValueError as e:
+        messages.error(request, f'Invalid export: {e}')
+        return redirect('view_reports', mess_id=mess_id)
+    
+    header, rows = export_rows(mess, dataset, months)
+    (start_year, start_month), (end_year, end_month) = months[0], months[-1]
+    filename = f"{mess.name}_{dataset}_{start_year}-{start_month:02d}_{end_year}-{end_month:02d}.{export_format}"
+    
+    if export_format == 'xlsx':
+        response = StreamingHttpResponse(
+            xlsx_stream(header, rows, sheet_name=dataset.title()),
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        )
+    else:
+        response = StreamingHttpResponse(csv_stream(header, rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@login_required
+@mess_member_required('manager', 'Only managers can download reports.', json=True)
+def request_report_job(request, mess_id):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    
+    mess = request.mess
+    
+    try:
+        selected_month = int(request.POST.get('month', datetime.now().month))
+        selected_year = int(request.POST.get('year', datetime.now().year))
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Invalid month or year'}, status=400)
+    if not 1 <= selected_month <= 12:
+        return JsonResponse({'error': 'Invalid month or year'}, status=400)
+    
+    job = run_with_retry(request_report, mess, selected_year, selected_month, request.user)
+    return JsonResponse({
+        **report_job_json(job),
+        'status_url': reverse('report_job_status', args=[mess.id, job.id]),
+    })
+
+@login_required
+@mess_member_required('manager', 'Only managers can download reports.', json=True)
+def report_job_status(request, mess_id, job_id):
+    job = get_object_or_404(ReportJob, id=job_id, mess_id=mess_id)
+    return JsonResponse(report_job_json(job))
+
+@login_required
+@mess_member_required('manager', 'Only managers can download reports.')
+def download_report_job(request, mess_id, job_id):
+    job = get_object_or_404(ReportJob, id=job_id, mess_id=mess_id)
+    if job.status != 'done' or not job.file:
+        messages.error(request, 'This report is not ready yet.')
+        return redirect('view_reports', mess_id=mess_id)
+    
+    return FileResponse(job.file.open('rb'), as_attachment=True,
+                        filename=report_filename(request.mess, job.year, job.month),
+                        content_type='application/pdf')
+    
+@login_required
+@mess_member_required('manager', 'Only managers can change roles.')
+def role_change(request, mess_id):
+    mess = request.mess
+    current_user_membership = request.membership
+    
+    members = Membership.objects.filter(mess=mess).exclude(user=request.user)
+    
+    if request.method == 'POST':
+        new_manager_id = request.POST.get('new_manager')
         
-        if request.method == 'POST':
-            new_manager_id = request.POST.get('new_manager')
-            
-            try:
-                new_manager_membership = get_object_or_404(Membership, id=new_manager_id, mess=mess)
+        try:
+            new_manager_membership = get_object_or_404(Membership, id=new_manager_id, mess=mess)
 
+            def transfer():
                 current_user_membership.role = 'member'
                 current_user_membership.save()
                 
                 new_manager_membership.role = 'manager'
                 new_manager_membership.save()
-                
-                messages.success(request, f'Manager role transferred to {new_manager_membership.user.username}. You are now a member.')
-                return redirect('home')
-                
-            except (Membership.DoesNotExist, ValueError):
-                messages.error(request, 'Invalid selection.')
-        
-        context = {
-            'mess': mess,
-            'members': members,
-            'current_user_membership': current_user_membership,
-        }
-        
-        return render(request, 'core/manager/role_change.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+            run_with_retry(transfer)
+            
+            messages.success(request, f'Manager role transferred to {new_manager_membership.user.username}. You are now a member.')
+            return redirect('home')
+            
+        except (Membership.DoesNotExist, ValueError):
+            messages.error(request, 'Invalid selection.')
+    
+    context = {
+        'mess': mess,
+        'members': members,
+        'current_user_membership': current_user_membership,
+    }
+    
+    return render(request, 'core/manager/role_change.html', context)
 
 @login_required
 def member_mess_list(request):
@@ -604,138 +717,188 @@ def member_mess_list(request):
     return render(request, 'core/member/mess_list.html', {'user_messes': user_messes})
 
 @login_required
+@mess_member_required()
+@reads_from_replica
 def member_dashboard(request, mess_id):
-    try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
+    mess = request.mess
+    membership = request.membership
+    
+    today = datetime.now().date()
+    first_day, last_day = month_bounds(today.year, today.month)
+
+    member_meals = Meal.objects.filter(
+        user=request.user, mess=mess, date__range=[first_day, last_day]
+    ).order_by('-date')
+    member_deposits = Deposit.objects.filter(
+        user=request.user, mess=mess, date__range=[first_day, last_day]
+    ).order_by('-date', '-id')
+
+    mess_month = cached_mess_totals(mess, today.year, today.month)
+    own = member_totals(mess, request.user, today.year, today.month)
+    total_cost = own['total_meal'] * mess_month['meal_rate']
+    balance = own['total_deposit'] - total_cost
+    carried_forward = opening_balances(mess, today.year, today.month).get(request.user.id, 0)
+    
+    context = {
+        'mess': mess,
+        'membership': membership,
+        'total_meals': own['total_meal'],
+        'total_deposit': own['total_deposit'],
+        'total_cost': total_cost,
+        'balance': balance,
+        'carried_forward': carried_forward,
+        'closing_balance': carried_forward + balance,
+        'meal_rate': mess_month['meal_rate'],
+        'month': first_day.strftime("%B %Y"),
+        'member_meals': Paginator(member_meals, MEMBER_DASHBOARD_PAGE_SIZE).get_page(request.GET.get('meals_page')),
+        'member_deposits': Paginator(member_deposits, MEMBER_DASHBOARD_PAGE_SIZE).get_page(request.GET.get('deposits_page')),
+    }
+    
+    return render(request, 'core/member/dashboard.html', context)
 
-        today = datetime.now().date()
-        first_day = today.replace(day=1)
-        last_day = (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+@login_required
+@mess_member_required()
+def member_members(request, mess_id):
+    mess = request.mess
+    membership = request.membership
+    
+    members = Membership.objects.filter(mess=mess).select_related('user')
+    
+    context = {
+        'mess': mess,
+        'membership': membership,
+        'members': members,
+    }
+    
+    return render(request, 'core/member/members.html', context)
 
-        member_meals = Meal.objects.filter(user=request.user, mess=mess, date__range=[first_day, last_day])
-        member_deposits = Deposit.objects.filter(user=request.user, mess=mess, date__range=[first_day, last_day])
+@login_required
+@mess_member_required()
+def messages_view(request, mess_id):
+    mess = request.mess
+    membership = request.membership
+    
+    if request.method == 'POST':
+        content = request.POST.get('content', '').strip()
+        if content:
+            run_with_retry(
+                Message.objects.create,
+                mess=mess,
+                user=request.user,
+                content=content
+            )
+            messages.success(request, 'Message sent successfully!')
+            if membership.role == 'manager':
+                return redirect('manager_messages', mess_id=mess_id)
+            else:
+                return redirect('member_messages', mess_id=mess_id)
+    
+    mess_messages, has_more = message_page(mess)
+    
+    context = {
+        'mess': mess,
+        'membership': membership,
+        'messages': mess_messages,
+        'manager_ids': manager_ids(mess),
+        'has_more_messages': has_more,
+    }
 
-        total_meals = sum(meal.breakfast + meal.lunch + meal.dinner for meal in member_meals)
-        total_deposit = member_deposits.aggregate(total=models.Sum('amount'))['total'] or 0
+    if membership.role == 'manager':
+        return render(request, 'core/manager/messages.html', context)
+    else:
+        return render(request, 'core/member/messages.html', context)
 
-        mess_expenses = Expense.objects.filter(mess=mess, date__range=[first_day, last_day])
-        total_expense = mess_expenses.aggregate(total=models.Sum('amount'))['total'] or 0
- 
-        all_meals = Meal.objects.filter(mess=mess, date__range=[first_day, last_day])
-        grand_total_meals = sum(meal.breakfast + meal.lunch + meal.dinner for meal in all_meals)
-        meal_rate = total_expense / grand_total_meals if grand_total_meals > 0 else 0
-        
-        total_cost = total_meals * meal_rate
-        balance = total_deposit - total_cost
-        
-        context = {
-            'mess': mess,
-            'membership': membership,
-            'total_meals': total_meals,
-            'total_deposit': total_deposit,
-            'total_cost': total_cost,
-            'balance': balance,
-            'meal_rate': meal_rate,
-            'month': first_day.strftime("%B %Y"),
-            'member_meals': member_meals,
-            'member_deposits': member_deposits,
-        }
-        
-        return render(request, 'core/member/dashboard.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+def _latest_message(request, mess_id):
+    if '_latest_message' not in request.__dict__:
+        request._latest_message = latest_message(mess_id)
+    return request._latest_message
 
-@login_required
-def member_members(request, mess_id):
-    try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-        
-        members = Membership.objects.filter(mess=mess).select_related('user')
-        
-        context = {
-            'mess': mess,
-            'membership': membership,
-            'members': members,
-        }
-        
-        return render(request, 'core/member/members.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+def _message_history_etag(request, mess_id):
+    latest = _latest_message(request, mess_id)
+    return f'{mess_id}-{latest[0] if latest else 0}-{membership_version(mess_id)}'
+
+def _message_history_last_modified(request, mess_id):
+    latest = _latest_message(request, mess_id)
+    return latest[1] if latest else None
 
 @login_required
-def messages_view(request, mess_id):
+@mess_member_required(json=True)
+@condition(etag_func=_message_history_etag, last_modified_func=_message_history_last_modified)
+def message_history(request, mess_id):
+    """JSON page of chat messages older than ?before=<id> or newer than ?after=<id>"""
     try:
-        mess = get_object_or_404(Mess, id=mess_id)
-        membership = get_object_or_404(Membership, user=request.user, mess=mess)
-        
-        if request.method == 'POST':
-            content = request.POST.get('content', '').strip()
-            if content:
-                Message.objects.create(
-                    mess=mess,
-                    user=request.user,
-                    content=content
-                )
-                messages.success(request, 'Message sent successfully!')
-                if membership.role == 'manager':
-                    return redirect('manager_messages', mess_id=mess_id)
-                else:
-                    return redirect('member_messages', mess_id=mess_id)
-        
-        mess_messages = Message.objects.filter(mess=mess).select_related('user').order_by('-created_at')[:50]
-        
-        context = {
-            'mess': mess,
-            'membership': membership,
-            'messages': mess_messages,
-        }
-
-        if membership.role == 'manager':
-            return render(request, 'core/manager/messages.html', context)
-        else:
-            return render(request, 'core/member/messages.html', context)
-        
-    except (Mess.DoesNotExist, Membership.DoesNotExist):
-        messages.error(request, 'Mess not found or you do not have access.')
-        return redirect('home')
+        before = int(request.GET['before']) if request.GET.get('before') else None
+        after = int(request.GET['after']) if request.GET.get('after') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid message id'}, status=400)
+    
+    page, has_more = message_page(request.mess, before=before, after=after)
+    managers = manager_ids(request.mess)
+    return JsonResponse({
+        'messages': [
+            {
+                'id': message.id,
+                'user_id': message.user_id,
+                'username': message.user.username,
+                'role': 'manager' if message.user_id in managers else 'member',
+                'content': message.content,
+                'created_at': message.created_at.isoformat(),
+            }
+            for message in page
+        ],
+        'html': render_to_string('core/message_items.html', {'messages': page, 'manager_ids': managers}, request=request),
+        'has_more': has_more,
+    })
 
 def create_notification(user, title, message, notification_type='info', mess=None):
     """Helper function to create notifications"""
-    Notification.objects.create(
-        user=user,
-        mess=mess,
-        title=title,
-        message=message,
-        notification_type=notification_type
-    )
+    notify_users([user.id], title, message, notification_type, mess=mess)
 
 @login_required
 def notifications_view(request):
     """View user notifications"""
-    user_notifications = Notification.objects.filter(user=request.user).order_by('-created_at')
-    unread_count = user_notifications.filter(is_read=False).count()
+    user_notifications, next_cursor = notification_page(request.user, request.GET.get('cursor'))
+    unread_count = request.user.unread_notifications
     
-    user_notifications.update(is_read=True)
+    mark_read(request.user, Notification.objects.filter(id__in=[n.id for n in user_notifications]))
     
     context = {
         'notifications': user_notifications,
         'unread_count': unread_count,
+        'next_cursor': next_cursor,
     }
     return render(request, 'core/notifications.html', context)
 
+@login_required
+def notifications_page(request):
+    """JSON page of notifications for infinite scroll"""
+    user_notifications, next_cursor = notification_page(request.user, request.GET.get('cursor'))
+    mark_read(request.user, Notification.objects.filter(id__in=[n.id for n in user_notifications]))
+    
+    return JsonResponse({
+        'notifications': [
+            {
+                'id': notification.id,
+                'title': notification.title,
+                'message': notification.message,
+                'notification_type': notification.notification_type,
+                'is_read': notification.is_read,
+                'mess': notification.mess.name if notification.mess else None,
+                'created_at': notification.created_at.isoformat(),
+            }
+            for notification in user_notifications
+        ],
+        'html': render_to_string('core/notification_items.html', {'notifications': user_notifications}),
+        'next_cursor': next_cursor,
+        'unread_count': request.user.unread_notifications,
+    })
+
 @login_required
 def mark_notification_read(request, notification_id):
     """Mark a single notification as read"""
     try:
         notification = get_object_or_404(Notification, id=notification_id, user=request.user)
-        notification.is_read = True
-        notification.save()
+        run_with_retry(mark_read, request.user, Notification.objects.filter(id=notification.id))
         return JsonResponse({'success': True})
     except Notification.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Notification not found'})
@@ -743,11 +906,46 @@ def mark_notification_read(request, notification_id):
 @login_required
 def mark_all_notifications_read(request):
     """Mark all notifications as read"""
-    Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+    run_with_retry(mark_read, request.user, Notification.objects.all())
     return JsonResponse({'success': True})
 
 @login_required
 def get_unread_count(request):
     """API endpoint for unread notification count"""
-    unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
-    return JsonResponse({'unread_count': unread_count})
\ No newline at end of file
+    return JsonResponse({'unread_count': request.user.unread_notifications})
+
+def _event_response(request, channels, initial):
+    if not realtime.streams_enabled(request):
+        raise Http404('Event streams are not enabled.')
+    response = StreamingHttpResponse(realtime.event_stream(channels, initial), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+async def notification_events(request):
+    """Server-sent events carrying the user's unread notification count"""
+    user = await request.auser()
+    return _event_response(
+        request,
+        [realtime.user_channel(user.id)],
+        [('unread', {'unread_count': user.unread_notifications})],
+    )
+
+@login_required
+@mess_member_required()
+async def mess_events(request, mess_id):
+    """Server-sent events with new chat messages of the mess and the user's unread count"""
+    user = request.user
+    return _event_response(
+        request,
+        [realtime.mess_channel(mess_id), realtime.user_channel(user.id)],
+        [('unread', {'unread_count': user.unread_notifications})],
+    )
+
+@login_required
+def view_metrics_json(request):
+    """Rolling per-view latency and query percentiles, staff only"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    return JsonResponse({'views': view_metrics.summary()})
\ No newline at end of file
@@ -3,6 +3,13 @@ ASGI config for mess_manager project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it to enable the server-sent event streams of new messages and unread
+counts, which are off by default and never served over WSGI:
+
+    REALTIME_PUSH=1 uvicorn mess_manager.asgi:application --workers 1
+
+More workers need a shared REALTIME_BROKER, see settings.py.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -11,7 +11,9 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import importlib.util
 import os
+import sys
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -33,11 +35,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.PrimaryAfterWriteMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -46,7 +50,7 @@ ROOT_URLCONF = 'mess_manager.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'core.instrumentation.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],  
         'APP_DIRS': True,
         'OPTIONS': {
@@ -55,6 +59,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'core.context_processors.notification_count',  
+                'core.context_processors.realtime_events',
             ],
         },
     },
@@ -63,25 +68,188 @@ TEMPLATES = [
 WSGI_APPLICATION = 'mess_manager.wsgi.application'
 
 
+# PostgreSQL connections are reused instead of opened per request. With
+# psycopg 3 and psycopg_pool installed each worker keeps a pool of
+# DB_POOL_MIN_SIZE to DB_POOL_MAX_SIZE connections, closing ones idle for
+# DB_POOL_MAX_IDLE seconds and waiting up to DB_POOL_TIMEOUT seconds for a
+# free one. Without the pool a connection persists for DB_CONN_MAX_AGE
+# seconds. Reused connections are checked before use when
+# DB_CONN_HEALTH_CHECKS is on, and the server cancels any statement running
+# longer than DB_STATEMENT_TIMEOUT_MS.
+DB_POOL = os.environ.get('DB_POOL', '1') == '1' and all(
+    importlib.util.find_spec(name) for name in ('psycopg', 'psycopg_pool')
+)
+DB_CONN_HEALTH_CHECKS = os.environ.get('DB_CONN_HEALTH_CHECKS', '1') == '1'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'mess_manager_db',
-        'USER': 'mess_manager_user',         
-        'PASSWORD': 'password123',   
-        'HOST': 'localhost',
-        'PORT': '5432',
+        'NAME': os.environ.get('DB_NAME', 'mess_manager_db'),
+        'USER': os.environ.get('DB_USER', 'mess_manager_user'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', 'password123'),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+        'OPTIONS': {
+            'options': f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))}",
+        },
     }
 }
 
-try:
-    import psycopg2
-except ImportError:
+if DB_POOL:
+    from psycopg_pool import ConnectionPool
+
+    # A pooled connection goes back to the pool at the end of each request,
+    # Django refuses to also keep it persistent
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+        'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    }
+    if DB_CONN_HEALTH_CHECKS:
+        DATABASES['default']['OPTIONS']['pool']['check'] = ConnectionPool.check_connection
+
+if not any(importlib.util.find_spec(name) for name in ('psycopg', 'psycopg2')):
+    # Every connection switches to WAL so readers never wait for the writer,
+    # syncs at NORMAL (safe with WAL, an OS crash only loses the latest
+    # commits), waits for locks instead of failing and keeps hot pages mapped
+    # and cached. Transactions start with BEGIN IMMEDIATE so a writer takes
+    # the lock up front rather than failing half-way when upgrading to it.
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
     DATABASES['default'] = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': str(BASE_DIR / 'db.sqlite3'),  
+        'NAME': os.environ.get('SQLITE_PATH', str(BASE_DIR / 'db.sqlite3')),
+        'OPTIONS': {
+            'init_command': '; '.join([
+                'PRAGMA journal_mode=WAL',
+                'PRAGMA synchronous=NORMAL',
+                f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}',
+                f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+                f"PRAGMA cache_size=-{int(os.environ.get('SQLITE_CACHE_KIB', 64 * 1024))}",
+                'PRAGMA temp_store=MEMORY',
+            ]),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+        },
+    }
+
+# Optional read replica for the report and dashboard views decorated with
+# core.replicas.reads_from_replica. DB_REPLICA_HOST points at a PostgreSQL
+# standby, SQLITE_REPLICA_PATH at a copy of the SQLite file. Tests read the
+# replica alias from the test database. A user who wrote reads from the
+# primary for REPLICA_STICKY_SECONDS, longer than the replica may lag.
+REPLICA_DATABASE = None
+if os.environ.get('DB_REPLICA_HOST') and DATABASES['default']['ENGINE'].endswith('postgresql'):
+    REPLICA_DATABASE = 'replica'
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.environ['DB_REPLICA_HOST'],
+        'PORT': os.environ.get('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'OPTIONS': {**DATABASES['default']['OPTIONS']},
+        'TEST': {'MIRROR': 'default'},
+    }
+elif os.environ.get('SQLITE_REPLICA_PATH') and DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    REPLICA_DATABASE = 'replica'
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['SQLITE_REPLICA_PATH'],
+        'TEST': {'MIRROR': 'default'},
     }
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# Mess data can be spread over more databases (shard_1, shard_2, ...):
+# SQLITE_SHARD_PATHS lists SQLite files, DB_SHARD_NAMES PostgreSQL
+# databases on the default server. Users, messes, memberships and
+# notifications stay in the default database, which is also a shard. New
+# messes go to the shard holding the fewest; move one with rebalance_shard.
+MESS_SHARDS = ['default']
+if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    shard_settings = [{'NAME': path} for path in os.environ.get('SQLITE_SHARD_PATHS', '').split(',') if path]
+else:
+    shard_settings = [{'NAME': name} for name in os.environ.get('DB_SHARD_NAMES', '').split(',') if name]
+for index, shard in enumerate(shard_settings, 1):
+    DATABASES[f'shard_{index}'] = {**DATABASES['default'], 'OPTIONS': {**DATABASES['default']['OPTIONS']}, **shard}
+    MESS_SHARDS.append(f'shard_{index}')
+
+# The sharding tests run on the configured shards or, without any, on two
+# databases that are only added when the test suite runs (`django-admin
+# test`, or TEST_SHARD_DATABASES=1 for other runners)
+TEST_MESS_SHARDS = MESS_SHARDS
+running_tests = sys.argv[1:2] == ['test'] or os.environ.get('TEST_SHARD_DATABASES') == '1'
+if len(MESS_SHARDS) == 1 and running_tests:
+    for index in (1, 2):
+        DATABASES[f'shard_{index}'] = {
+            **DATABASES['default'], 'OPTIONS': {**DATABASES['default']['OPTIONS']},
+            'NAME': f"{DATABASES['default']['NAME']}_shard_{index}",
+        }
+    TEST_MESS_SHARDS = ['default', 'shard_1', 'shard_2']
+
+# Each shard numbers its mess rows from its own start so a moved mess keeps
+# its row ids. Applied by `migrate --database shard_N`.
+SHARD_ID_STARTS = {
+    alias: int(alias.rsplit('_', 1)[1]) * 10 ** 12 for alias in DATABASES if alias.startswith('shard_')
+}
+
+DATABASE_ROUTERS = ['core.shards.ShardRouter', 'core.replicas.ReplicaRouter']
+
+# Writes made through core.database.run_with_retry retry a locked
+# transaction this many times with exponential backoff from this delay
+DB_LOCK_RETRIES = 5
+DB_LOCK_RETRY_DELAY = 0.05
+
+
 
+# Local memory by default. Multi-process deployments should point this at a
+# shared cache (file based or Redis) so report invalidation reaches every worker.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'mess-manager'),
+    },
+    # Version counters of cached reports and memberships, kept apart from the
+    # cached values: if a counter were culled it would restart at 0 and the
+    # entries stored under the old versions would be served again. Local
+    # memory and file caches get no size limit below; a shared Redis must run
+    # with a noeviction or volatile-* maxmemory-policy (counters never expire).
+    'versions': {
+        'BACKEND': os.environ.get('VERSION_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('VERSION_CACHE_LOCATION', 'mess-manager-versions'),
+        'TIMEOUT': None,
+    },
+}
+if CACHES['versions']['BACKEND'].rsplit('.', 2)[-2] in ('locmem', 'filebased'):
+    CACHES['versions']['OPTIONS'] = {'MAX_ENTRIES': 2 ** 62}
+VERSION_CACHE_ALIAS = 'versions'
+
+# Cached monthly settlements and PDFs, invalidated when the month's data changes
+REPORT_CACHE_ALIAS = 'default'
+REPORT_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Seconds a resolved mess membership is reused across requests. Off by
+# default because it needs a shared cache to see role changes made by
+# other workers; within a request the membership is always resolved once.
+MEMBERSHIP_CACHE_ALIAS = 'default'
+MEMBERSHIP_CACHE_TIMEOUT = int(os.environ.get('MEMBERSHIP_CACHE_TIMEOUT', 0))
+
+# Render PDF reports with `run_report_worker` instead of during the request.
+# Finished files are stored under MEDIA_ROOT/reports/.
+REPORT_JOBS = os.environ.get('REPORT_JOBS', '1') == '1'
+
+# Server-sent event streams of new messages and unread counts. Off by
+# default: a stream stays open as long as the page, which under WSGI ties
+# up a worker for good. To enable it set REALTIME_PUSH=1 and serve
+# mess_manager.asgi:application with an ASGI server (see asgi.py); the
+# streams refuse WSGI requests even then. Without them the bell badge is
+# rendered with each page as before. The in-process broker only reaches
+# clients of the same process; multi-worker deployments point
+# REALTIME_BROKER at a class with the same publish() and subscribe()
+# methods backed by a shared broker.
+REALTIME_PUSH = os.environ.get('REALTIME_PUSH', '0') == '1'
+REALTIME_BROKER = os.environ.get('REALTIME_BROKER', 'core.realtime.InProcessBroker')
+REALTIME_HEARTBEAT = 25
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -141,4 +309,21 @@ if not DEBUG:
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 SESSION_COOKIE_AGE = 1209600  
-SESSION_SAVE_EVERY_REQUEST = True
\ No newline at end of file
+SESSION_SAVE_EVERY_REQUEST = True
+
+# Queue notifications in the outbox and deliver them with
+# `run_notification_worker`. Set to False to write them during the request.
+NOTIFICATION_OUTBOX = os.environ.get('NOTIFICATION_OUTBOX', '1') == '1'
+
+# Read notifications older than this are removed by `purge_notifications`
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 90))
+
+# Request instrumentation, see core.middleware.RequestMetricsMiddleware.
+# Views slower than SLOW_VIEW_MS or running more than SLOW_VIEW_QUERIES
+# queries are logged to the `core.performance` logger. Staff users get the
+# timings of each response in a Server-Timing header, everyone does with
+# SERVER_TIMING_HEADER=1.
+SLOW_VIEW_MS = int(os.environ.get('SLOW_VIEW_MS', 500))
+SLOW_VIEW_QUERIES = int(os.environ.get('SLOW_VIEW_QUERIES', 50))
+VIEW_METRICS_WINDOW = 500
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', '0') == '1'
\ No newline at end of file